@@ -1,24 +1,46 @@
 import gspread
 from google.oauth2.service_account import Credentials
 import vnstock
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, time, timedelta
 import pytz
 import os
 import json
+import sys
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import time as time_module
 import numpy as np
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-import signal
-import platform
+import threading
+import asyncio
+import random
+import inspect
+import re
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp là tùy chọn: chế độ asyncio sẽ chạy requests trong thread pool
+    aiohttp = None
 
 # ====== CẤU HÌNH GITHUB ACTIONS ======
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1xuU1VzRtZtVlNE_GLzebROre4I5ZvwLnU3qGskY10BQ/edit?usp=sharing"
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+# Danh sách nơi ghi giá (spreadsheet, worksheet, cột mã, cột giá); không có file thì chỉ ghi Data_CP của SHEET_URL
+SHEET_TARGETS_FILE = 'sheet_targets.json'
+SHEET_WRITE_WORKERS = 4   # Số target được ghi song song
 
-# Cache cho Google Sheets client
-_worksheet_cache = None
+# Cache cho Google Sheets client và các worksheet đã mở: (url, tên worksheet) -> worksheet
+_sheets_client = None
+_worksheet_cache = {}
+_sheet_targets = None
 
 # Biến để theo dõi lỗi liên tục
 _error_count = 0
@@ -36,8 +58,134 @@ _max_restarts = float('inf')  # Vô hạn restart - chỉ dừng khi cancel th
 API_TIMEOUT = 8  # Tăng lên 8 giây cho GitHub Actions
 MAX_RETRIES = 3   # Tăng lên 3 lần retry cho GitHub Actions
 
-def setup_requests_session():
-    """Thiết lập session với retry strategy và headers giả lập browser"""
+# Cấu hình lấy giá song song
+FETCH_WORKERS = 16         # Số luồng lấy giá đồng thời
+FETCH_CYCLE_TIMEOUT = 45   # Thời gian tối đa (giây) cho việc lấy giá của một chu kỳ
+HISTORY_WINDOW_DAYS = 7    # Cửa sổ nến ngày tải 1 lần/mã/chu kỳ (rộng nhất mà các method cần)
+CALL_WORKERS = 32          # Số luồng chạy API call có timeout
+MAX_ABANDONED_CALLS = 16   # Số API call quá hạn nhưng chưa kết thúc tối đa trước khi ngừng gọi thêm
+ABANDONED_CALL_MAX_AGE = 120   # Sau (giây) call treo không còn được tính vào MAX_ABANDONED_CALLS
+# Timeout (kết nối, đọc) cho mọi request HTTP không tự đặt timeout - vnstock 0.2.0 gọi requests không có timeout
+HTTP_TRANSPORT_TIMEOUT = (5, API_TIMEOUT)
+# Số request đồng thời tối đa cho từng nguồn dữ liệu
+SOURCE_CONCURRENCY = {
+    'realtime': 8,
+    'alternative': 8,
+    'force': 4,
+    'webscrape': 2,
+    'closing': 8,
+}
+
+# Lịch cập nhật
+FAST_POLL_INTERVAL = (55, 65)        # Khoảng chờ ngẫu nhiên (giây) giữa 2 lần cập nhật khi đang khớp lệnh
+CLOSING_REFRESH_TIME = time(15, 0)   # Lấy giá đóng cửa sau khi phiên thỏa thuận kết thúc
+
+# Số host tối đa giữ connection pool trong mỗi session
+HTTP_POOL_HOSTS = 16
+
+# Cache giá trong process
+PRICE_CACHE_SIZE = 2000      # Số entry tối đa (LRU)
+CLOSE_RETRY_TTL = 1800       # Giá đóng cửa chưa đúng ngày giao dịch gần nhất hết hạn sau (giây)
+
+# Lưu giá xuống đĩa để khởi động lại không phải lấy lại từ đầu
+PRICE_STORE_FILE = 'price_store.sqlite3'
+CLOSE_HISTORY_DAYS = 30      # Số ngày giá đóng cửa giữ lại trong file
+
+# Danh sách mã niêm yết dùng để kiểm tra mã trên sheet
+LISTING_FILE = 'listing_companies.json'
+LISTING_MAX_AGE_DAYS = 7     # Tải lại danh sách mã sau (ngày)
+TICKER_LIST_REFRESH = 600    # Đọc lại cột C (danh sách mã) sau (giây)
+
+# Giá lệch quá tỷ lệ này so với giá hợp lệ gần nhất bị coi là bất thường
+PRICE_BAND = 0.5
+
+# Logging: mức log mặc định (bật DEBUG bằng LOG_LEVEL=DEBUG hoặc tham số --debug)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_INTERVAL = 300   # Message lặp lại chỉ log 1 lần trong khoảng này (giây), trừ khi bật DEBUG
+LOG_SAMPLE_MAX_KEYS = 5000  # Số message khác nhau tối đa được nhớ trước khi dọn các message đã hết hạn
+
+# Chế độ asyncio (ASYNC_MODE=1 hoặc tham số --async): 1 event loop, HTTP bất đồng bộ
+ASYNC_MODE = os.getenv('ASYNC_MODE', '0') == '1'
+ASYNC_HTTP_LIMIT = 100       # Số kết nối HTTP đồng thời tối đa (aiohttp)
+
+# Metrics mỗi chu kỳ (JSON lines, 1 dòng / chu kỳ)
+METRICS_FILE = 'metrics.jsonl'
+METRICS_MAX_BYTES = 5 * 1024 * 1024                # Đổi tên thành .1 khi vượt quá
+METRICS_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10)  # Mốc histogram độ trễ (giây)
+
+# Xếp hạng method lấy giá theo hiệu quả gần đây
+ROUTER_WINDOW = 50               # Số lần gọi gần nhất được tính cho mỗi (method, nhóm mã)
+CIRCUIT_BREAKER_FAILURES = 5     # Số lần lỗi liên tiếp để tạm ngắt 1 method
+CIRCUIT_BREAKER_COOLDOWN = 120   # Thời gian tạm ngắt (giây)
+
+# Ghi giá lên sheet ngay trong lúc chu kỳ đang lấy giá (gom nhiều mã vào 1 lần batch_update)
+STREAM_WRITES = os.getenv('STREAM_WRITES', '0') == '1'
+STREAM_FLUSH_INTERVAL = 2.0      # Ghi phần đã có sau mỗi (giây)
+STREAM_FLUSH_SIZE = 50           # hoặc khi đã gom đủ số mã này
+
+# Lệnh khớp trong phiên (intraday): ring buffer cho mỗi mã, mỗi chu kỳ chỉ tải các trang mới
+INTRADAY_CAPACITY = 4096         # Số lệnh khớp gần nhất giữ lại cho mỗi mã
+INTRADAY_PAGE_SIZE = 100         # Số lệnh mỗi trang (TCBS tối đa 100)
+INTRADAY_MAX_PAGES = 10          # Số trang tối đa mỗi lần cập nhật 1 mã
+# Ghi thêm VWAP, giá cao/thấp và khối lượng của phiên vào các cột sau cột giá (tắt mặc định)
+INTRADAY_COLUMNS = os.getenv('INTRADAY_COLUMNS', '0') == '1'
+INTRADAY_BACKFILL_PAGES = 100    # Số trang tối đa khi cần đọc lại từ đầu phiên (lần nạp đầu, mất mốc) nếu bật INTRADAY_COLUMNS
+INTRADAY_COLUMN_FIELDS = OrderedDict([('I', 'vwap'), ('J', 'high'), ('K', 'low'), ('L', 'volume')])
+
+# Hedged request (HEDGE_ENABLED=1 hoặc tham số --hedge): gọi song song method thứ 2 khi method chính chậm bất thường
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '0') == '1'
+HEDGE_PERCENTILE = 90            # Gửi hedge khi method chính chậm hơn percentile độ trễ này
+HEDGE_DEFAULT_DELAY = 2.0        # Độ trễ (giây) trước khi hedge khi chưa đủ thống kê
+HEDGE_MIN_SAMPLES = 5            # Số mẫu tối thiểu để tính percentile
+MAX_HEDGES_IN_FLIGHT = 4         # Số hedge chạy đồng thời tối đa
+
+# Giới hạn tốc độ request theo host: host -> (số request/giây, số request burst)
+RATE_LIMITS = {
+    'apipubaws.tcbs.com.vn': (10, 10),     # price board, intraday
+    'services.entrade.com.vn': (10, 10),   # dữ liệu lịch sử
+    'vnstock': (10, 10),                   # Vnstock/Quote (host tùy phiên bản vnstock)
+    'finfo-api.vndirect.com.vn': (5, 5),
+    'api.vietstock.vn': (5, 5),
+    'www.vietcap.com.vn': (3, 3),
+    'www.ssi.com.vn': (3, 3),
+    'www.vndirect.com.vn': (3, 3),
+    'sheets.googleapis.com': (1, 5),       # Quota Google Sheets: 60 request/phút
+}
+DEFAULT_RATE_LIMIT = (5, 5)
+RATE_LIMIT_MIN_FRACTION = 0.1    # Tốc độ tối thiểu khi bị giảm (tỷ lệ so với tốc độ cấu hình)
+RATE_LIMIT_RECOVERY = 0.1        # Mỗi lần thành công tăng lại tốc độ thêm tỷ lệ này
+
+# Số mã tối đa cho mỗi request price board (nhiều mã / 1 request)
+PRICE_BOARD_CHUNK_SIZE = 50
+
+# Thread pool và semaphore dùng chung cho việc lấy giá
+_fetch_executor = None
+_call_executor = None
+_cycle_deadline = None
+_abandoned_calls = {}   # future -> thời điểm bị bỏ (monotonic)
+_abandoned_lock = threading.Lock()
+
+# Hedge đang chạy và thống kê hedge của chu kỳ
+_hedge_executor = None
+_hedge_slots = threading.BoundedSemaphore(MAX_HEDGES_IN_FLIGHT)
+_hedge_stats = {'launched': 0, 'won': 0}
+_hedge_stats_lock = threading.Lock()
+
+# Thống kê method lấy giá theo mã: mã -> {method: [thành công, thất bại]}
+_method_stats = {}
+_method_stats_dirty = set()
+_method_stats_lock = threading.Lock()
+_source_semaphores = {
+    source: threading.BoundedSemaphore(limit)
+    for source, limit in SOURCE_CONCURRENCY.items()
+}
+
+def setup_requests_session(pool_maxsize=None, max_retries=MAX_RETRIES):
+    """Thiết lập session với retry strategy và headers giả lập browser
+
+    pool_maxsize: số kết nối keep-alive tối đa giữ lại cho mỗi host
+    (mặc định bằng FETCH_WORKERS để mỗi luồng lấy giá có 1 kết nối).
+    """
     session = requests.Session()
     
     # Headers giả lập browser thật để tránh bị block
@@ -55,91 +203,652 @@ def setup_requests_session():
     })
     
     retry_strategy = Retry(
-        total=MAX_RETRIES,
+        total=max_retries,
         backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
+        status_forcelist=[500, 502, 503, 504],  # 429 do _rate_limiter xử lý: retry của urllib3 bỏ qua token bucket
         allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    if pool_maxsize is None:
+        pool_maxsize = FETCH_WORKERS
+    adapter = HTTPAdapter(
+        max_retries=retry_strategy,
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=pool_maxsize
+    )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     session.timeout = API_TIMEOUT
     return session
 
-def check_network_connection():
-    """Kiểm tra kết nối mạng"""
-    try:
-        session = setup_requests_session()
-        # Thử kết nối đến một số domain phổ biến
-        test_urls = [
-            "https://www.google.com",
-            "https://www.vietcap.com.vn",
-            "https://www.ssi.com.vn"
-        ]
-        
-        for url in test_urls:
-            try:
-                response = session.get(url, timeout=5)
-                if response.status_code == 200:
-                    return True
-            except:
-                continue
-        
-        return False
-    except:
-        return False
+# ====== LOGGING ======
+logger = logging.getLogger('stock_updater')
 
-def safe_vnstock_call(func, *args, **kwargs):
-    """Gọi vnstock API một cách an toàn với timeout và retry"""
-    import signal
-    import platform
+class SamplingFilter(logging.Filter):
+    """Bỏ bớt message lặp lại: mỗi message (đã format) chỉ log 1 lần mỗi interval giây
+
+    So sánh message đã format nên các dòng cùng mẫu "%s" của từng mã khác
+    nhau không bị gộp. Lỗi (ERROR trở lên) luôn được log. Lần log kế tiếp ghi
+    kèm số lần đã bị ẩn.
+    """
+
+    def __init__(self, interval=LOG_SAMPLE_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._seen = {}  # (level, message) -> (lần log gần nhất, số lần bị ẩn)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.levelno, record.getMessage())
+        now = time_module.monotonic()
+        with self._lock:
+            if len(self._seen) > LOG_SAMPLE_MAX_KEYS:
+                # Message theo từng mã/giá rất đa dạng: bỏ các key đã hết interval và không còn lần bị ẩn
+                self._seen = {
+                    seen_key: seen for seen_key, seen in self._seen.items()
+                    if seen[1] or now - seen[0] < self.interval
+                }
+            logged_at, suppressed = self._seen.get(key, (None, 0))
+            if logged_at is not None and now - logged_at < self.interval:
+                self._seen[key] = (logged_at, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} (+{suppressed} lần lặp lại bị ẩn)"
+        return True
+
+_log_listener = None
+
+def setup_logging(level=LOG_LEVEL):
+    """Ghi log qua queue: luồng lấy giá chỉ đưa record vào queue, 1 thread nền ghi ra stdout"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    level = getattr(logging, str(level).upper(), logging.INFO)
     
-    # Windows không hỗ trợ signal.SIGALRM, sử dụng threading.Timer thay thế
-    if platform.system() == 'Windows':
-        import threading
-        import time
-        
-        result = [None]
-        exception = [None]
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname).1s %(message)s', datefmt='%H:%M:%S'))
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    if level > logging.DEBUG:
+        queue_handler.addFilter(SamplingFilter())
+    
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    _log_listener = QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
+def shutdown_logging():
+    """Ghi hết log còn trong queue (gọi trước khi thoát bằng os._exit)"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+# ====== METRICS MỖI CHU KỲ ======
+class CycleMetrics:
+    """Thu thập số liệu của 1 chu kỳ cập nhật và ghi ra METRICS_FILE (JSON lines)
+
+    - timings: tổng thời gian (giây) theo từng phần (lấy giá, ghi sheet, ngủ...)
+    - latency: histogram độ trễ theo nguồn lấy giá (mốc METRICS_LATENCY_BUCKETS)
+    - fallback_depth: số mã theo số method phải thử trước khi có giá
+    - values: các số đếm/tỷ lệ khác (cache hit, số mã thành công...)
+    Thời gian ngủ giữa 2 chu kỳ được tính vào chu kỳ kế tiếp.
+    """
+
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.latency = {}
+            self.fallback_depth = {}
+            self.values = {}
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        started = time_module.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time_module.monotonic() - started)
+
+    def observe(self, source, seconds):
+        """Ghi nhận 1 lần gọi nguồn lấy giá vào histogram độ trễ"""
+        bucket = next((str(bound) for bound in METRICS_LATENCY_BUCKETS if seconds <= bound), '+Inf')
+        with self._lock:
+            histogram = self.latency.get(source)
+            if histogram is None:
+                histogram = self.latency[source] = {'count': 0, 'sum': 0.0, 'buckets': {}}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + 1
+
+    def record_depth(self, chain, depth):
+        """Mã lấy được giá ở method thứ depth của chuỗi fallback chain"""
+        with self._lock:
+            depths = self.fallback_depth.setdefault(chain, {})
+            depths[str(depth)] = depths.get(str(depth), 0) + 1
+
+    def set(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def flush(self):
+        """Ghi số liệu của chu kỳ vừa xong ra file rồi bắt đầu chu kỳ mới"""
+        with self._lock:
+            record = {
+                'timestamp': datetime.now(pytz.UTC).isoformat(timespec='seconds'),
+                'timings': {name: round(seconds, 3) for name, seconds in self.timings.items()},
+                'latency': {
+                    source: dict(histogram, sum=round(histogram['sum'], 3))
+                    for source, histogram in self.latency.items()
+                },
+                'fallback_depth': self.fallback_depth,
+                **self.values,
+            }
+        self.reset()
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > METRICS_MAX_BYTES:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logger.warning(f"⚠️ Không thể ghi metrics vào {self.path}: {e}")
+        return record
+
+_metrics = CycleMetrics()
+
+# ====== CLIENT DÙNG CHUNG (HTTP SESSION, VNSTOCK) ======
+class ClientRegistry:
+    """Giữ HTTP session (kết nối keep-alive) và vnstock client dùng chung cho cả process
+
+    Mỗi session/client chỉ được tạo 1 lần (có khóa để an toàn khi nhiều
+    luồng cùng gọi), tránh bắt tay TLS và khởi tạo object lặp lại cho từng mã.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._vnstock_client = None
+
+    def session(self, name='default', max_retries=MAX_RETRIES):
+        """Lấy session dùng chung theo tên (tạo mới nếu chưa có)"""
+        session = self._sessions.get(name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(name)
+                if session is None:
+                    session = setup_requests_session(max_retries=max_retries)
+                    self._sessions[name] = session
+        return session
+
+    def vnstock_client(self):
+        """Lấy vnstock.Vnstock() dùng chung (AttributeError nếu phiên bản vnstock không có class này)"""
+        if self._vnstock_client is None:
+            with self._lock:
+                if self._vnstock_client is None:
+                    self._vnstock_client = vnstock.Vnstock()
+        return self._vnstock_client
+
+    def connection_stats(self):
+        """Thống kê số request và số kết nối đã mở của các connection pool"""
+        total_requests = 0
+        total_connections = 0
+        for session in list(self._sessions.values()):
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    total_requests += pool.num_requests
+                    total_connections += pool.num_connections
+        reused = max(total_requests - total_connections, 0)
+        reuse_rate = (reused / total_requests * 100) if total_requests else 0.0
+        return {
+            'requests': total_requests,
+            'connections': total_connections,
+            'reuse_rate': reuse_rate,
+        }
+
+_client_registry = ClientRegistry()
+
+# ====== HEALTH MONITOR KẾT NỐI ======
+# Các nguồn dữ liệu được kiểm tra định kỳ: host -> chu kỳ kiểm tra (giây)
+HEALTH_CHECKS = {
+    'www.google.com': 60,
+    'apipubaws.tcbs.com.vn': 30,      # price board, intraday
+    'services.entrade.com.vn': 30,    # dữ liệu lịch sử
+    'finfo-api.vndirect.com.vn': 120,
+    'api.vietstock.vn': 120,
+    'www.vietcap.com.vn': 120,
+    'www.ssi.com.vn': 120,
+    'www.vndirect.com.vn': 120,
+}
+HEALTH_TTL_FACTOR = 3  # Kết quả kiểm tra hết hạn sau HEALTH_TTL_FACTOR chu kỳ
+
+class ConnectivityMonitor:
+    """Kiểm tra kết nối đến từng nguồn dữ liệu trong thread nền và cache kết quả
+
+    Các hàm lấy giá chỉ đọc kết quả cache (không chặn, không gửi request).
+    Nguồn chưa được kiểm tra hoặc kết quả đã hết hạn được coi là đang hoạt động.
+    """
+
+    def __init__(self, checks):
+        self.checks = dict(checks)
+        self._status = {}       # host -> (is_up, thời điểm kiểm tra)
+        self._next_check = {}   # host -> thời điểm kiểm tra tiếp theo
+        self._lock = threading.Lock()
+        self._thread = None
+        self._session = None
+        self._paused = threading.Event()
+        self._recheck_all = False
+
+    def _probe(self, host):
+        """Gửi 1 request đến host, coi là hoạt động nếu server phản hồi (không phải lỗi 5xx)"""
+        try:
+            response = self._session.get(f"https://{host}", timeout=5)
+            return response.status_code < 500
+        except:
+            return False
+
+    async def _probe_async(self, http, host):
+        """Phiên bản asyncio của _probe"""
+        try:
+            status, _ = await http.get(f"https://{host}", timeout=5, session_name='health', max_retries=0)
+            return status < 500
+        except Exception:
+            return False
+
+    def _due_hosts(self, force):
+        now = time_module.monotonic()
+        return [host for host in self.checks if force or self._next_check.get(host, 0) <= now]
+
+    def _store_results(self, hosts, results):
+        checked_at = time_module.monotonic()
+        with self._lock:
+            for host, is_up in zip(hosts, results):
+                self._status[host] = (is_up, checked_at)
+                self._next_check[host] = checked_at + self.checks[host]
+
+    def check_all(self, force=False):
+        """Kiểm tra các host đến hạn (hoặc tất cả nếu force=True)"""
+        if self._session is None:
+            # Probe không retry để phát hiện nguồn lỗi nhanh
+            self._session = _client_registry.session('health', max_retries=0)
+        due_hosts = self._due_hosts(force)
+        if not due_hosts:
+            return
         
-        def target():
+        # Kiểm tra song song các host đến hạn
+        with _metrics.timer('health_probe'), ThreadPoolExecutor(max_workers=len(due_hosts)) as executor:
+            results = list(executor.map(self._probe, due_hosts))
+        self._store_results(due_hosts, results)
+
+    async def check_all_async(self, http, force=False):
+        """Phiên bản asyncio của check_all: probe tất cả host đến hạn trên event loop"""
+        due_hosts = self._due_hosts(force)
+        if not due_hosts:
+            return
+        with _metrics.timer('health_probe'):
+            results = await asyncio.gather(*(self._probe_async(http, host) for host in due_hosts))
+        self._store_results(due_hosts, results)
+
+    def pause(self):
+        """Tạm dừng kiểm tra định kỳ (khi ngủ ngoài giờ giao dịch)"""
+        self._paused.set()
+
+    def resume(self):
+        """Tiếp tục kiểm tra định kỳ, kiểm tra lại tất cả host ngay"""
+        self._paused.clear()
+        if self._thread is not None:
+            self.check_all(force=True)
+        else:
+            # Chế độ asyncio: task kiểm tra định kỳ sẽ kiểm tra lại tất cả ở vòng kế tiếp
+            self._recheck_all = True
+
+    def _run(self):
+        while True:
+            if self._paused.is_set():
+                time_module.sleep(1)
+                continue
             try:
-                result[0] = func(*args, **kwargs)
+                self.check_all()
             except Exception as e:
-                exception[0] = e
-        
-        thread = threading.Thread(target=target)
-        thread.daemon = True
-        thread.start()
-        thread.join(timeout=API_TIMEOUT)
-        
-        if thread.is_alive():
-            # Thread vẫn chạy sau timeout
-            return None  # Timeout
-        
-        if exception[0]:
-            raise exception[0]
-        
-        return result[0]
+                logger.warning(f"⚠️ Lỗi health monitor: {e}")
+            time_module.sleep(1)
+
+    async def run_async(self, http):
+        """Kiểm tra định kỳ như 1 task trên event loop (thay cho thread nền ở chế độ asyncio)"""
+        while True:
+            if not self._paused.is_set():
+                force, self._recheck_all = self._recheck_all, False
+                try:
+                    await self.check_all_async(http, force=force)
+                except Exception as e:
+                    logger.warning(f"⚠️ Lỗi health monitor: {e}")
+            await asyncio.sleep(1)
+
+    def start(self):
+        """Kiểm tra tất cả host 1 lần rồi chạy kiểm tra định kỳ trong thread nền"""
+        if self._thread is not None:
+            return
+        self.check_all(force=True)
+        self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+        self._thread.start()
+
+    def is_up(self, host):
+        """Đọc trạng thái cache của host (không chặn)"""
+        with self._lock:
+            status = self._status.get(host)
+        if status is None:
+            return True
+        is_up, checked_at = status
+        if time_module.monotonic() - checked_at > self.checks.get(host, 60) * HEALTH_TTL_FACTOR:
+            return True
+        return is_up
+
+    def is_url_up(self, url):
+        """Đọc trạng thái cache của host trong URL"""
+        return self.is_up(url.split('/')[2])
+
+    def any_up(self):
+        """Có ít nhất 1 host đang hoạt động (không chặn)"""
+        return any(self.is_up(host) for host in self.checks)
+
+_health_monitor = ConnectivityMonitor(HEALTH_CHECKS)
+
+def check_network_connection():
+    """Kiểm tra kết nối mạng (đọc kết quả cache từ health monitor)"""
+    return _health_monitor.any_up()
+
+# ====== GIỚI HẠN TỐC ĐỘ REQUEST ======
+class TokenBucket:
+    """Token bucket có tốc độ tự điều chỉnh
+
+    Gặp lỗi 429 hoặc response rỗng: giảm 1 nửa tốc độ (không thấp hơn
+    RATE_LIMIT_MIN_FRACTION). Mỗi lần thành công: tăng lại RATE_LIMIT_RECOVERY
+    tốc độ cấu hình cho đến khi về mức ban đầu.
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time_module.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self):
+        """Lấy 1 token nếu có: trả về 0, nếu không trả về số giây cần chờ"""
+        with self._lock:
+            self._refill(time_module.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Lấy 1 token, chờ nếu cần; trả về False nếu không lấy được trong timeout giây"""
+        deadline = None if timeout is None else time_module.monotonic() + timeout
+        while True:
+            wait_seconds = self._take()
+            if not wait_seconds:
+                return True
+            if deadline is not None and time_module.monotonic() + wait_seconds > deadline:
+                return False
+            time_module.sleep(wait_seconds)
+            _metrics.add_time('rate_limit_wait', wait_seconds)
+
+    async def acquire_async(self, timeout=None):
+        """Phiên bản asyncio của acquire (chờ bằng asyncio.sleep, không chặn event loop)"""
+        deadline = None if timeout is None else time_module.monotonic() + timeout
+        while True:
+            wait_seconds = self._take()
+            if not wait_seconds:
+                return True
+            if deadline is not None and time_module.monotonic() + wait_seconds > deadline:
+                return False
+            await asyncio.sleep(wait_seconds)
+            _metrics.add_time('rate_limit_wait', wait_seconds)
+
+    def penalize(self):
+        with self._lock:
+            self.rate = max(self.rate * 0.5, self.max_rate * RATE_LIMIT_MIN_FRACTION)
+
+    def reward(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.rate + self.max_rate * RATE_LIMIT_RECOVERY, self.max_rate)
+
+class RateLimiter:
+    """Token bucket riêng cho từng host, dùng chung cho mọi luồng"""
+
+    def __init__(self, limits, default_limit):
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(host)
+                if bucket is None:
+                    rate, capacity = self.limits.get(host, self.default_limit)
+                    bucket = self._buckets[host] = TokenBucket(rate, capacity)
+        return bucket
+
+    def acquire(self, host, timeout=None):
+        """Chờ đến lượt gửi request tới host; TimeoutError nếu quá timeout giây"""
+        if not self.bucket(host).acquire(timeout):
+            raise TimeoutError(f"Rate limit {host}: không đến lượt trong {timeout:.1f} giây")
+
+    async def acquire_async(self, host, timeout=None):
+        """Phiên bản asyncio của acquire"""
+        if not await self.bucket(host).acquire_async(timeout):
+            raise TimeoutError(f"Rate limit {host}: không đến lượt trong {timeout:.1f} giây")
+
+    def penalize(self, host):
+        self.bucket(host).penalize()
+
+    def reward(self, host):
+        self.bucket(host).reward()
+
+    def throttled_hosts(self):
+        """Các host đang bị giảm tốc độ: host -> (tốc độ hiện tại, tốc độ cấu hình)"""
+        with self._lock:
+            buckets = list(self._buckets.items())
+        return {host: (bucket.rate, bucket.max_rate) for host, bucket in buckets if bucket.rate < bucket.max_rate}
+
+_rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+
+# Host thực tế của các hàm vnstock (vnstock 0.2.x)
+VNSTOCK_FUNCTION_HOSTS = {
+    'price_board': 'apipubaws.tcbs.com.vn',
+    'stock_intraday_data': 'apipubaws.tcbs.com.vn',
+    'stock_historical_data': 'services.entrade.com.vn',
+    'listing_companies': 'raw.githubusercontent.com',
+}
+
+def _vnstock_host(func):
+    return VNSTOCK_FUNCTION_HOSTS.get(getattr(func, '__name__', ''), 'vnstock')
+
+def _is_rate_limit_error(error):
+    return '429' in str(error) or 'too many requests' in str(error).lower()
+
+def rate_limited_get(session, url, **kwargs):
+    """session.get có giới hạn tốc độ theo host, tự giảm tốc khi gặp 429"""
+    host = url.split('/')[2]
+    _rate_limiter.acquire(host, timeout=max(remaining_cycle_time(), 0))
+    try:
+        response = session.get(url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        if _is_rate_limit_error(e) or getattr(e.response, 'status_code', None) == 429:
+            _rate_limiter.penalize(host)
+        raise
+    if response.status_code == 429:
+        _rate_limiter.penalize(host)
     else:
-        # Unix/Linux systems
-        def timeout_handler(signum, frame):
-            raise TimeoutError("API call timeout")
-        
-        # Thiết lập timeout
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(API_TIMEOUT)
-        
-        try:
+        _rate_limiter.reward(host)
+    return response
+
+def sheets_call(func, *args, **kwargs):
+    """Gọi Google Sheets API có giới hạn tốc độ theo quota"""
+    _rate_limiter.acquire('sheets.googleapis.com')
+    try:
+        with _metrics.timer(f"sheets.{getattr(func, '__name__', 'call')}"):
             result = func(*args, **kwargs)
-            signal.alarm(0)  # Hủy timeout
-            return result
-        except TimeoutError:
-            signal.alarm(0)
-            raise TimeoutError(f"API call timeout after {API_TIMEOUT} seconds")
-        except Exception as e:
-            signal.alarm(0)
-            raise e
+    except Exception as e:
+        if _is_rate_limit_error(e):
+            _rate_limiter.penalize('sheets.googleapis.com')
+        raise
+    _rate_limiter.reward('sheets.googleapis.com')
+    return result
+
+# ====== TIMEOUT CHO API CALL ======
+_session_request = requests.Session.request
+_session_request_signature = inspect.signature(_session_request)
+_transport_timeout_scope = threading.local()  # active=True trong luồng đang chạy call của call_with_timeout
+
+def _request_with_transport_timeout(self, method, url, *args, **kwargs):
+    """Session.request với HTTP_TRANSPORT_TIMEOUT khi bên gọi không đặt timeout
+
+    Chỉ áp dụng trong luồng đang chạy call của call_with_timeout (vnstock gọi
+    requests.get/requests.request không có timeout, cũng đi qua
+    Session.request), nên socket bị treo luôn kết thúc bằng lỗi timeout thay
+    vì giữ luồng mãi mãi; các request khác trong tiến trình không bị ảnh hưởng.
+    """
+    if getattr(_transport_timeout_scope, 'active', False):
+        bound = _session_request_signature.bind(self, method, url, *args, **kwargs)
+        if bound.arguments.get('timeout') is None:
+            bound.arguments['timeout'] = HTTP_TRANSPORT_TIMEOUT
+            return _session_request(*bound.args, **bound.kwargs)
+    return _session_request(self, method, url, *args, **kwargs)
+
+def install_transport_timeout():
+    """Cài HTTP_TRANSPORT_TIMEOUT cho các call của call_with_timeout (gọi 1 lần khi khởi động)"""
+    requests.Session.request = _request_with_transport_timeout
+
+def _run_with_transport_timeout(func, args, kwargs):
+    _transport_timeout_scope.active = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _transport_timeout_scope.active = False
+
+def _get_call_executor():
+    """Lấy thread pool dùng để chạy các API call có timeout (số luồng cố định)"""
+    global _call_executor
+    if _call_executor is None:
+        _call_executor = ThreadPoolExecutor(max_workers=CALL_WORKERS, thread_name_prefix="api-call")
+    return _call_executor
+
+def start_cycle_deadline(budget_seconds):
+    """Đặt hạn chót cho chu kỳ cập nhật hiện tại (tính từ bây giờ)"""
+    global _cycle_deadline
+    _cycle_deadline = time_module.monotonic() + budget_seconds
+
+def remaining_cycle_time():
+    """Số giây còn lại trước hạn chót của chu kỳ (vô hạn nếu chưa đặt hạn chót)"""
+    if _cycle_deadline is None:
+        return float('inf')
+    return _cycle_deadline - time_module.monotonic()
+
+def _effective_timeout(timeout):
+    """Timeout thực tế của 1 call: không vượt quá thời gian còn lại của chu kỳ"""
+    if timeout is None:
+        timeout = API_TIMEOUT
+    return min(timeout, remaining_cycle_time())
+
+def _abandon_call(future):
+    """Bỏ kết quả của call đã quá hạn; call đang chạy được theo dõi cho đến khi tự kết thúc"""
+    if future.cancel():
+        return
+    with _abandoned_lock:
+        _abandoned_calls[future] = time_module.monotonic()
+    future.add_done_callback(_release_abandoned_call)
+
+def _release_abandoned_call(future):
+    with _abandoned_lock:
+        _abandoned_calls.pop(future, None)
+
+def _count_abandoned_calls():
+    """Số call treo gần đây; call treo quá ABANDONED_CALL_MAX_AGE giây không còn được tính"""
+    now = time_module.monotonic()
+    with _abandoned_lock:
+        expired = [future for future, abandoned_at in _abandoned_calls.items() if now - abandoned_at > ABANDONED_CALL_MAX_AGE]
+        for future in expired:
+            del _abandoned_calls[future]
+        count = len(_abandoned_calls)
+    if expired:
+        logger.warning(f"⚠️ {len(expired)} API call treo quá {ABANDONED_CALL_MAX_AGE} giây, bỏ theo dõi")
+    return count
+
+def _submit_call(func, args, kwargs, timeout):
+    """Kiểm tra hạn chót và số call đang treo, sau đó đưa call vào thread pool"""
+    if timeout <= 0:
+        raise TimeoutError("Hết thời gian của chu kỳ cập nhật")
+    abandoned_count = _count_abandoned_calls()
+    if abandoned_count >= MAX_ABANDONED_CALLS:
+        raise TimeoutError(f"Có {abandoned_count} API call đang treo, tạm dừng gọi thêm")
+    return _get_call_executor().submit(_run_with_transport_timeout, func, args, kwargs)
+
+def call_with_timeout(func, args=(), kwargs=None, timeout=None):
+    """Gọi func với timeout, dùng được từ mọi thread (không dùng signal)
+
+    timeout mặc định là API_TIMEOUT và luôn bị giới hạn bởi hạn chót của chu kỳ.
+    Call quá hạn không chặn luồng gọi; luồng chạy call được trả lại pool khi
+    call kết thúc (request HTTP luôn có HTTP_TRANSPORT_TIMEOUT). Khi có quá
+    MAX_ABANDONED_CALLS call treo trong ABANDONED_CALL_MAX_AGE giây gần nhất
+    thì tạm ngừng gọi thêm.
+    """
+    timeout = _effective_timeout(timeout)
+    future = _submit_call(func, args, kwargs or {}, timeout)
+    try:
+        return future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        _abandon_call(future)
+        raise TimeoutError(f"API call timeout after {timeout:.1f} seconds")
+
+def _record_vnstock_outcome(host, result=None, error=None):
+    """Giảm tốc host khi bị 429, tăng lại khi có response
+
+    Kết quả rỗng (trang intraday trống, mã không có trên price board) là
+    bình thường, không phải dấu hiệu bị giới hạn tốc độ.
+    """
+    if error is not None:
+        if _is_rate_limit_error(error):
+            _rate_limiter.penalize(host)
+    else:
+        _rate_limiter.reward(host)
+
+def safe_vnstock_call(func, *args, **kwargs):
+    """Gọi vnstock API một cách an toàn với timeout và giới hạn tốc độ theo host"""
+    host = _vnstock_host(func)
+    _rate_limiter.acquire(host, timeout=max(_effective_timeout(None), 0))
+    try:
+        result = call_with_timeout(func, args, kwargs)
+    except Exception as e:
+        _record_vnstock_outcome(host, error=e)
+        raise
+    _record_vnstock_outcome(host, result=result)
+    return result
 
 def load_restart_count():
     """Load restart count từ file"""
@@ -161,49 +870,785 @@ def save_restart_count():
     except:
         pass
 
+def _cap_sleep_to_runtime(seconds):
+    """Giới hạn thời gian ngủ để không vượt quá thời điểm tự động restart"""
+    if _start_time is None:
+        return seconds
+    elapsed = (datetime.now() - _start_time).total_seconds()
+    remaining = _max_runtime_minutes * 60 - elapsed
+    return max(min(seconds, remaining), 1)
+
 # ====== 1. KIỂM TRA THỜI GIAN THỊ TRƯỜNG ======
-def is_market_open():
-    """Kiểm tra xem thị trường chứng khoán Việt Nam có đang mở cửa không"""
-    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    now = datetime.now(vn_tz)
-    
-    # Debug timezone cho GitHub Actions
-    utc_now = datetime.now(pytz.UTC)
-    print(f"🌍 Timezone Debug: UTC={utc_now.strftime('%H:%M:%S %d/%m/%Y')}, VN={now.strftime('%H:%M:%S %d/%m/%Y')}")
-    
-    # Thời gian mở cửa: 9:00 - 15:00 (giờ Việt Nam)
-    market_open = time(9, 0)
-    market_close = time(15, 0)
-    
-    # Kiểm tra xem có phải ngày làm việc không (thứ 2-6)
-    is_weekday = now.weekday() < 5  # 0=Monday, 4=Friday
-    
-    # Kiểm tra thời gian
-    is_time_ok = market_open <= now.time() <= market_close
-    
-    market_status = "MỞ" if (is_weekday and is_time_ok) else "ĐÓNG"
-    print(f"📊 Thị trường: {market_status} (Weekday: {is_weekday}, Time: {is_time_ok})")
+VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Các phiên trong ngày giao dịch (HOSE/HNX)
+SESSION_PRE_OPEN = 'pre_open'        # Trước 9:00
+SESSION_ATO = 'ato'                  # 9:00 - 9:15
+SESSION_CONTINUOUS = 'continuous'    # 9:15 - 11:30 và 13:00 - 14:30
+SESSION_LUNCH_BREAK = 'lunch_break'  # 11:30 - 13:00
+SESSION_ATC = 'atc'                  # 14:30 - 14:45
+SESSION_CLOSED = 'closed'            # Sau 14:45 và ngày nghỉ
+
+SESSION_SCHEDULE = [
+    (time(9, 0), SESSION_ATO),
+    (time(9, 15), SESSION_CONTINUOUS),
+    (time(11, 30), SESSION_LUNCH_BREAK),
+    (time(13, 0), SESSION_CONTINUOUS),
+    (time(14, 30), SESSION_ATC),
+    (time(14, 45), SESSION_CLOSED),
+]
+
+SESSION_NAMES = {
+    SESSION_PRE_OPEN: "Trước giờ mở cửa",
+    SESSION_ATO: "ATO",
+    SESSION_CONTINUOUS: "Khớp lệnh liên tục",
+    SESSION_LUNCH_BREAK: "Nghỉ trưa",
+    SESSION_ATC: "ATC",
+    SESSION_CLOSED: "Đóng cửa",
+}
+
+# Lịch nghỉ giao dịch HOSE/HNX (ngoài thứ 7, chủ nhật)
+# Cần kiểm tra lại theo thông báo của HOSE mỗi năm; có thể bổ sung ngày nghỉ
+# trong file MARKET_HOLIDAYS_FILE (danh sách "YYYY-MM-DD") mà không cần sửa code.
+MARKET_HOLIDAYS = {
+    # 2025
+    '2025-01-01',                                                   # Tết Dương lịch
+    '2025-01-27', '2025-01-28', '2025-01-29', '2025-01-30', '2025-01-31',  # Tết Nguyên đán
+    '2025-04-07',                                                   # Giỗ Tổ Hùng Vương
+    '2025-04-30', '2025-05-01', '2025-05-02',                       # 30/4 - 1/5
+    '2025-09-01', '2025-09-02',                                     # Quốc khánh
+    # 2026
+    '2026-01-01',                                                   # Tết Dương lịch
+    '2026-02-16', '2026-02-17', '2026-02-18', '2026-02-19', '2026-02-20',  # Tết Nguyên đán
+    '2026-04-27',                                                   # Giỗ Tổ Hùng Vương (nghỉ bù)
+    '2026-04-30', '2026-05-01',                                     # 30/4 - 1/5
+    '2026-09-01', '2026-09-02',                                     # Quốc khánh
+    # 2027 (theo Bộ luật Lao động, đối chiếu lại khi HOSE công bố lịch chính thức)
+    '2027-01-01',                                                   # Tết Dương lịch
+    '2027-02-04', '2027-02-05', '2027-02-08', '2027-02-09', '2027-02-10',  # Tết Nguyên đán
+    '2027-04-16',                                                   # Giỗ Tổ Hùng Vương
+    '2027-04-30', '2027-05-03',                                     # 30/4 - 1/5 (nghỉ bù thứ 7)
+    '2027-09-02', '2027-09-03',                                     # Quốc khánh
+}
+MARKET_HOLIDAYS_FILE = 'market_holidays.json'
+
+def load_market_holidays():
+    """Bổ sung ngày nghỉ giao dịch từ MARKET_HOLIDAYS_FILE (nếu có)"""
+    try:
+        if os.path.exists(MARKET_HOLIDAYS_FILE):
+            with open(MARKET_HOLIDAYS_FILE, 'r') as f:
+                extra_holidays = json.load(f)
+            MARKET_HOLIDAYS.update(str(day) for day in extra_holidays)
+            logger.info(f"📅 Đã nạp {len(extra_holidays)} ngày nghỉ từ {MARKET_HOLIDAYS_FILE}")
+    except Exception as e:
+        logger.warning(f"⚠️ Không thể đọc {MARKET_HOLIDAYS_FILE}: {e}")
     
-    return is_weekday and is_time_ok
+    # Năm chưa có lịch nghỉ: ngày lễ sẽ bị coi là ngày giao dịch
+    last_year = max(int(day[:4]) for day in MARKET_HOLIDAYS)
+    if datetime.now(VN_TZ).year > last_year:
+        logger.warning(f"⚠️ Lịch nghỉ giao dịch chỉ có đến năm {last_year}: cập nhật MARKET_HOLIDAYS hoặc {MARKET_HOLIDAYS_FILE}")
+
+# Snapshot phiên giao dịch của chu kỳ hiện tại
+_market_session = None
+
+def is_trading_day(day):
+    """Kiểm tra 1 ngày có phải ngày giao dịch không (thứ 2-6, không phải ngày nghỉ lễ)"""
+    if day.weekday() >= 5:  # 5=Saturday, 6=Sunday
+        return False
+    return day.strftime('%Y-%m-%d') not in MARKET_HOLIDAYS
+
+def next_trading_day(day):
+    """Ngày giao dịch gần nhất sau ngày day"""
+    day = day + timedelta(days=1)
+    while not is_trading_day(day):
+        day = day + timedelta(days=1)
+    return day
+
+def previous_trading_day(day):
+    """Ngày giao dịch gần nhất trước ngày day"""
+    day = day - timedelta(days=1)
+    while not is_trading_day(day):
+        day = day - timedelta(days=1)
+    return day
+
+class MarketSession:
+    """Trạng thái thị trường tại 1 thời điểm, tính 1 lần cho mỗi chu kỳ cập nhật
+
+    phase: phiên hiện tại (SESSION_*)
+    trading_date: ngày giao dịch hôm nay (None nếu hôm nay không giao dịch)
+    last_trading_day: ngày giao dịch gần nhất đã kết thúc phiên (có giá đóng cửa)
+    """
+
+    def __init__(self, now):
+        self.now = now
+        self.today = now.strftime('%Y-%m-%d')
+        today_date = now.date()
+        
+        if is_trading_day(today_date):
+            self.trading_date = today_date
+            self.phase = SESSION_PRE_OPEN
+            for start_time, phase in SESSION_SCHEDULE:
+                if now.time() >= start_time:
+                    self.phase = phase
+        else:
+            self.trading_date = None
+            self.phase = SESSION_CLOSED
+        
+        if self.trading_date is not None and self.phase == SESSION_CLOSED:
+            self.last_trading_day = today_date
+        else:
+            self.last_trading_day = previous_trading_day(today_date)
+
+    @property
+    def is_open(self):
+        """Thị trường đang trong giờ giao dịch (ATO đến ATC, kể cả nghỉ trưa)"""
+        return self.phase not in (SESSION_PRE_OPEN, SESSION_CLOSED)
+
+    @property
+    def is_trading(self):
+        """Đang có khớp lệnh (ATO, liên tục, ATC), giá có thể thay đổi từng phút"""
+        return self.phase in (SESSION_ATO, SESSION_CONTINUOUS, SESSION_ATC)
+
+    @property
+    def phase_name(self):
+        return SESSION_NAMES[self.phase]
+
+    def next_phase_start(self):
+        """Thời điểm bắt đầu phiên kế tiếp (giờ Việt Nam)"""
+        if self.trading_date is not None:
+            for start_time, phase in SESSION_SCHEDULE:
+                if self.now.time() < start_time:
+                    return VN_TZ.localize(datetime.combine(self.trading_date, start_time))
+        next_day = next_trading_day(self.now.date())
+        return VN_TZ.localize(datetime.combine(next_day, SESSION_SCHEDULE[0][0]))
+
+def get_market_session(now=None):
+    """Tính trạng thái thị trường tại thời điểm now (mặc định: bây giờ, giờ Việt Nam)"""
+    if now is None:
+        now = datetime.now(VN_TZ)
+    return MarketSession(now)
+
+def refresh_market_session():
+    """Tính lại snapshot phiên giao dịch cho chu kỳ mới"""
+    global _market_session
+    _market_session = get_market_session()
+    return _market_session
+
+def current_market_session():
+    """Snapshot phiên giao dịch của chu kỳ hiện tại (tính mới nếu chưa có)"""
+    if _market_session is None:
+        return refresh_market_session()
+    return _market_session
+
+def is_market_open():
+    """Kiểm tra xem thị trường chứng khoán Việt Nam có đang mở cửa không (theo snapshot của chu kỳ)"""
+    return current_market_session().is_open
+
+# ====== 1.1. BẢN GHI GIÁ VÀ ĐỘ MỚI CỦA DỮ LIỆU ======
+# Trạng thái của giá (Quote.status, PriceBatch.status)
+STATUS_OK = 0
+STATUS_MISSING = 1       # Nguồn không có dữ liệu
+STATUS_ERROR = 2         # Lấy giá bị lỗi/exception
+STATUS_OUT_OF_BAND = 3   # Giá lệch quá PRICE_BAND so với giá tham chiếu (chỉ có trong PriceBatch)
+STATUS_STALE = 4         # Giá hợp lệ gần nhất, dùng lại khi tất cả method đều lỗi
+
+# Nguồn giá: Quote.source là chỉ số trong SOURCE_NAMES
+SOURCE_NAMES = (
+    'price_board', 'realtime', 'alternative', 'force', 'webscrape',
+    'closing', 'method1', 'method2', 'method3', 'fetch', 'store',
+)
+SOURCE_IDS = {name: idx for idx, name in enumerate(SOURCE_NAMES)}
+
+class Quote:
+    """Giá của 1 mã từ 1 nguồn, kết quả của mọi hàm lấy giá
+
+    price: float (NaN nếu không có), timestamp: epoch thời điểm giao dịch theo
+    sàn (NaN nếu nguồn không có), source: SOURCE_IDS, status: STATUS_*,
+    volume: khối lượng (NaN nếu không có), session: phiên lúc lấy giá (SESSION_*),
+    detail: thông báo khi không có giá. Chuỗi hiển thị chỉ tạo khi ghi log (label).
+    """
+    __slots__ = ('price', 'timestamp', 'source', 'status', 'volume', 'session', 'detail')
+
+    def __init__(self, price, source, status=STATUS_OK, timestamp=np.nan, volume=np.nan, session=None, detail=None):
+        self.price = price
+        self.timestamp = timestamp
+        self.source = source
+        self.status = status
+        self.volume = volume
+        self.session = session
+        self.detail = detail
+
+    @property
+    def has_price(self):
+        return self.status == STATUS_OK or self.status == STATUS_STALE
+
+    def trading_date(self):
+        """Ngày giao dịch (giờ VN) theo timestamp, None nếu không có"""
+        if self.timestamp != self.timestamp:
+            return None
+        return datetime.fromtimestamp(self.timestamp, VN_TZ).date()
+
+    def as_stale(self):
+        """Bản sao đánh dấu là giá cũ (dùng lại giá hợp lệ gần nhất)"""
+        return Quote(self.price, self.source, STATUS_STALE, self.timestamp, self.volume, self.session)
+
+    def label(self):
+        """Chuỗi mô tả nguồn/thời điểm của giá để ghi log"""
+        text = SOURCE_NAMES[self.source]
+        if not self.has_price:
+            return f"{text}: {self.detail}"
+        if self.timestamp == self.timestamp:
+            text += f" ({datetime.fromtimestamp(self.timestamp, VN_TZ):%Y-%m-%d %H:%M})"
+        if self.status == STATUS_STALE:
+            text = f"cũ - {text}"
+        return text
+
+    def __repr__(self):
+        return f"Quote({self.price}, {self.label()})"
+
+def _as_float(value):
+    """Giá trị số từ dữ liệu nguồn -> float, NaN nếu không đọc được"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _exchange_time(value):
+    """Thời điểm giao dịch từ dữ liệu nguồn (Timestamp, datetime64, date, chuỗi) -> datetime giờ VN
+
+    Chỉ có ngày (cột time của nến ngày là datetime.date) thì lấy 0h ngày đó.
+    Trả về None nếu không đọc được, kể cả khi chỉ có giờ mà không có ngày
+    (cột time của intraday).
+    """
+    if value is None or value != value:  # None, NaN, NaT
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):  # epoch (giây hoặc mili giây)
+        value = float(value)
+        if value > 1e11:
+            value /= 1000
+        return datetime.fromtimestamp(value, VN_TZ) if value > 1e9 else None
+    if isinstance(value, np.datetime64):
+        value = str(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip()[:19])
+        except ValueError:
+            return None
+    if hasattr(value, 'to_pydatetime'):
+        value = value.to_pydatetime()
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        return VN_TZ.localize(value)
+    return value.astimezone(VN_TZ)
+
+# Key chứa thời điểm giao dịch trong quote của vnstock / JSON của các trang web
+QUOTE_TIME_KEYS = ('time', 'tradingDate', 'date', 'lastUpdated', 'updatedAt', 'timestamp')
+
+def _quote_dict_time(quote_dict):
+    """Thời điểm giao dịch trong dict quote (key đầu tiên đọc được), None nếu không có"""
+    for key in QUOTE_TIME_KEYS:
+        value = quote_dict.get(key)
+        if _exchange_time(value) is not None:
+            return value
+    return None
+
+def make_quote(price, source, timestamp=None, volume=None):
+    """Quote từ dữ liệu thô của nguồn; giá không đọc được hoặc <= 0 là STATUS_MISSING"""
+    session = current_market_session().phase
+    price = _as_float(price)
+    if not price > 0:  # NaN, 0, giá âm
+        return Quote(np.nan, SOURCE_IDS[source], STATUS_MISSING, session=session, detail="giá không hợp lệ")
+    exchange_time = _exchange_time(timestamp)
+    return Quote(
+        price, SOURCE_IDS[source], STATUS_OK,
+        np.nan if exchange_time is None else exchange_time.timestamp(),
+        _as_float(volume), session
+    )
+
+def missing_quote(source, detail):
+    """Quote khi nguồn không có dữ liệu"""
+    return Quote(np.nan, SOURCE_IDS[source], STATUS_MISSING, session=current_market_session().phase, detail=detail)
+
+def error_quote(source, detail):
+    """Quote khi lấy giá bị lỗi"""
+    return Quote(np.nan, SOURCE_IDS[source], STATUS_ERROR, session=current_market_session().phase, detail=detail)
+
+def is_quote_fresh(quote, session=None):
+    """Chính sách độ mới: giá có thuộc ngày giao dịch mà phiên hiện tại cần không
+
+    Thị trường mở: cần dữ liệu của hôm nay, riêng phiên ATO (chưa khớp lệnh)
+    chấp nhận giá của ngày giao dịch trước. Thị trường đóng: cần giá của ngày
+    giao dịch gần nhất. Giá không có thời điểm giao dịch (không biết độ mới)
+    chỉ được coi là mới khi thị trường đang mở; ngoài giờ chuỗi giá đóng cửa
+    tiếp tục tìm giá có ngày giao dịch.
+    """
+    if session is None:
+        session = current_market_session()
+    trading_date = quote.trading_date()
+    if trading_date is None:
+        return session.is_open
+    if session.is_open and session.phase != SESSION_ATO:
+        required_date = session.trading_date
+    else:
+        required_date = session.last_trading_day
+    return trading_date >= required_date
+
+# ====== 1.2. NẾN NGÀY DÙNG CHUNG TRONG CHU KỲ ======
+def _fetch_historical_bars(ticker_clean, start_date, end_date):
+    historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=start_date, end_date=end_date)
+    if historical_data is None:
+        raise TimeoutError("Historical API call timeout")
+    return historical_data
+
+def _fetch_quote_bars(ticker_clean, start_date, end_date):
+    stock_data = _history_loader.stock(ticker_clean)
+    if stock_data is None:
+        raise TimeoutError("API call timeout")
+    return stock_data.quote.data_source.history(start_date)
+
+# Nguồn nến ngày: stock_historical_data và data_source.history của Vnstock class
+HISTORY_SOURCES = {
+    'historical': _fetch_historical_bars,
+    'quote': _fetch_quote_bars,
+}
+
+class HistoryLoader:
+    """Nến ngày HISTORY_WINDOW_DAYS ngày gần nhất của từng mã, tải 1 lần mỗi chu kỳ
+
+    Mọi method cần lịch sử giá (realtime, force, method1/2) dùng chung 1 frame
+    cho mỗi (nguồn, mã) thay vì tự tải các cửa sổ chồng lên nhau: giá gần
+    nhất, nến hôm nay, giá đóng cửa phiên trước đều lấy từ frame này. Đối
+    tượng stock của Vnstock class (quote và nguồn 'quote') cũng chỉ tạo 1 lần.
+    Lần tải lỗi cũng được ghi nhớ đến hết chu kỳ.
+    """
+
+    def __init__(self, window_days):
+        self.window_days = window_days
+        self._frames = {}      # (nguồn, mã) -> DataFrame | None; ('stock', mã) -> đối tượng stock | None
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._start_date = None
+        self._end_date = None
+        self._undated_sources = set()
+        self.downloads = 0
+
+    def reset(self, session):
+        """Bỏ frame của chu kỳ trước, đặt cửa sổ theo phiên của chu kỳ mới"""
+        with self._lock:
+            self._frames.clear()
+            self._key_locks.clear()
+            self._start_date = (session.now - timedelta(days=self.window_days)).strftime('%Y-%m-%d')
+            self._end_date = session.today
+            self.downloads = 0
+
+    def bars(self, ticker_clean, source='historical', load=True):
+        """Frame nến của mã (None nếu không có); load=False chỉ dùng frame đã tải trong chu kỳ"""
+        key = (source, ticker_clean)
+        with self._lock:
+            if key in self._frames or not load:
+                return self._frames.get(key)
+            if self._start_date is None:
+                session = current_market_session()
+                self._start_date = (session.now - timedelta(days=self.window_days)).strftime('%Y-%m-%d')
+                self._end_date = session.today
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            start_date, end_date = self._start_date, self._end_date
+        
+        def load_frame():
+            frame = HISTORY_SOURCES[source](ticker_clean, start_date, end_date)
+            if frame is None or len(frame) == 0:
+                return None
+            self._check_dated(source, frame)
+            return frame
+        return self._load_once(key, key_lock, load_frame)
+
+    def stock(self, ticker_clean):
+        """Đối tượng stock (Vnstock class) của mã, None nếu không tạo được"""
+        key = ('stock', ticker_clean)
+        with self._lock:
+            if key in self._frames:
+                return self._frames[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        return self._load_once(
+            key, key_lock,
+            lambda: safe_vnstock_call(_client_registry.vnstock_client().stock, symbol=ticker_clean),
+        )
+
+    def _check_dated(self, source, frame):
+        # Cột time không đọc được thì mọi giá từ nguồn này thành "không rõ ngày" (coi là mới khi thị trường mở)
+        if source in self._undated_sources or 'time' not in frame:
+            return
+        if _exchange_time(frame['time'].iloc[-1]) is None:
+            self._undated_sources.add(source)
+            logger.warning(f"⚠️ Không đọc được ngày giao dịch từ cột time của nguồn '{source}' ({type(frame['time'].iloc[-1]).__name__})")
+
+    def _load_once(self, key, key_lock, loader):
+        # Các luồng cùng cần 1 mã (vd hedge) chờ lần tải đầu tiên thay vì tải lại
+        with key_lock:
+            with self._lock:
+                if key in self._frames:
+                    return self._frames[key]
+            try:
+                value = loader()
+            except Exception:
+                value = None
+            with self._lock:
+                self._frames[key] = value
+                self.downloads += 1
+            return value
+
+    def last_bar(self, ticker_clean, source='historical'):
+        """Nến gần nhất (giá gần nhất / giá đóng cửa gần nhất)"""
+        frame = self.bars(ticker_clean, source)
+        return None if frame is None else frame.iloc[-1]
+
+    def today_bar(self, ticker_clean, source='historical'):
+        """Nến của hôm nay, None nếu hôm nay chưa có nến"""
+        latest_data = self.last_bar(ticker_clean, source)
+        if latest_data is not None and self.is_today(latest_data):
+            return latest_data
+        return None
+
+    @staticmethod
+    def is_today(bar):
+        return str(bar.get('time', '')).startswith(current_market_session().today)
+
+    def previous_close(self, ticker_clean, source='historical', load=True):
+        """Giá đóng cửa của phiên trước hôm nay, None nếu không có"""
+        frame = self.bars(ticker_clean, source, load=load)
+        if frame is None:
+            return None
+        for idx in range(len(frame) - 1, -1, -1):
+            bar = frame.iloc[idx]
+            if not self.is_today(bar):
+                return bar.get('close')
+        return None
+
+_history_loader = HistoryLoader(HISTORY_WINDOW_DAYS)
+
+# ====== 1.3. LỆNH KHỚP TRONG PHIÊN (INTRADAY) ======
+class IntradayBuffer:
+    """Ring buffer các lệnh khớp trong phiên của 1 mã (timestamp, giá, khối lượng)
+
+    Chỉ giữ capacity lệnh gần nhất; tổng khối lượng, giá trị (cho VWAP) và
+    giá cao/thấp được cộng dồn khi thêm lệnh. Các số này chỉ là số của cả
+    phiên khi complete: buffer đã có lệnh từ đầu phiên và không bị hụt lệnh
+    nào giữa các lần cập nhật.
+    """
+    __slots__ = ('trading_date', 'timestamp', 'price', 'volume', 'end', 'count',
+                 'last_key', 'total_volume', 'notional', 'high', 'low', 'complete')
+
+    def __init__(self, capacity, trading_date):
+        self.trading_date = trading_date
+        self.timestamp = np.full(capacity, np.nan)
+        self.price = np.full(capacity, np.nan)
+        self.volume = np.zeros(capacity)
+        self.end = 0           # Vị trí ghi tiếp theo
+        self.count = 0
+        self.last_key = None   # Lệnh mới nhất đã có (time, volume, price, loại lệnh)
+        self.total_volume = 0.0
+        self.notional = 0.0
+        self.high = np.nan
+        self.low = np.nan
+        self.complete = False
+
+    def append(self, timestamps, prices, volumes):
+        """Thêm các lệnh (theo thứ tự thời gian tăng dần)"""
+        if not len(prices):
+            return
+        self.total_volume += float(volumes.sum())
+        self.notional += float((prices * volumes).sum())
+        self.high = float(np.fmax(self.high, prices.max()))
+        self.low = float(np.fmin(self.low, prices.min()))
+        
+        capacity = len(self.price)
+        kept = min(len(prices), capacity)
+        idx = (self.end + np.arange(kept)) % capacity
+        self.timestamp[idx] = timestamps[-kept:]
+        self.price[idx] = prices[-kept:]
+        self.volume[idx] = volumes[-kept:]
+        self.end = (self.end + kept) % capacity
+        self.count = min(self.count + kept, capacity)
+
+    @property
+    def last_price(self):
+        return self.price[self.end - 1] if self.count else np.nan
+
+    @property
+    def last_timestamp(self):
+        return self.timestamp[self.end - 1] if self.count else np.nan
+
+    @property
+    def vwap(self):
+        return self.notional / self.total_volume if self.total_volume > 0 else np.nan
+
+    def stat(self, field):
+        """Giá trị thống kê của phiên: 'vwap', 'high', 'low', 'volume'"""
+        if field == 'volume':
+            return self.total_volume
+        return getattr(self, field)
+
+class IntradayStore:
+    """Lệnh khớp trong phiên của từng mã, nạp dần từ stock_intraday_data
+
+    Trang 0 của TCBS là các lệnh mới nhất; mỗi lần cập nhật chỉ đọc các trang
+    mới cho đến lệnh mới nhất đã có (TCBS không trả số thứ tự lệnh nên dùng
+    bộ (time, volume, giá, loại lệnh) làm mốc). Mỗi mã chỉ cập nhật 1 lần mỗi
+    chu kỳ; giá gần nhất, VWAP, cao/thấp và khối lượng lấy từ dữ liệu đã có.
+
+    Lần nạp đầu (kể cả sau khi khởi động lại) và khi không thấy mốc trong
+    max_pages trang, đọc tiếp đến đầu phiên trong giới hạn backfill_pages
+    trang; bị dừng giữa chừng thì chu kỳ sau đọc tiếp. Quá backfill_pages
+    trang thì buffer không complete (số liệu phiên thiếu).
+    """
+
+    def __init__(self, capacity, page_size, max_pages, backfill_pages=None):
+        self.capacity = capacity
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.backfill_pages = max(backfill_pages or max_pages, max_pages)
+        self._buffers = {}        # mã -> IntradayBuffer
+        self._updated_cycle = {}  # mã -> chu kỳ cập nhật gần nhất
+        self._backfills = {}      # mã -> (ngày, buffer gốc, các trang đã đọc) của lần nạp về đầu phiên bị dừng giữa chừng
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._cycle = 0
+        self._trading_date = None
+        self.requests = 0
+
+    def begin_cycle(self, session):
+        with self._lock:
+            self._cycle += 1
+            self._trading_date = self._session_date(session)
+            self.requests = 0
+
+    @staticmethod
+    def _session_date(session):
+        """Ngày của phiên mà dữ liệu intraday đang thuộc về (trước giờ mở cửa: phiên trước)"""
+        return session.trading_date if session.is_open else session.last_trading_day
+
+    def _current_date(self):
+        return self._trading_date or self._session_date(current_market_session())
+
+    def buffer(self, ticker_clean):
+        """Buffer của phiên hiện tại, None nếu chưa có lệnh nào"""
+        buffer = self._buffers.get(ticker_clean)
+        if buffer is None or buffer.trading_date != self._current_date() or not buffer.count:
+            return None
+        return buffer
+
+    def _fetch_page(self, ticker_clean, page):
+        """1 trang lệnh khớp, None nếu trang không có lệnh nào"""
+        try:
+            frame = safe_vnstock_call(vnstock.stock_intraday_data, symbol=ticker_clean, page_size=self.page_size, page=page)
+        except KeyError as e:
+            # vnstock 0.2.0 drop cột cp/rcp/pcp của trang rỗng nên raise KeyError thay vì trả frame rỗng
+            if 'not found in axis' not in str(e):
+                raise
+            return None
+        finally:
+            with self._lock:
+                self.requests += 1
+        if frame is None:
+            raise TimeoutError("Intraday API call timeout")
+        return frame if len(frame) else None
+
+    def _new_trades(self, ticker_clean, last_key, page_limit, first_page=0, after_key=None):
+        """Các trang lệnh mới hơn last_key, ghép theo thứ tự mới nhất trước
+
+        Đọc từ trang first_page; nếu có after_key thì bỏ các lệnh từ after_key
+        trở về trước ở trang đầu tiên (nối tiếp phần đã đọc). Trả về (frames,
+        đã đọc đến đâu, trang tiếp theo): 'mark' nếu gặp last_key, 'open' nếu
+        đã đến lệnh đầu phiên, None nếu hết page_limit trang hoặc bị lỗi/hết
+        hạn chót giữa chừng (các trang đã đọc vẫn được trả về). Lỗi ngay ở
+        trang đầu tiên thì raise; LookupError nếu trang đầu không có after_key.
+        """
+        frames = []
+        for page in range(first_page, page_limit):
+            try:
+                frame = self._fetch_page(ticker_clean, page)
+            except Exception as e:
+                if not frames:
+                    raise
+                logger.debug(f"⚠️ {ticker_clean}: dừng đọc intraday ở trang {page}: {e}")
+                return frames, None, page
+            if frame is None:
+                if page == first_page and after_key is not None:
+                    raise LookupError("Không thấy lệnh đã đọc ở trang tiếp theo")
+                return frames, 'open', page + 1
+            keys = [_trade_key(row) for row in frame.itertuples(index=False)]
+            full_page = len(frame) == self.page_size
+            if page == first_page and after_key is not None:
+                if after_key not in keys:
+                    raise LookupError("Không thấy lệnh đã đọc ở trang tiếp theo")
+                skip = keys.index(after_key) + 1
+                frame, keys = frame.iloc[skip:], keys[skip:]
+            if last_key in keys:
+                frames.append(frame.iloc[:keys.index(last_key)])
+                return frames, 'mark', page + 1
+            frames.append(frame)
+            if not full_page:
+                return frames, 'open', page + 1
+            if page + 1 == self.max_pages and last_key is not None:
+                logger.debug(f"🔎 {ticker_clean}: không thấy mốc intraday trong {self.max_pages} trang, đọc tiếp về đầu phiên")
+        return frames, None, page_limit
+
+    def _resume_backfill(self, ticker_clean, base, frames):
+        """Đọc tiếp lần nạp dở ở chu kỳ trước: các lệnh mới, rồi các trang cũ hơn phần đã đọc
+
+        Trả về như _new_trades, frames gồm cả phần đã đọc. Không nối được các
+        lệnh mới với phần đã đọc thì bỏ phần đã đọc, nạp lại từ các lệnh mới.
+        """
+        newest = _trade_key(next(frames[0].itertuples(index=False)))
+        oldest = _trade_key(list(frames[-1].itertuples(index=False))[-1])
+        top, reached, next_page = self._new_trades(ticker_clean, newest, self.max_pages)
+        if reached != 'mark':
+            return top, reached, next_page
+        frames = top + frames
+        # Trang chứa lệnh cũ nhất đã đọc (các trang bị đẩy lùi bởi lệnh mới)
+        page = (sum(len(frame) for frame in frames) - 1) // self.page_size
+        try:
+            older, reached, next_page = self._new_trades(
+                ticker_clean, base.last_key, self.backfill_pages, first_page=page, after_key=oldest,
+            )
+        except LookupError:
+            logger.debug(f"🔎 {ticker_clean}: mất mốc khi nạp tiếp intraday, nạp lại từ đầu phiên")
+            return top, None, 0
+        return frames + older, reached, next_page
+
+    def update(self, ticker_clean):
+        """Nạp các lệnh mới của mã (tối đa 1 lần mỗi chu kỳ), trả về buffer hoặc None
+
+        Lần nạp về đầu phiên bị dừng giữa chừng (hạn chót chu kỳ, lỗi API)
+        giữ các trang đã đọc: buffer tạm có các lệnh mới nhất (không
+        complete) và chu kỳ sau đọc tiếp từ chỗ đã dừng.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(ticker_clean, threading.Lock())
+        with key_lock:
+            if self._updated_cycle.get(ticker_clean) == self._cycle:
+                return self.buffer(ticker_clean)
+            trading_date = self._current_date()
+            buffer = self._buffers.get(ticker_clean)
+            if buffer is None or buffer.trading_date != trading_date:
+                buffer = IntradayBuffer(self.capacity, trading_date)
+            backfill = self._backfills.pop(ticker_clean, None)
+            if backfill is not None and backfill[0] != trading_date:
+                backfill = None
+            
+            try:
+                if backfill is None:
+                    base = buffer
+                    frames, reached, next_page = self._new_trades(ticker_clean, buffer.last_key, self.backfill_pages)
+                else:
+                    _, base, previous = backfill
+                    frames, reached, next_page = self._resume_backfill(ticker_clean, base, previous)
+            except Exception:
+                if backfill is not None:
+                    self._backfills[ticker_clean] = backfill
+                return self.buffer(ticker_clean)
+            frames = [frame for frame in frames if len(frame)]
+            if reached == 'open':
+                # Đã có mọi lệnh từ đầu phiên (lần nạp đầu hoặc mốc cũ không còn): dựng lại buffer
+                buffer = IntradayBuffer(self.capacity, trading_date)
+                buffer.complete = True
+            elif reached == 'mark':
+                buffer = base
+            elif next_page < self.backfill_pages and frames:
+                # Dừng giữa chừng: giữ phần đã đọc, tạm dùng các lệnh mới nhất
+                self._backfills[ticker_clean] = (trading_date, base, frames)
+                buffer = IntradayBuffer(self.capacity, trading_date)
+            else:
+                buffer = base
+                buffer.complete = False
+            rows = [row for frame in frames for row in frame.itertuples(index=False)]
+            if rows:
+                buffer.last_key = _trade_key(rows[0])
+                rows.reverse()
+                day_start = VN_TZ.localize(datetime.combine(trading_date, time())).timestamp()
+                buffer.append(
+                    np.array([day_start + _seconds_of_day(row.time) for row in rows], dtype=float),
+                    np.array([_as_float(row.averagePrice) for row in rows], dtype=float),
+                    np.array([_as_float(row.volume) for row in rows], dtype=float),
+                )
+            self._buffers[ticker_clean] = buffer
+            self._updated_cycle[ticker_clean] = self._cycle
+            return self.buffer(ticker_clean)
+
+def _trade_key(row):
+    """Mốc của 1 lệnh khớp: (time, volume, giá, loại lệnh)"""
+    return (row.time, row.volume, row.averagePrice, row.orderType)
+
+def _seconds_of_day(value):
+    """'HH:MM:SS' -> số giây từ 0 giờ, NaN nếu không đọc được"""
+    try:
+        hours, minutes, seconds = str(value).split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return np.nan
+
+def intraday_quote(ticker_clean, source):
+    """Quote từ lệnh khớp gần nhất trong phiên (nạp trang mới nếu cần), None nếu không có"""
+    buffer = _intraday_store.update(ticker_clean)
+    if buffer is None:
+        return None
+    return make_quote(buffer.last_price, source, buffer.last_timestamp, buffer.total_volume)
+
+_intraday_store = IntradayStore(
+    INTRADAY_CAPACITY, INTRADAY_PAGE_SIZE, INTRADAY_MAX_PAGES,
+    INTRADAY_BACKFILL_PAGES if INTRADAY_COLUMNS else INTRADAY_MAX_PAGES,
+)
+
+def refresh_intraday(tickers, session):
+    """Nạp thêm các trang lệnh mới cho các mã chưa được cập nhật trong chu kỳ này
+
+    Chỉ chạy trong giờ giao dịch (song song, trong hạn chót của chu kỳ); ngoài
+    giờ chỉ dùng dữ liệu đã có.
+    """
+    if session.is_open and tickers:
+        executor = _get_fetch_executor()
+        futures = [executor.submit(_intraday_store.update, ticker_clean) for ticker_clean in tickers]
+        _, not_done = wait(futures, timeout=max(remaining_cycle_time(), 0))
+        for future in not_done:
+            future.cancel()
+
+def intraday_columns(ticker_index, column_fields=None):
+    """Giá trị các cột intraday (mặc định INTRADAY_COLUMN_FIELDS) theo dòng: {cột: {dòng: giá trị}}
+
+    Mã chưa có đủ lệnh của cả phiên (buffer không complete) được để trống.
+    """
+    buffers = {ticker_clean: _intraday_store.buffer(ticker_clean) for ticker_clean in ticker_index.tickers}
+    partial = [ticker_clean for ticker_clean, buffer in buffers.items() if buffer is not None and not buffer.complete]
+    if partial:
+        logger.debug(f"⚠️ {len(partial)} mã chưa có đủ lệnh khớp của phiên, để trống VWAP/cao/thấp/khối lượng: {', '.join(partial[:10])}")
+    buffers = {ticker_clean: buffer for ticker_clean, buffer in buffers.items() if buffer is not None and buffer.complete}
+    columns = {}
+    for column, field in (column_fields or INTRADAY_COLUMN_FIELDS).items():
+        values = {}
+        for ticker_clean, buffer in buffers.items():
+            value = buffer.stat(field)
+            if field != 'volume':
+                value = _normalize_units(value)
+            if value == value:
+                values[ticker_clean] = round(float(value), 2)
+        columns[column] = ticker_index.spread(values)
+    return columns
 
 # ====== 2. LẤY GIÁ REALTIME ======
 def get_realtime_price(ticker_clean):
     """Lấy giá realtime của mã cổ phiếu"""
-    import time
-    
     try:
         # Kiểm tra kết nối mạng trước
         if not check_network_connection():
-            return "Lỗi", "Không có kết nối mạng"
-        
-        # Thêm delay để tránh bị block
-        time.sleep(0.1)  # Tăng delay cho GitHub Actions để tránh rate limit
+            return error_quote('realtime', "Không có kết nối mạng")
         
         # Sử dụng stock method với timeout
         try:
-            # Thử sử dụng Vnstock class trước với timeout
-            vs = vnstock.Vnstock()
-            stock_data = safe_vnstock_call(vs.stock, symbol=ticker_clean)
+            # Thử sử dụng Vnstock class trước (dùng chung với nguồn 'quote' của HistoryLoader)
+            stock_data = _history_loader.stock(ticker_clean)
             
             # Kiểm tra nếu API call bị timeout
             if stock_data is None:
@@ -222,126 +1667,28 @@ def get_realtime_price(ticker_clean):
                 quote_dict = vars(quote_data)
             except Exception as quote_error:
                 # Fallback cuối cùng: sử dụng historical data
-                from datetime import datetime, timedelta
-                vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-                now_vn = datetime.now(vn_tz)
-                start_date = (now_vn - timedelta(days=7)).strftime('%Y-%m-%d')
-                end_date = now_vn.strftime('%Y-%m-%d')
-                
                 try:
-                    # Sử dụng API mới của vnstock
-                    historical_data = safe_vnstock_call(vnstock.stock_intraday_data, symbol=ticker_clean, page_size=1)
-                    
-                    # Kiểm tra nếu API call bị timeout
-                    if historical_data is None:
-                        raise TimeoutError("Intraday API call timeout")
-                        
-                    if historical_data is not None and len(historical_data) > 0:
-                        latest_data = historical_data.iloc[-1]
-                        price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
-                        if isinstance(price, (np.integer, np.floating)):
-                            price = float(price)
-                        return price, f"intraday ({latest_data.get('time', 'N/A')})"
+                    # Lệnh khớp gần nhất trong phiên (chỉ tải các trang lệnh mới)
+                    quote = intraday_quote(ticker_clean, 'realtime')
+                    if quote is not None:
+                        return quote
                     else:
-                        # Thử với API khác
-                        try:
-                            historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=start_date, end_date=end_date)
-                            
-                            # Kiểm tra nếu API call bị timeout
-                            if historical_data is None:
-                                raise TimeoutError("Historical API call timeout")
-                                
-                            if historical_data is not None and len(historical_data) > 0:
-                                latest_data = historical_data.iloc[-1]
-                                price = latest_data.get('close', 'N/A')
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, f"historical ({latest_data.get('time', 'N/A')})"
-                        except AttributeError:
-                            # Thử với API cũ
-                            try:
-                                historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=start_date, end_date=end_date)
-                                
-                                # Kiểm tra nếu API call bị timeout
-                                if historical_data is None:
-                                    raise TimeoutError("Historical API call timeout")
-                                    
-                                if historical_data is not None and len(historical_data) > 0:
-                                    latest_data = historical_data.iloc[-1]
-                                    price = latest_data.get('close', 'N/A')
-                                    if isinstance(price, (np.integer, np.floating)):
-                                        price = float(price)
-                                    return price, f"historical ({latest_data.get('time', 'N/A')})"
-                            except:
-                                pass
-                        
-                        return "N/A", "không có dữ liệu lịch sử"
+                        # Nến gần nhất trong frame lịch sử dùng chung của chu kỳ
+                        latest_data = _history_loader.last_bar(ticker_clean)
+                        if latest_data is not None:
+                            return make_quote(latest_data.get('close', 'N/A'), 'realtime', latest_data.get('time'), latest_data.get('volume'))
+                        return missing_quote('realtime', "không có dữ liệu lịch sử")
                 except Exception as hist_error:
-                    return "Lỗi", f"Lỗi historical: {hist_error}"
+                    return error_quote('realtime', f"Lỗi historical: {hist_error}")
         
-        # Thử truy cập trực tiếp vào data_source để lấy dữ liệu gần nhất
-        try:
-            if hasattr(stock_data.quote, 'data_source') and stock_data.quote.data_source is not None:
-                # Lấy dữ liệu gần nhất (có thể là realtime)
-                from datetime import datetime, timedelta
-                vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-                now_vn = datetime.now(vn_tz)
-                start_date = (now_vn - timedelta(days=1)).strftime('%Y-%m-%d')
-                historical_data = stock_data.quote.data_source.history(start_date)
-                
-                if historical_data is not None and len(historical_data) > 0:
-                    latest_data = historical_data.iloc[-1]
-                    
-                    # Kiểm tra xem dữ liệu có phải là hôm nay không
-                    trading_date = latest_data.get('time', '')
-                    today = now_vn.strftime('%Y-%m-%d')
-                    
-                    # Kiểm tra thời gian hiện tại để xác định loại dữ liệu
-                    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-                    now = datetime.now(vn_tz)
-                    current_time = now.time()
-                    
-                    # Kiểm tra xem có phải ngày hôm nay không (chỉ so sánh phần ngày)
-                    trading_date_only = str(trading_date).split(' ')[0] if trading_date else ''
-                    
-                    # Kiểm tra xem có phải ngày hôm nay không
-                    if trading_date_only == today:
-                        # Kiểm tra thị trường có đang mở không
-                        if 9 <= current_time.hour < 15:
-                            if 'lastPrice' in latest_data and latest_data['lastPrice'] is not None:
-                                price = latest_data['lastPrice']
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, "realtime (today lastPrice - market open)"
-                            elif 'close' in latest_data and latest_data['close'] is not None:
-                                price = latest_data['close']
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, "realtime (today close - market open)"
-                        else:
-                            if 'lastPrice' in latest_data and latest_data['lastPrice'] is not None:
-                                price = latest_data['lastPrice']
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, "realtime (today close - market closed)"
-                            elif 'close' in latest_data and latest_data['close'] is not None:
-                                price = latest_data['close']
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, "realtime (today close - market closed)"
-                    else:
-                        if 'lastPrice' in latest_data and latest_data['lastPrice'] is not None:
-                            price = latest_data['lastPrice']
-                            if isinstance(price, (np.integer, np.floating)):
-                                price = float(price)
-                            return price, "realtime (latest lastPrice)"
-                        elif 'close' in latest_data and latest_data['close'] is not None:
-                            price = latest_data['close']
-                            if isinstance(price, (np.integer, np.floating)):
-                                price = float(price)
-                            return price, "realtime (latest close)"
-        except Exception as hist_error:
-            pass
+        # Dữ liệu gần nhất từ data_source (có thể là realtime), tải 1 lần/chu kỳ qua HistoryLoader
+        latest_data = _history_loader.last_bar(ticker_clean, 'quote')
+        if latest_data is not None:
+            price = latest_data.get('lastPrice')
+            if price is None:
+                price = latest_data.get('close')
+            if price is not None:
+                return make_quote(price, 'realtime', latest_data.get('time'), latest_data.get('volume'))
         
         # Thử các key khác trong quote_dict
         price = None
@@ -354,26 +1701,19 @@ def get_realtime_price(ticker_clean):
                 break
         
         if price is not None:
-            if isinstance(price, (np.integer, np.floating)):
-                price = float(price)
-            return price, f"realtime ({price_source})"
+            return make_quote(price, 'realtime', _quote_dict_time(quote_dict), quote_dict.get('volume'))
         else:
-            return "N/A", "không có dữ liệu realtime"
+            return missing_quote('realtime', "không có dữ liệu realtime")
             
     except Exception as e:
-        return "Lỗi", f"Lỗi realtime: {e}"
+        return error_quote('realtime', f"Lỗi realtime: {e}")
 
 def get_realtime_price_alternative(ticker_clean):
     """Lấy giá realtime bằng các method khác khi method chính thất bại"""
-    import time
-    
     try:
         # Kiểm tra kết nối mạng trước
         if not check_network_connection():
-            return "Lỗi", "Không có kết nối mạng"
-        
-        # Thêm delay để tránh bị block
-        time.sleep(0.15)  # Tăng delay cho method thay thế
+            return error_quote('alternative', "Không có kết nối mạng")
         
         # Method 1: Thử sử dụng Quote API trực tiếp
         try:
@@ -388,40 +1728,21 @@ def get_realtime_price_alternative(ticker_clean):
             for key in ['lastPrice', 'close', 'price', 'currentPrice', 'last_price']:
                 if key in quote_dict and quote_dict[key] is not None:
                     price = quote_dict[key]
-                    if isinstance(price, (np.integer, np.floating)):
-                        price = float(price)
-                    return price, f"realtime_alt1 ({key})"
+                    return make_quote(price, 'alternative', _quote_dict_time(quote_dict), quote_dict.get('volume'))
         except Exception as e:
             pass
         
-        # Method 2: Thử sử dụng stock_intraday_data với page_size nhỏ
+        # Method 2: Lệnh khớp gần nhất từ dữ liệu intraday (IntradayStore)
         try:
-            historical_data = safe_vnstock_call(vnstock.stock_intraday_data, symbol=ticker_clean, page_size=1)
-            
-            if historical_data is not None and len(historical_data) > 0:
-                latest_data = historical_data.iloc[-1]
-                price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
-                trading_date = latest_data.get('time', 'N/A')
-                
-                if isinstance(price, (np.integer, np.floating)):
-                    price = float(price)
-                
-                # Kiểm tra xem có phải dữ liệu hôm nay không
-                vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-                now_vn = datetime.now(vn_tz)
-                today = now_vn.strftime('%Y-%m-%d')
-                
-                if str(trading_date).startswith(today):
-                    return price, f"realtime_alt2 (today intraday)"
-                else:
-                    return price, f"realtime_alt2 (latest intraday)"
+            quote = intraday_quote(ticker_clean, 'alternative')
+            if quote is not None:
+                return quote
         except Exception as e:
             pass
         
         # Method 3: Thử sử dụng Vnstock class với timeout dài hơn
         try:
-            vs = vnstock.Vnstock()
-            stock_data = safe_vnstock_call(vs.stock, symbol=ticker_clean)
+            stock_data = _history_loader.stock(ticker_clean)
             
             if stock_data is None:
                 raise TimeoutError("Vnstock API call timeout")
@@ -433,81 +1754,33 @@ def get_realtime_price_alternative(ticker_clean):
                 for key in ['lastPrice', 'close', 'price', 'currentPrice', 'last_price']:
                     if key in quote_dict and quote_dict[key] is not None:
                         price = quote_dict[key]
-                        if isinstance(price, (np.integer, np.floating)):
-                            price = float(price)
-                        return price, f"realtime_alt3 ({key})"
+                        return make_quote(price, 'alternative', _quote_dict_time(quote_dict), quote_dict.get('volume'))
         except Exception as e:
             pass
         
-        return "N/A", "không có dữ liệu realtime từ các method thay thế"
+        return missing_quote('alternative', "không có dữ liệu realtime từ các method thay thế")
         
     except Exception as e:
-        return "Lỗi", f"Lỗi realtime alternative: {e}"
+        return error_quote('alternative', f"Lỗi realtime alternative: {e}")
 
 def get_realtime_price_force(ticker_clean):
     """Lấy giá realtime bằng cách force lấy dữ liệu hôm nay"""
-    import time
-    
     try:
         # Kiểm tra kết nối mạng trước
         if not check_network_connection():
-            return "Lỗi", "Không có kết nối mạng"
-        
-        # Thêm delay để tránh bị block
-        time.sleep(0.2)  # Tăng delay cho method force
-        
-        vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        now_vn = datetime.now(vn_tz)
-        today = now_vn.strftime('%Y-%m-%d')
-        
-        # Method 1: Thử lấy dữ liệu hôm nay từ stock_historical_data
-        try:
-            historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=today, end_date=today)
-            
-            if historical_data is not None and len(historical_data) > 0:
-                latest_data = historical_data.iloc[-1]
-                price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
-                trading_date = latest_data.get('time', 'N/A')
-                
-                if isinstance(price, (np.integer, np.floating)):
-                    price = float(price)
-                
-                if str(trading_date).startswith(today):
-                    return price, f"realtime_force1 (today historical)"
-        except Exception as e:
-            pass
+            return error_quote('force', "Không có kết nối mạng")
         
-        # Method 2: Thử lấy dữ liệu từ 2 ngày gần nhất
-        try:
-            yesterday = (now_vn - timedelta(days=1)).strftime('%Y-%m-%d')
-            historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=yesterday, end_date=today)
-            
-            if historical_data is not None and len(historical_data) > 0:
-                # Tìm dữ liệu hôm nay trước
-                today_data = None
-                for _, row in historical_data.iterrows():
-                    if str(row.get('time', '')).startswith(today):
-                        today_data = row
-                        break
-                
-                if today_data is not None:
-                    price = today_data.get('close', today_data.get('lastPrice', 'N/A'))
-                    if isinstance(price, (np.integer, np.floating)):
-                        price = float(price)
-                    return price, f"realtime_force2 (today found)"
-                else:
-                    # Lấy dữ liệu gần nhất
-                    latest_data = historical_data.iloc[-1]
-                    price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
-                    if isinstance(price, (np.integer, np.floating)):
-                        price = float(price)
-                    return price, f"realtime_force2 (latest available)"
-        except Exception as e:
-            pass
+        # Method 1: nến hôm nay; Method 2: nến gần nhất (cùng 1 frame lịch sử của chu kỳ)
+        latest_data = _history_loader.today_bar(ticker_clean)
+        if latest_data is None:
+            latest_data = _history_loader.last_bar(ticker_clean)
+        if latest_data is not None:
+            price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
+            return make_quote(price, 'force', latest_data.get('time'), latest_data.get('volume'))
         
         # Method 3: Thử sử dụng requests trực tiếp để bypass block
         try:
-            session = setup_requests_session()
+            session = _client_registry.session()
             
             # Thử các API khác nhau
             api_urls = [
@@ -517,8 +1790,11 @@ def get_realtime_price_force(ticker_clean):
             ]
             
             for api_url in api_urls:
+                # Bỏ qua ngay các nguồn đang không hoạt động
+                if not _health_monitor.is_url_up(api_url):
+                    continue
                 try:
-                    response = session.get(api_url, timeout=10)
+                    response = rate_limited_get(session, api_url, timeout=10)
                     if response.status_code == 200:
                         data = response.json()
                         
@@ -528,233 +1804,1038 @@ def get_realtime_price_force(ticker_clean):
                             price = stock_data.get('close', stock_data.get('lastPrice', stock_data.get('price')))
                             
                             if price and price not in ['N/A', 'null', None]:
-                                if isinstance(price, (np.integer, np.floating)):
-                                    price = float(price)
-                                return price, f"realtime_force3 (direct API)"
+                                return make_quote(price, 'force', stock_data.get('date', stock_data.get('tradingDate')), stock_data.get('volume'))
                 except Exception as e:
                     continue
         except Exception as e:
             pass
         
-        return "N/A", "không có dữ liệu realtime force"
+        return missing_quote('force', "không có dữ liệu realtime force")
         
     except Exception as e:
-        return "Lỗi", f"Lỗi realtime force: {e}"
+        return error_quote('force', f"Lỗi realtime force: {e}")
+
+WEBSCRAPE_URLS = (
+    "https://www.vietcap.com.vn/stock/{ticker}",
+    "https://www.ssi.com.vn/stock/{ticker}",
+    "https://www.vndirect.com.vn/stock/{ticker}",
+)
+
+# Tìm giá trong HTML bằng regex
+WEBSCRAPE_PRICE_PATTERNS = (
+    r'"price":\s*([\d.]+)',
+    r'"lastPrice":\s*([\d.]+)',
+    r'"close":\s*([\d.]+)',
+    r'class="price[^"]*">\s*([\d,]+)',
+    r'data-price="([\d.]+)"',
+)
+# Thời điểm giao dịch trong JSON nhúng của trang (nếu có)
+WEBSCRAPE_TIME_PATTERN = re.compile(r'"(?:%s)":\s*"?([\dT:\-\s.]+)' % '|'.join(QUOTE_TIME_KEYS))
+
+def _scraped_time(html_content):
+    """Thời điểm giao dịch đầu tiên đọc được trong HTML, None nếu trang không có"""
+    for match in WEBSCRAPE_TIME_PATTERN.finditer(html_content):
+        value = match.group(1).strip()
+        if value.replace('.', '').isdigit():
+            value = float(value)
+        if _exchange_time(value) is not None:
+            return value
+    return None
+
+def _parse_scraped_price(html_content):
+    """Tìm giá trong HTML của trang, trả về Quote hoặc None"""
+    for pattern in WEBSCRAPE_PRICE_PATTERNS:
+        matches = re.findall(pattern, html_content)
+        if matches:
+            price_str = matches[0].replace(',', '')
+            try:
+                price = float(price_str)
+                if 1 <= price <= 100000:  # Kiểm tra giá hợp lệ
+                    return make_quote(price, 'webscrape', _scraped_time(html_content))
+            except ValueError:
+                continue
+    return None
 
 def get_realtime_price_webscrape(ticker_clean):
     """Lấy giá realtime bằng web scraping khi API bị block"""
-    import time
-    import re
-    
     try:
         # Kiểm tra kết nối mạng trước
         if not check_network_connection():
-            return "Lỗi", "Không có kết nối mạng"
-        
-        # Thêm delay để tránh bị block
-        time.sleep(0.3)  # Tăng delay cho web scraping
+            return error_quote('webscrape', "Không có kết nối mạng")
         
-        session = setup_requests_session()
+        session = _client_registry.session()
         
         # Thử các trang web khác nhau
-        scrape_urls = [
-            f"https://www.vietcap.com.vn/stock/{ticker_clean}",
-            f"https://www.ssi.com.vn/stock/{ticker_clean}",
-            f"https://www.vndirect.com.vn/stock/{ticker_clean}"
-        ]
-        
-        for url in scrape_urls:
+        for url in (template.format(ticker=ticker_clean) for template in WEBSCRAPE_URLS):
+            # Bỏ qua ngay các trang đang không hoạt động
+            if not _health_monitor.is_url_up(url):
+                continue
             try:
-                response = session.get(url, timeout=15)
+                response = rate_limited_get(session, url, timeout=15)
                 if response.status_code == 200:
-                    html_content = response.text
-                    
-                    # Tìm giá trong HTML bằng regex
-                    price_patterns = [
-                        r'"price":\s*([\d.]+)',
-                        r'"lastPrice":\s*([\d.]+)',
-                        r'"close":\s*([\d.]+)',
-                        r'class="price[^"]*">\s*([\d,]+)',
-                        r'data-price="([\d.]+)"'
-                    ]
-                    
-                    for pattern in price_patterns:
-                        matches = re.findall(pattern, html_content)
-                        if matches:
-                            price_str = matches[0].replace(',', '')
-                            try:
-                                price = float(price_str)
-                                if 1 <= price <= 100000:  # Kiểm tra giá hợp lệ
-                                    return price, f"realtime_webscrape ({url.split('/')[-2]})"
-                            except ValueError:
-                                continue
+                    result = _parse_scraped_price(response.text)
+                    if result is not None:
+                        return result
             except Exception as e:
                 continue
         
-        return "N/A", "không có dữ liệu từ web scraping"
+        return missing_quote('webscrape', "không có dữ liệu từ web scraping")
         
     except Exception as e:
-        return "Lỗi", f"Lỗi web scraping: {e}"
+        return error_quote('webscrape', f"Lỗi web scraping: {e}")
 
 # ====== 3. LẤY GIÁ ĐÓNG CỬA ======
+def _fallback_rank(quote):
+    """Thứ tự chọn giá khi không có giá mới: giá không rõ độ mới trước, sau đó giá cũ mới nhất"""
+    unknown = not quote.timestamp == quote.timestamp  # Không có thời điểm giao dịch (NaN)
+    return unknown, 0.0 if unknown else quote.timestamp
+
 def get_closing_price(ticker_clean):
     """Lấy giá đóng cửa gần nhất của mã cổ phiếu"""
-    import time
-    
     try:
         # Kiểm tra kết nối mạng trước
         if not check_network_connection():
-            return "Lỗi", "Không có kết nối mạng"
+            return error_quote('closing', "Không có kết nối mạng")
         
-        # Thêm delay để tránh bị block
-        time.sleep(0.08)  # Tăng delay cho GitHub Actions để tránh rate limit
+        # Thử nhiều phương pháp khác nhau để lấy dữ liệu, theo thứ tự hiệu quả gần đây
+        methods = _source_router.order(CLOSING_METHODS, _ticker_class(ticker_clean))
         
-        # Thử nhiều phương pháp khác nhau để lấy dữ liệu
-        methods = [
-            # Method 1: Sử dụng Vnstock class
-            lambda: _get_price_method1(ticker_clean),
-            # Method 2: Sử dụng stock_historical_data trực tiếp
-            lambda: _get_price_method2(ticker_clean),
-            # Method 3: Sử dụng stock_intraday_data
-            lambda: _get_price_method3(ticker_clean),
-        ]
-        
-        for i, method in enumerate(methods, 1):
+        # Giá hợp lệ nhưng cũ (nguồn chưa cập nhật phiên gần nhất): thử method khác, dùng nếu không có giá mới hơn
+        stale_result = None
+        for i, method_name in enumerate(methods, 1):
             try:
-                result = method()
-                if result and result[0] not in ['N/A', 'Lỗi', '', None]:
-                    return result
+                result = _routed_attempt(method_name, CLOSING_METHODS[method_name], ticker_clean)
+                if result is not None and result.has_price:
+                    if is_quote_fresh(result):
+                        _metrics.record_depth('closing', i)
+                        return result
+                    if stale_result is None or _fallback_rank(result) > _fallback_rank(stale_result):
+                        stale_result = result
             except Exception as e:
-                if i == len(methods):  # Nếu là method cuối cùng
-                    return "Lỗi", f"Tất cả methods đều thất bại: {e}"
+                if i == len(methods) and stale_result is None:  # Nếu là method cuối cùng
+                    return error_quote('closing', f"Tất cả methods đều thất bại: {e}")
                 continue
         
-        return "N/A", "không có dữ liệu từ tất cả methods"
+        if stale_result is not None:
+            _metrics.record_depth('closing', len(methods))
+            return stale_result
+        return missing_quote('closing', "không có dữ liệu từ tất cả methods")
         
     except Exception as e:
-        return "Lỗi", f"Lỗi đóng cửa: {e}"
+        return error_quote('closing', f"Lỗi đóng cửa: {e}")
 
 def _get_price_method1(ticker_clean):
-    """Method 1: Sử dụng Vnstock class"""
+    """Method 1: Sử dụng Vnstock class (data_source.history)"""
+    latest_data = _history_loader.last_bar(ticker_clean, 'quote')
+    if latest_data is None:
+        return None
+    return make_quote(latest_data.get('close', 'N/A'), 'method1', latest_data.get('time'), latest_data.get('volume'))
+
+def _get_price_method2(ticker_clean):
+    """Method 2: Sử dụng stock_historical_data trực tiếp"""
+    latest_data = _history_loader.last_bar(ticker_clean)
+    if latest_data is None:
+        return None
+    return make_quote(latest_data.get('close', 'N/A'), 'method2', latest_data.get('time'), latest_data.get('volume'))
+
+def _get_price_method3(ticker_clean):
+    """Method 3: Lệnh khớp cuối cùng của phiên từ dữ liệu intraday"""
     try:
-        vs = vnstock.Vnstock()
-        stock_data = safe_vnstock_call(vs.stock, symbol=ticker_clean)
+        return intraday_quote(ticker_clean, 'method3')
+    except:
+        pass
+    return None
+
+# Các method lấy giá theo thứ tự mặc định (khi chưa có thống kê)
+REALTIME_METHODS = OrderedDict([
+    ('realtime', get_realtime_price),
+    ('alternative', get_realtime_price_alternative),
+    ('force', get_realtime_price_force),
+    ('webscrape', get_realtime_price_webscrape),
+])
+CLOSING_METHODS = OrderedDict([
+    ('method1', _get_price_method1),
+    ('method2', _get_price_method2),
+    ('method3', _get_price_method3),
+])
+
+# ====== 3.1. LẤY GIÁ THEO LÔ (PRICE BOARD) ======
+def get_batch_prices(tickers_clean):
+    """Lấy giá nhiều mã cùng lúc qua price board, trả về dict {mã: Quote}
+
+    Danh sách mã được chia thành từng lô PRICE_BOARD_CHUNK_SIZE mã, mỗi lô chỉ
+    tốn 1 request. Mã không có trong kết quả sẽ không xuất hiện trong dict để
+    gọi lại theo từng mã. Price board không có thời điểm giao dịch nên chỉ
+    dùng khi thị trường mở; ngoài giờ giá lấy qua chuỗi giá đóng cửa.
+    """
+    if not hasattr(vnstock, 'price_board') or not is_market_open():
+        return {}
+    if not _health_monitor.is_up('apipubaws.tcbs.com.vn'):
+        logger.warning("⚠️ Price board (TCBS) đang không hoạt động, bỏ qua lấy giá theo lô")
+        return {}
+    
+    batch_prices = {}
+    
+    for i in range(0, len(tickers_clean), PRICE_BOARD_CHUNK_SIZE):
+        chunk = tickers_clean[i:i+PRICE_BOARD_CHUNK_SIZE]
+        try:
+            started = time_module.monotonic()
+            try:
+                board = safe_vnstock_call(vnstock.price_board, ','.join(chunk))
+            finally:
+                _metrics.observe('price_board', time_module.monotonic() - started)
+            if board is None or len(board) == 0:
+                continue
+            
+            for _, row in board.iterrows():
+                ticker_clean = str(row.get('Mã CP', '')).strip().upper()
+                if ticker_clean not in chunk:
+                    continue
+                quote = make_quote(row.get('Giá'), 'price_board')
+                if quote.has_price:
+                    batch_prices[ticker_clean] = quote
+        except Exception as e:
+            logger.warning(f"⚠️ Lỗi price board ({len(chunk)} mã): {e}")
+            continue
+    
+    for ticker_clean in tickers_clean:
+        record_method_result(ticker_clean, 'price_board', ticker_clean in batch_prices)
+    
+    return batch_prices
+
+# ====== 3.2. LẤY GIÁ SONG SONG ======
+def _get_fetch_executor():
+    """Lấy thread pool dùng chung cho việc lấy giá (tạo 1 lần cho cả process)"""
+    global _fetch_executor
+    if _fetch_executor is None:
+        _fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+    return _fetch_executor
+
+def _call_source(source, func, ticker_clean):
+    """Gọi một method lấy giá, giới hạn số request đồng thời của từng nguồn"""
+    with _source_semaphores[source]:
+        try:
+            result = _routed_attempt(source, func, ticker_clean)
+        except Exception:
+            record_method_result(ticker_clean, source, False)
+            raise
+    record_method_result(ticker_clean, source, result is not None and result.has_price)
+    return result
+
+def record_method_result(ticker_clean, method, ok):
+    """Cộng dồn số lần thành công/thất bại của từng method cho từng mã"""
+    with _method_stats_lock:
+        counts = _method_stats.setdefault(ticker_clean, {}).setdefault(method, [0, 0])
+        counts[0 if ok else 1] += 1
+        _method_stats_dirty.add(ticker_clean)
+
+def _needs_fallback(quote):
+    """Kết quả không dùng được (không có giá hoặc dữ liệu cũ theo is_quote_fresh), cần thử method khác"""
+    return quote is None or not quote.has_price or not is_quote_fresh(quote)
+
+def fetch_ticker_price(ticker_clean):
+    """Lấy giá của 1 mã theo chuỗi fallback: realtime khi thị trường mở, đóng cửa khi thị trường đóng
+
+    Khi thị trường mở, các method realtime được thử theo thứ tự hiệu quả gần
+    đây (SourceRouter), bỏ qua method đang bị tạm ngắt; cuối cùng mới lấy giá
+    đóng cửa.
+    """
+    # Kiểm tra thị trường có đang mở không
+    if is_market_open():
+        # Thị trường đang mở: ưu tiên realtime, thử nhiều method
+        sources = _source_router.order(REALTIME_METHODS, _ticker_class(ticker_clean))
         
-        if stock_data is None:
-            raise TimeoutError("API call timeout")
+        # Chế độ hedge: 2 method đầu tiên có thể chạy song song
+        depth = 0
+        if HEDGE_ENABLED and len(sources) >= 2:
+            result, tried_sources = fetch_hedged(ticker_clean, sources[0], sources[1])
+            depth = len(tried_sources)
+            if not _needs_fallback(result):
+                _metrics.record_depth('realtime', depth)
+                return result
+            sources = [source for source in sources if source not in tried_sources]
         
-        # Lấy dữ liệu 7 ngày gần nhất
-        from datetime import datetime, timedelta
-        vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        now_vn = datetime.now(vn_tz)
-        start_date = (now_vn - timedelta(days=7)).strftime('%Y-%m-%d')
-        historical_data = stock_data.quote.data_source.history(start_date)
+        for source in sources:
+            depth += 1
+            quote = _call_source(source, REALTIME_METHODS[source], ticker_clean)
+            if not _needs_fallback(quote):
+                _metrics.record_depth('realtime', depth)
+                return quote
+            logger.debug("  - %s: 🔄 %s không có dữ liệu mới, thử method khác...", ticker_clean, source)
         
-        if historical_data is not None and len(historical_data) > 0:
-            latest_data = historical_data.iloc[-1]
-            close_price = latest_data.get('close', 'N/A')
-            trading_date = latest_data.get('time', 'N/A')
-            
-            if isinstance(close_price, (np.integer, np.floating)):
-                close_price = float(close_price)
-            if isinstance(trading_date, np.datetime64):
-                trading_date = str(trading_date)
+        # Nếu vẫn không có, mới fallback sang closing price
+        logger.debug("  - %s: ⚠️ Fallback sang closing price...", ticker_clean)
+        _metrics.record_depth('realtime', depth + 1)
+        quote = _call_source('closing', get_closing_price, ticker_clean)
+    else:
+        # Thị trường đã đóng: lấy giá đóng cửa gần nhất
+        quote = _call_source('closing', get_closing_price, ticker_clean)
+
+    return quote
+
+def _get_hedge_executor():
+    """Thread pool chạy method chính và hedge (đủ chỗ cho mọi luồng lấy giá và hedge)"""
+    global _hedge_executor
+    if _hedge_executor is None:
+        _hedge_executor = ThreadPoolExecutor(
+            max_workers=FETCH_WORKERS + MAX_HEDGES_IN_FLIGHT,
+            thread_name_prefix="hedge"
+        )
+    return _hedge_executor
+
+def _release_hedge_slot(future):
+    _hedge_slots.release()
+
+def fetch_hedged(ticker_clean, primary, secondary):
+    """Gọi method chính; nếu quá percentile độ trễ thì gọi thêm method phụ song song
+
+    Kết quả hợp lệ đến trước được dùng, request còn lại bị hủy (nếu chưa chạy)
+    hoặc bỏ qua kết quả. Trả về (Quote | None, các method đã thử).
+    """
+    executor = _get_hedge_executor()
+    hedge_delay = _source_router.latency_percentile(
+        primary, _ticker_class(ticker_clean), HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES
+    )
+    if hedge_delay is None:
+        hedge_delay = HEDGE_DEFAULT_DELAY
+    
+    primary_future = executor.submit(_call_source, primary, REALTIME_METHODS[primary], ticker_clean)
+    done, _ = wait([primary_future], timeout=min(hedge_delay, max(remaining_cycle_time(), 0)))
+    if done or not _hedge_slots.acquire(blocking=False):
+        # Method chính đã trả lời, hoặc đã đủ số hedge đang chạy: chờ method chính
+        try:
+            return primary_future.result(timeout=max(remaining_cycle_time(), 0)), [primary]
+        except Exception:
+            return None, [primary]
+    
+    hedge_future = executor.submit(_call_source, secondary, REALTIME_METHODS[secondary], ticker_clean)
+    hedge_future.add_done_callback(_release_hedge_slot)
+    with _hedge_stats_lock:
+        _hedge_stats['launched'] += 1
+    
+    pending = {primary_future, hedge_future}
+    last_result = None
+    while pending:
+        done, pending = wait(pending, timeout=max(remaining_cycle_time(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            last_result = result
+            if not _needs_fallback(result):
+                for other in pending:
+                    other.cancel()
+                if future is hedge_future:
+                    with _hedge_stats_lock:
+                        _hedge_stats['won'] += 1
+                return result, [primary, secondary]
+    return last_result, [primary, secondary]
+
+def fetch_prices_concurrently(tickers_clean, on_result=None):
+    """Lấy giá cho danh sách mã song song, trả về list Quote đúng thứ tự đầu vào
+
+    Mã bị exception hoặc chưa xong khi hết hạn chót của chu kỳ trả về Quote
+    STATUS_ERROR. on_result(mã, Quote) được gọi ngay khi từng mã có kết quả
+    (không phải exception).
+    """
+    executor = _get_fetch_executor()
+    futures = [executor.submit(fetch_ticker_price, ticker_clean) for ticker_clean in tickers_clean]
+    if on_result is not None:
+        for ticker_clean, future in zip(tickers_clean, futures):
+            future.add_done_callback(_result_callback(ticker_clean, on_result))
+
+    done, not_done = wait(futures, timeout=max(remaining_cycle_time(), 0))
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        logger.warning(f"⏱️ {len(not_done)} mã chưa lấy xong giá trước hạn chót của chu kỳ ({FETCH_CYCLE_TIMEOUT} giây)")
+
+    results = []
+    for future in futures:
+        if future in done:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(error_quote('fetch', str(e)))
+        else:
+            results.append(error_quote('fetch', f"fetch timeout after {FETCH_CYCLE_TIMEOUT} seconds"))
+    return results
+
+def _result_callback(ticker_clean, on_result):
+    """Done callback gọi on_result(mã, Quote) khi future hoàn thành không lỗi"""
+    def callback(future):
+        if not future.cancelled() and future.exception() is None:
+            on_result(ticker_clean, future.result())
+    return callback
+
+# ====== 3.3. CACHE GIÁ ======
+PRICE_KIND_REALTIME = 'realtime'
+PRICE_KIND_CLOSE = 'close'
+
+class PriceCache:
+    """Cache giá theo (mã, ngày giao dịch, loại giá), giới hạn kích thước theo LRU
+
+    Giá đóng cửa của phiên đã kết thúc không bao giờ hết hạn; giá đóng cửa
+    chưa đúng ngày hết hạn sau ttl giây. Giá trong phiên không được cache (mỗi
+    chu kỳ đều lấy mới). Giá hợp lệ gần nhất của mỗi mã được giữ riêng để
+    dùng khi tất cả method đều lỗi.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()    # (mã, ngày, loại) -> (Quote, hết hạn lúc | None)
+        self._last_good = OrderedDict()  # mã -> Quote
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ticker_clean, trading_date, kind):
+        """Lấy Quote còn hạn trong cache, None nếu không có"""
+        key = (ticker_clean, trading_date, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                quote, expires_at = entry
+                if expires_at is None or expires_at > time_module.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return quote
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, ticker_clean, trading_date, kind, quote, ttl=None):
+        """Lưu giá vào cache; ttl=None nghĩa là không hết hạn"""
+        key = (ticker_clean, trading_date, kind)
+        expires_at = None if ttl is None else time_module.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (quote, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
             
-            # Xử lý thời gian để hiển thị chính xác hơn
-            if trading_date and trading_date != 'N/A':
-                # Kiểm tra nếu thời gian là 00:00:00 thì hiển thị là "đóng cửa"
-                if '00:00:00' in str(trading_date):
-                    # Lấy ngày từ trading_date
-                    date_only = str(trading_date).split(' ')[0]
-                    trading_date_display = f"{date_only} (đóng cửa)"
-                else:
-                    trading_date_display = str(trading_date)
+            self._last_good[ticker_clean] = quote
+            self._last_good.move_to_end(ticker_clean)
+            while len(self._last_good) > self.max_size:
+                self._last_good.popitem(last=False)
+
+    def seed_last_good(self, ticker_clean, quote):
+        """Cập nhật giá hợp lệ gần nhất (từ file hoặc giá trong phiên) mà không tạo entry cache còn hạn"""
+        with self._lock:
+            self._last_good[ticker_clean] = quote
+            self._last_good.move_to_end(ticker_clean)
+            while len(self._last_good) > self.max_size:
+                self._last_good.popitem(last=False)
+
+    def last_good(self, ticker_clean):
+        """Giá hợp lệ gần nhất của mã (có thể đã cũ), None nếu chưa từng có"""
+        with self._lock:
+            return self._last_good.get(ticker_clean)
+
+    def evict(self, tickers):
+        """Xóa mọi entry của các mã (khi mã bị xóa khỏi sheet)"""
+        tickers = set(tickers)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in tickers]:
+                del self._entries[key]
+            for ticker_clean in tickers:
+                self._last_good.pop(ticker_clean, None)
+        _band_guard.discard(tickers)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (self.hits / total * 100) if total else 0.0
+
+_price_cache = PriceCache(PRICE_CACHE_SIZE)
+
+def _cache_slot(session):
+    """(ngày giao dịch, loại giá) dùng làm khóa cache cho chu kỳ hiện tại"""
+    if session.is_open:
+        return session.trading_date, PRICE_KIND_REALTIME
+    return session.last_trading_day, PRICE_KIND_CLOSE
+
+def get_cached_prices(tickers_clean, session):
+    """Tách danh sách mã thành (dict giá có trong cache, list mã cần lấy mới)
+
+    Trong phiên mỗi chu kỳ (FAST_POLL_INTERVAL) đều cần giá mới nên không tra cache.
+    """
+    trading_date, kind = _cache_slot(session)
+    if kind == PRICE_KIND_REALTIME:
+        return {}, list(tickers_clean)
+    cached = {}
+    missing = []
+    for ticker_clean in tickers_clean:
+        entry = _price_cache.get(ticker_clean, trading_date, kind)
+        if entry is not None:
+            cached[ticker_clean] = entry
+        else:
+            missing.append(ticker_clean)
+    return cached, missing
+
+def store_prices(results_by_ticker, session, from_price_board=(), held=()):
+    """Lưu các giá hợp lệ vừa lấy được vào cache
+
+    Giá đóng cửa đúng ngày giao dịch gần nhất được lưu vĩnh viễn; giá đóng
+    cửa cũ hơn (nguồn chưa cập nhật) chỉ lưu CLOSE_RETRY_TTL giây để thử lại.
+    Giá trong phiên chỉ cập nhật giá hợp lệ gần nhất (không tạo entry cache).
+    Mã trong held (giá ngoài biên chưa được xác nhận) không được lưu.
+    Trả về list (mã, ngày, loại, Quote, là giá đóng cửa chính thức) đã lưu.
+    """
+    trading_date, kind = _cache_slot(session)
+    stored = []
+    for ticker_clean, quote in results_by_ticker.items():
+        if not quote.has_price or ticker_clean in held:
+            continue
+        if kind == PRICE_KIND_REALTIME:
+            _price_cache.seed_last_good(ticker_clean, quote)
+            stored.append((ticker_clean, trading_date, kind, quote, False))
+            continue
+        if ticker_clean in from_price_board or quote.trading_date() == trading_date:
+            ttl = None
+        else:
+            ttl = CLOSE_RETRY_TTL
+        _price_cache.put(ticker_clean, trading_date, kind, quote, ttl=ttl)
+        stored.append((ticker_clean, trading_date, kind, quote, kind == PRICE_KIND_CLOSE and ttl is None))
+    return stored
+
+def apply_last_known_good(results_by_ticker):
+    """Thay kết quả lỗi bằng giá hợp lệ gần nhất trong cache (đánh dấu là giá cũ)
+
+    Trả về số mã phải dùng giá cũ.
+    """
+    stale_count = 0
+    for ticker_clean, quote in results_by_ticker.items():
+        if quote.has_price:
+            continue
+        last_good = _price_cache.last_good(ticker_clean)
+        if last_good is None:
+            continue
+        results_by_ticker[ticker_clean] = last_good.as_stale()
+        stale_count += 1
+    return stale_count
+
+# ====== 3.4. LƯU GIÁ XUỐNG ĐĨA (WARM START) ======
+class PriceStore:
+    """Lưu giá gần nhất, giá đóng cửa theo ngày và thống kê method vào SQLite
+
+    Khi khởi động, dữ liệu được nạp lại vào PriceCache để không phải lấy lại
+    toàn bộ giá sau mỗi lần restart; mỗi chu kỳ chỉ ghi các dòng thay đổi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Mở (tạo nếu chưa có) file SQLite và xóa giá đóng cửa quá CLOSE_HISTORY_DAYS ngày
+
+        Gọi lại khi restart trong cùng tiến trình sẽ đóng kết nối cũ trước,
+        tránh rò rỉ kết nối SQLite sau mỗi lần restart.
+        """
+        self.close()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS latest_quotes (
+                    ticker TEXT PRIMARY KEY,
+                    price REAL NOT NULL,
+                    info TEXT,
+                    trading_date TEXT,
+                    kind TEXT,
+                    updated_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS daily_closes (
+                    ticker TEXT NOT NULL,
+                    trading_date TEXT NOT NULL,
+                    close REAL NOT NULL,
+                    info TEXT,
+                    PRIMARY KEY (ticker, trading_date)
+                );
+                CREATE TABLE IF NOT EXISTS method_stats (
+                    ticker TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    success INTEGER NOT NULL,
+                    failure INTEGER NOT NULL,
+                    PRIMARY KEY (ticker, method)
+                );
+            """)
+            cutoff = (datetime.now(VN_TZ).date() - timedelta(days=CLOSE_HISTORY_DAYS)).isoformat()
+            self._conn.execute("DELETE FROM daily_closes WHERE trading_date < ?", (cutoff,))
+
+    def close(self):
+        """Đóng kết nối SQLite (nếu đang mở)"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def load_into(self, cache):
+        """Nạp giá đóng cửa, giá gần nhất và thống kê method; trả về (số giá đóng cửa, số giá gần nhất)"""
+        with self._lock:
+            closes = self._conn.execute("SELECT ticker, trading_date, close, info FROM daily_closes ORDER BY trading_date").fetchall()
+            latest = self._conn.execute("SELECT ticker, price, info, trading_date FROM latest_quotes ORDER BY updated_at").fetchall()
+            stats = self._conn.execute("SELECT ticker, method, success, failure FROM method_stats").fetchall()
+        
+        for ticker_clean, trading_date, close, info in closes:
+            quote = _stored_quote(close, info, trading_date)
+            cache.put(ticker_clean, quote.trading_date(), PRICE_KIND_CLOSE, quote, ttl=None)
+        for ticker_clean, price, info, trading_date in latest:
+            cache.seed_last_good(ticker_clean, _stored_quote(price, info, trading_date))
+        with _method_stats_lock:
+            for ticker_clean, method, success, failure in stats:
+                _method_stats.setdefault(ticker_clean, {})[method] = [success, failure]
+        return len(closes), len(latest)
+
+    def save_cycle(self, stored_prices):
+        """Ghi các giá vừa lấy được và thống kê method đã thay đổi trong 1 transaction"""
+        if self._conn is None:
+            return
+        updated_at = time_module.time()
+        with _method_stats_lock:
+            dirty_stats = [
+                (ticker_clean, method, counts[0], counts[1])
+                for ticker_clean in _method_stats_dirty
+                for method, counts in _method_stats.get(ticker_clean, {}).items()
+            ]
+            _method_stats_dirty.clear()
+        
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO latest_quotes VALUES (?, ?, ?, ?, ?, ?)",
+                [(ticker_clean, quote.price, SOURCE_NAMES[quote.source], str(trading_date), kind, updated_at)
+                 for ticker_clean, trading_date, kind, quote, _ in stored_prices]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO daily_closes VALUES (?, ?, ?, ?)",
+                [(ticker_clean, str(trading_date), quote.price, SOURCE_NAMES[quote.source])
+                 for ticker_clean, trading_date, kind, quote, is_final_close in stored_prices
+                 if is_final_close]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO method_stats VALUES (?, ?, ?, ?)",
+                dirty_stats
+            )
+
+def _stored_quote(price, info, trading_date):
+    """Quote đọc lại từ file: cột info là tên nguồn (file cũ lưu chuỗi mô tả, lấy từ đầu tiên)"""
+    source = SOURCE_IDS.get(str(info).split(' ')[0], SOURCE_IDS['store'])
+    try:
+        timestamp = VN_TZ.localize(datetime.strptime(trading_date, '%Y-%m-%d')).timestamp()
+    except (TypeError, ValueError):
+        timestamp = np.nan
+    return Quote(float(price), source, STATUS_OK, timestamp)
+
+_price_store = PriceStore(PRICE_STORE_FILE)
+
+def load_price_store():
+    """Mở file lưu giá và nạp vào cache (warm start)"""
+    try:
+        load_start = time_module.time()
+        _price_store.open()
+        close_count, latest_count = _price_store.load_into(_price_cache)
+        load_ms = (time_module.time() - load_start) * 1000
+        logger.info(f"💾 Warm start: {close_count} giá đóng cửa, {latest_count} giá gần nhất ({load_ms:.0f} ms)")
+    except Exception as e:
+        logger.warning(f"⚠️ Không thể nạp {PRICE_STORE_FILE}: {e}")
+
+# ====== 3.5. XẾP HẠNG METHOD LẤY GIÁ ======
+class SourceRouter:
+    """Theo dõi tỷ lệ thành công, độ trễ và độ mới của từng method để chọn thứ tự thử
+
+    Mỗi (method, nhóm mã) giữ ROUTER_WINDOW lần gọi gần nhất. Method được xếp
+    theo (tỷ lệ có dữ liệu mới / độ trễ trung bình) giảm dần, là thứ tự tối ưu
+    cho chuỗi fallback thử lần lượt. Method bị exception/timeout liên tiếp
+    CIRCUIT_BREAKER_FAILURES lần với 1 nhóm mã thì bị tạm ngắt cho nhóm đó
+    CIRCUIT_BREAKER_COOLDOWN giây; giá cũ hoặc không có dữ liệu (mã ít giao
+    dịch) không tính là lỗi.
+    """
+
+    def __init__(self, window, failure_threshold, cooldown):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._samples = {}               # (method, nhóm mã) -> deque[(fresh, latency)]
+        self._consecutive_failures = {}  # (method, nhóm mã) -> số lần lỗi liên tiếp
+        self._open_until = {}            # (method, nhóm mã) -> thời điểm hết tạm ngắt
+        self._lock = threading.Lock()
+        self.failed_attempts = 0         # Số lần thử không có dữ liệu (đếm theo chu kỳ)
+
+    def record(self, method, ticker_class, fresh, latency, failed):
+        """Ghi nhận kết quả 1 lần gọi method (failed: exception hoặc timeout)"""
+        key = (method, ticker_class)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append((fresh, latency))
+            if not fresh:
+                self.failed_attempts += 1
+            if not failed:
+                self._consecutive_failures[key] = 0
+                self._open_until.pop(key, None)
             else:
-                trading_date_display = "N/A"
-            
-            return close_price, f"method1 ({trading_date_display})"
-    except:
-        pass
-    return None
+                failures = self._consecutive_failures.get(key, 0) + 1
+                self._consecutive_failures[key] = failures
+                if failures >= self.failure_threshold:
+                    self._open_until[key] = time_module.monotonic() + self.cooldown
+
+    def _score(self, method, ticker_class):
+        samples = self._samples.get((method, ticker_class), ())
+        count = len(samples)
+        # Làm trơn Laplace: method chưa có dữ liệu có tỷ lệ 0.5 và độ trễ 1 giây
+        fresh_rate = (sum(1 for fresh, _ in samples if fresh) + 1) / (count + 2)
+        avg_latency = (sum(latency for _, latency in samples) + 1.0) / (count + 1)
+        return fresh_rate / max(avg_latency, 0.01)
+
+    def latency_percentile(self, method, ticker_class, percentile, min_samples):
+        """Percentile độ trễ của method, None nếu chưa đủ min_samples mẫu"""
+        with self._lock:
+            latencies = [latency for _, latency in self._samples.get((method, ticker_class), ())]
+        if len(latencies) < min_samples:
+            return None
+        return float(np.percentile(latencies, percentile))
+
+    def is_open(self, method, ticker_class):
+        """Method đang bị tạm ngắt với nhóm mã"""
+        open_until = self._open_until.get((method, ticker_class))
+        return open_until is not None and open_until > time_module.monotonic()
+
+    def order(self, methods, ticker_class):
+        """Thứ tự thử các method (bỏ qua method đang tạm ngắt), giữ thứ tự gốc khi điểm bằng nhau"""
+        with self._lock:
+            available = [method for method in methods if not self.is_open(method, ticker_class)]
+            return sorted(available, key=lambda method: -self._score(method, ticker_class))
+
+    def open_methods(self):
+        """Danh sách method/nhóm mã đang bị tạm ngắt"""
+        with self._lock:
+            return [f"{method}/{ticker_class}" for method, ticker_class in self._open_until if self.is_open(method, ticker_class)]
+
+    def reset_cycle_counters(self):
+        with self._lock:
+            self.failed_attempts = 0
+
+_source_router = SourceRouter(ROUTER_WINDOW, CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_COOLDOWN)
+
+def _ticker_class(ticker_clean):
+    """Nhóm mã để xếp hạng method: cổ phiếu (3 ký tự) và các loại khác"""
+    return 'stock' if len(ticker_clean) == 3 else 'other'
+
+def _record_attempt(method, ticker_clean, result, elapsed, raised=False):
+    """Ghi nhận độ trễ và kết quả 1 lần gọi method (raised=True nếu bị exception)"""
+    _metrics.observe(method, elapsed)
+    fresh = not _needs_fallback(result)
+    # Method thường trả Quote lỗi thay vì raise (timeout, lỗi kết nối); None là không có dữ liệu
+    failed = raised or (result is not None and result.status == STATUS_ERROR)
+    _source_router.record(method, _ticker_class(ticker_clean), fresh, elapsed, failed)
+
+def _routed_attempt(method, func, ticker_clean):
+    """Gọi 1 method lấy giá, ghi nhận độ trễ và kết quả cho SourceRouter"""
+    started = time_module.monotonic()
+    try:
+        result = func(ticker_clean)
+    except Exception:
+        _record_attempt(method, ticker_clean, None, time_module.monotonic() - started, raised=True)
+        raise
+    _record_attempt(method, ticker_clean, result, time_module.monotonic() - started)
+    return result
+
+# ====== 3.6. CHUẨN HÓA GIÁ ======
+def _normalize_units(prices):
+    """Giá > 10,000 là giá tính theo đồng (bị nhân 1000), đổi về nghìn đồng"""
+    return np.where(prices > 10000, prices / 1000, prices)
+
+class PriceBandGuard:
+    """Giữ giá lệch quá PRICE_BAND so với giá tham chiếu ngoài cache và PriceStore
+
+    Giá ngoài biên lần đầu chỉ được ghi nhận là ứng viên (pending) của mã; lần
+    lấy sau trả đúng giá đó thì giá được chấp nhận, trả giá khác thì ứng viên
+    bị thay (hoặc bị xóa nếu giá đã trở lại trong biên).
+    """
+
+    def __init__(self):
+        self._pending = {}  # mã -> giá ứng viên (nghìn đồng, làm tròn 2 số)
+        self._lock = threading.Lock()
+
+    def screen(self, results_by_ticker, reference_prices):
+        """Kiểm tra giá vừa lấy; trả về (mã bị giữ lại, mã ngoài biên đã được xác nhận)"""
+        held, confirmed = set(), set()
+        with self._lock:
+            for ticker_clean, quote in results_by_ticker.items():
+                if not quote.has_price:
+                    continue
+                price = round(float(_normalize_units(quote.price)), 2)
+                reference = reference_prices.get(ticker_clean)
+                if reference is None or abs(price - float(_normalize_units(reference))) <= PRICE_BAND * float(_normalize_units(reference)):
+                    self._pending.pop(ticker_clean, None)
+                elif self._pending.get(ticker_clean) == price:
+                    del self._pending[ticker_clean]
+                    confirmed.add(ticker_clean)
+                else:
+                    self._pending[ticker_clean] = price
+                    held.add(ticker_clean)
+        return held, confirmed
+
+    def discard(self, tickers):
+        with self._lock:
+            for ticker_clean in tickers:
+                self._pending.pop(ticker_clean, None)
+
+_band_guard = PriceBandGuard()
+
+class PriceBatch:
+    """Kết quả lấy giá của 1 chu kỳ dưới dạng các mảng NumPy cùng thứ tự với tickers
+
+    price: giá đã chuẩn hóa (nghìn đồng, NaN nếu không có), status: STATUS_*,
+    source: SOURCE_IDS, timestamp: epoch lúc lấy. Giá ngoài PRICE_BAND được
+    thay bằng giá tham chiếu; giá đó không vào cache/PriceStore cho đến khi
+    PriceBandGuard xác nhận (bỏ mã khỏi reference_prices).
+    """
+
+    def __init__(self, tickers, results_by_ticker, reference_prices, timestamps):
+        self.tickers = list(tickers)
+        self.quotes = [results_by_ticker[ticker_clean] for ticker_clean in self.tickers]
+        count = len(self.tickers)
+        raw = np.fromiter((quote.price for quote in self.quotes), dtype=float, count=count)
+        status = np.fromiter((quote.status for quote in self.quotes), dtype=np.int8, count=count)
+        self.source = np.fromiter((quote.source for quote in self.quotes), dtype=np.int8, count=count)
+        
+        raw = _normalize_units(raw)
+        valid = np.isfinite(raw) & (raw > 0)
+        
+        reference = _normalize_units(np.array([reference_prices.get(t, np.nan) for t in self.tickers], dtype=float))
+        out_of_band = valid & np.isfinite(reference) & (np.abs(raw - reference) > PRICE_BAND * reference)
+        status[out_of_band] = STATUS_OUT_OF_BAND
+        
+        self.raw = raw
+        self.price = np.round(np.where(out_of_band, reference, np.where(valid, raw, np.nan)), 2)
+        self.status = status
+        self.timestamp = np.array([timestamps.get(t, np.nan) for t in self.tickers], dtype=float)
+
+    def count(self, status):
+        return int(np.count_nonzero(self.status == status))
+
+    def label(self, idx):
+        return self.quotes[idx].label()
+
+    def payload(self):
+        """Giá theo mã để ghi lên sheet; mã không có giá được ghi rỗng"""
+        prices = self.price.tolist()
+        return {ticker_clean: (price if price == price else "") for ticker_clean, price in zip(self.tickers, prices)}
+
+# ====== 3.7. CHẾ ĐỘ ASYNCIO ======
+class AsyncHttpClient:
+    """HTTP bất đồng bộ cho chế độ asyncio
+
+    Dùng aiohttp nếu đã cài (1 connection pool cho mọi request, không tốn
+    thread); nếu không có aiohttp, chạy session requests dùng chung trong thread pool.
+    """
+
+    def __init__(self, limit=ASYNC_HTTP_LIMIT):
+        self.limit = limit
+        self._session = None
+
+    def _aiohttp_session(self):
+        if self._session is None:
+            headers = dict(_client_registry.session().headers)
+            headers['Accept-Encoding'] = 'gzip, deflate'  # aiohttp cần thêm thư viện để giải nén br
+            self._session = aiohttp.ClientSession(
+                headers=headers,
+                connector=aiohttp.TCPConnector(limit=self.limit)
+            )
+        return self._session
+
+    async def get(self, url, timeout, session_name='default', max_retries=MAX_RETRIES):
+        """GET url, trả về (status code, nội dung)"""
+        if aiohttp is None:
+            session = _client_registry.session(session_name, max_retries=max_retries)
+            response = await asyncio.get_running_loop().run_in_executor(
+                _get_call_executor(), lambda: session.get(url, timeout=timeout)
+            )
+            return response.status_code, response.text
+        async with self._aiohttp_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, await response.text()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+async def rate_limited_get_async(http, url, timeout):
+    """Phiên bản asyncio của rate_limited_get, trả về (status code, nội dung)"""
+    host = url.split('/')[2]
+    await _rate_limiter.acquire_async(host, timeout=max(remaining_cycle_time(), 0))
+    status, text = await http.get(url, timeout)
+    if status == 429:
+        _rate_limiter.penalize(host)
+    else:
+        _rate_limiter.reward(host)
+    return status, text
+
+async def _scrape_url_async(http, url):
+    status, html_content = await rate_limited_get_async(http, url, timeout=15)
+    if status != 200:
+        return None
+    return _parse_scraped_price(html_content)
 
-def _get_price_method2(ticker_clean):
-    """Method 2: Sử dụng stock_historical_data trực tiếp"""
+async def get_realtime_price_webscrape_async(ticker_clean, http):
+    """Web scraping bất đồng bộ: gửi request đến tất cả trang cùng lúc, dùng giá hợp lệ đến trước"""
+    if not check_network_connection():
+        return error_quote('webscrape', "Không có kết nối mạng")
+    
+    urls = [template.format(ticker=ticker_clean) for template in WEBSCRAPE_URLS]
+    tasks = [asyncio.ensure_future(_scrape_url_async(http, url)) for url in urls if _health_monitor.is_url_up(url)]
     try:
-        from datetime import datetime, timedelta
-        vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        now_vn = datetime.now(vn_tz)
-        start_date = (now_vn - timedelta(days=7)).strftime('%Y-%m-%d')
-        end_date = now_vn.strftime('%Y-%m-%d')
-        
-        historical_data = safe_vnstock_call(vnstock.stock_historical_data, symbol=ticker_clean, start_date=start_date, end_date=end_date)
-        
-        if historical_data is not None and len(historical_data) > 0:
-            latest_data = historical_data.iloc[-1]
-            close_price = latest_data.get('close', 'N/A')
-            trading_date = latest_data.get('time', 'N/A')
-            
-            if isinstance(close_price, (np.integer, np.floating)):
-                close_price = float(close_price)
-            if isinstance(trading_date, np.datetime64):
-                trading_date = str(trading_date)
-            
-            # Xử lý thời gian để hiển thị chính xác hơn
-            if trading_date and trading_date != 'N/A':
-                # Kiểm tra nếu thời gian là 00:00:00 thì hiển thị là "đóng cửa"
-                if '00:00:00' in str(trading_date):
-                    # Lấy ngày từ trading_date
-                    date_only = str(trading_date).split(' ')[0]
-                    trading_date_display = f"{date_only} (đóng cửa)"
-                else:
-                    trading_date_display = str(trading_date)
-            else:
-                trading_date_display = "N/A"
-            
-            return close_price, f"method2 ({trading_date_display})"
-    except:
-        pass
-    return None
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except Exception:
+                continue
+            if result is not None:
+                return result
+    finally:
+        for task in tasks:
+            task.cancel()
+    return missing_quote('webscrape', "không có dữ liệu từ web scraping")
 
-def _get_price_method3(ticker_clean):
-    """Method 3: Sử dụng stock_intraday_data"""
-    try:
-        historical_data = safe_vnstock_call(vnstock.stock_intraday_data, symbol=ticker_clean, page_size=7)
-        
-        if historical_data is not None and len(historical_data) > 0:
-            latest_data = historical_data.iloc[-1]
-            close_price = latest_data.get('close', latest_data.get('lastPrice', 'N/A'))
-            trading_date = latest_data.get('time', 'N/A')
-            
-            if isinstance(close_price, (np.integer, np.floating)):
-                close_price = float(close_price)
-            if isinstance(trading_date, np.datetime64):
-                trading_date = str(trading_date)
-            
-            # Xử lý thời gian để hiển thị chính xác hơn
-            if trading_date and trading_date != 'N/A':
-                # Kiểm tra nếu thời gian là 00:00:00 thì hiển thị là "đóng cửa"
-                if '00:00:00' in str(trading_date):
-                    # Lấy ngày từ trading_date
-                    date_only = str(trading_date).split(' ')[0]
-                    trading_date_display = f"{date_only} (đóng cửa)"
-                else:
-                    trading_date_display = str(trading_date)
-            else:
-                trading_date_display = "N/A"
-            
-            return close_price, f"method3 ({trading_date_display})"
-    except:
-        pass
-    return None
+# Method có bản asyncio; các method còn lại (vnstock, requests) chạy trong thread pool lấy giá
+ASYNC_REALTIME_METHODS = {
+    'webscrape': get_realtime_price_webscrape_async,
+}
+_async_source_semaphores = {}
+
+def _in_fetch_executor(func, *args):
+    """Chạy hàm blocking trong thread pool lấy giá, trả về awaitable"""
+    return asyncio.get_running_loop().run_in_executor(_get_fetch_executor(), func, *args)
+
+async def _call_source_async(source, ticker_clean, http):
+    """Phiên bản asyncio của _call_source"""
+    async_func = ASYNC_REALTIME_METHODS.get(source)
+    if async_func is None:
+        return await _in_fetch_executor(_call_source, source, REALTIME_METHODS[source], ticker_clean)
+    
+    semaphore = _async_source_semaphores.get(source)
+    if semaphore is None:
+        semaphore = _async_source_semaphores[source] = asyncio.Semaphore(SOURCE_CONCURRENCY[source])
+    async with semaphore:
+        started = time_module.monotonic()
+        try:
+            result = await async_func(ticker_clean, http)
+        except Exception:
+            _record_attempt(source, ticker_clean, None, time_module.monotonic() - started, raised=True)
+            record_method_result(ticker_clean, source, False)
+            raise
+    _record_attempt(source, ticker_clean, result, time_module.monotonic() - started)
+    record_method_result(ticker_clean, source, result is not None and result.has_price)
+    return result
+
+async def fetch_ticker_price_async(ticker_clean, http):
+    """Phiên bản asyncio của fetch_ticker_price (cùng thứ tự fallback)"""
+    if not is_market_open():
+        return await _in_fetch_executor(_call_source, 'closing', get_closing_price, ticker_clean)
+    
+    sources = _source_router.order(REALTIME_METHODS, _ticker_class(ticker_clean))
+    depth = 0
+    if HEDGE_ENABLED and len(sources) >= 2:
+        result, tried_sources = await _in_fetch_executor(fetch_hedged, ticker_clean, sources[0], sources[1])
+        depth = len(tried_sources)
+        if not _needs_fallback(result):
+            _metrics.record_depth('realtime', depth)
+            return result
+        sources = [source for source in sources if source not in tried_sources]
+    
+    for source in sources:
+        depth += 1
+        quote = await _call_source_async(source, ticker_clean, http)
+        if not _needs_fallback(quote):
+            _metrics.record_depth('realtime', depth)
+            return quote
+        logger.debug("  - %s: 🔄 %s không có dữ liệu mới, thử method khác...", ticker_clean, source)
+    
+    logger.debug("  - %s: ⚠️ Fallback sang closing price...", ticker_clean)
+    _metrics.record_depth('realtime', depth + 1)
+    return await _in_fetch_executor(_call_source, 'closing', get_closing_price, ticker_clean)
+
+async def fetch_prices_async(tickers_clean, http, on_result=None):
+    """Phiên bản asyncio của fetch_prices_concurrently: mỗi mã là 1 task
+
+    Task chưa xong khi hết hạn chót của chu kỳ bị hủy và trả về Quote STATUS_ERROR.
+    """
+    tasks = [asyncio.ensure_future(fetch_ticker_price_async(ticker_clean, http)) for ticker_clean in tickers_clean]
+    if on_result is not None:
+        for ticker_clean, task in zip(tickers_clean, tasks):
+            task.add_done_callback(_result_callback(ticker_clean, on_result))
+    if not tasks:
+        return []
+    done, pending = await asyncio.wait(tasks, timeout=max(remaining_cycle_time(), 0))
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.warning(f"⏱️ {len(pending)} mã chưa lấy xong giá trước hạn chót của chu kỳ ({FETCH_CYCLE_TIMEOUT} giây)")
+    
+    results = []
+    for task in tasks:
+        if task in done:
+            error = task.exception()
+            results.append(task.result() if error is None else error_quote('fetch', str(error)))
+        else:
+            results.append(error_quote('fetch', f"fetch timeout after {FETCH_CYCLE_TIMEOUT} seconds"))
+    return results
 
 # ====== 4. KẾT NỐI GOOGLE SHEETS ======
-def connect_google_sheets():
-    """Kết nối đến Google Sheets sử dụng credentials từ biến môi trường"""
-    global _worksheet_cache
+class SheetTarget:
+    """1 nơi ghi giá: worksheet trong 1 spreadsheet, cột chứa mã và cột ghi giá
+
+    intraday_columns ({cột: trường}) thay cho INTRADAY_COLUMN_FIELDS khi
+    worksheet dùng bố cục cột khác.
+    """
+
+    def __init__(self, url=SHEET_URL, worksheet="Data_CP", ticker_column='C', price_column='H', intraday_columns=None):
+        self.url = url
+        self.worksheet_name = worksheet
+        self.ticker_column = ticker_column.upper()
+        self.price_column = price_column.upper()
+        self.intraday_columns = OrderedDict(intraday_columns) if intraday_columns else None
+        self.worksheet = None
+
+    @property
+    def key(self):
+        return self.url, self.worksheet_name
+
+    @property
+    def name(self):
+        """Tên ngắn dùng trong log: worksheet và 8 ký tự đầu của ID spreadsheet"""
+        sheet_id = self.url.split('/d/')[-1].split('/')[0]
+        return f"{self.worksheet_name}@{sheet_id[:8]}"
+
+def load_sheet_targets():
+    """Danh sách SheetTarget từ SHEET_TARGETS_FILE; mặc định 1 target là Data_CP của SHEET_URL (cột C/H)
+
+    File là 1 list JSON, mỗi phần tử gồm "url", "worksheet", "ticker_column",
+    "price_column" (có thể bỏ qua trường nào dùng giá trị mặc định).
+    """
+    if os.path.exists(SHEET_TARGETS_FILE):
+        try:
+            with open(SHEET_TARGETS_FILE, 'r', encoding='utf-8') as f:
+                targets = [SheetTarget(**entry) for entry in json.load(f)]
+            if targets:
+                logger.info(f"📑 Đã nạp {len(targets)} nơi ghi giá từ {SHEET_TARGETS_FILE}")
+                return targets
+        except Exception as e:
+            logger.warning(f"⚠️ Không thể đọc {SHEET_TARGETS_FILE}: {e}")
+    return [SheetTarget()]
+
+def _authorize_sheets():
+    """gspread client dùng chung cho mọi spreadsheet (xác thực 1 lần), None nếu không có credentials"""
+    global _sheets_client
     
-    # Sử dụng cache nếu đã có
-    if _worksheet_cache is not None:
-        return _worksheet_cache
+    if _sheets_client is not None:
+        return _sheets_client
     
     try:
         # Lấy credentials từ biến môi trường (GitHub Actions)
@@ -772,16 +2853,16 @@ def connect_google_sheets():
                     try:
                         with open(file_path, 'r') as f:
                             credentials_json = f.read()
-                        print(f"✅ Đã tìm thấy credentials trong file: {file_path}")
+                        logger.info(f"✅ Đã tìm thấy credentials trong file: {file_path}")
                         if file_path == 'GOOGLE_CREDENTIALS_.json':
-                            print("🔧 Sử dụng GitHub Actions credentials")
+                            logger.info("🔧 Sử dụng GitHub Actions credentials")
                         break
                     except Exception as e:
-                        print(f"⚠️ Không thể đọc file {file_path}: {e}")
+                        logger.warning(f"⚠️ Không thể đọc file {file_path}: {e}")
                         continue
             
             if not credentials_json:
-                print("❌ Không tìm thấy Google credentials. Vui lòng cấu hình GOOGLE_CREDENTIALS_JSON.")
+                logger.error("❌ Không tìm thấy Google credentials. Vui lòng cấu hình GOOGLE_CREDENTIALS_JSON.")
                 return None
         
         # Parse JSON credentials
@@ -800,364 +2881,1018 @@ def connect_google_sheets():
         # Thiết lập timeout cho Google Sheets API
         client.timeout = 30  # 30 giây timeout
         
-        spreadsheet = client.open_by_url(SHEET_URL)
-        worksheet = spreadsheet.worksheet("Data_CP")
-        
-        # Cache worksheet để tái sử dụng
-        _worksheet_cache = worksheet
-        
-        print("✅ Kết nối Google Sheets thành công!")
-        return worksheet
+        _sheets_client = client
+        return client
     except Exception as e:
-        print(f"❌ Lỗi khi kết nối Google Sheets: {e}")
+        logger.error(f"❌ Lỗi khi xác thực Google Sheets: {e}")
         return None
 
-# ====== 5. CẬP NHẬT GIÁ CỔ PHIẾU ======
-def update_stock_prices(worksheet):
-    """Cập nhật giá cổ phiếu vào Google Sheets"""
-    try:
-        # Lấy danh sách mã cổ phiếu từ cột C
-        tickers = worksheet.col_values(3)[1:]  # Bỏ qua header
-        
-        # Lọc bỏ các mã rỗng
-        tickers = [ticker for ticker in tickers if ticker and str(ticker).strip()]
+def connect_google_sheets():
+    """Kết nối đến các worksheet trong danh sách nơi ghi giá
+
+    Trả về list SheetTarget đã kết nối (None nếu không kết nối được target nào).
+    Target lỗi được bỏ qua và thử kết nối lại ở lần gọi sau.
+    """
+    global _sheet_targets
+    
+    if _sheet_targets is None:
+        _sheet_targets = load_sheet_targets()
+    
+    # Chỉ kết nối các worksheet chưa có trong cache
+    missing = [target for target in _sheet_targets if target.key not in _worksheet_cache]
+    if missing:
+        client = _authorize_sheets()
+        if client is None:
+            missing = []
+        spreadsheets = {}
+        for target in missing:
+            try:
+                if target.url not in spreadsheets:
+                    spreadsheets[target.url] = client.open_by_url(target.url)
+                _worksheet_cache[target.key] = spreadsheets[target.url].worksheet(target.worksheet_name)
+                logger.info(f"✅ Kết nối Google Sheets thành công! ({target.name})")
+            except Exception as e:
+                logger.error(f"❌ Lỗi khi kết nối Google Sheets ({target.name}): {e}")
+    
+    connected = []
+    for target in _sheet_targets:
+        target.worksheet = _worksheet_cache.get(target.key)
+        if target.worksheet is not None:
+            connected.append(target)
+    return connected or None
+
+# ====== 4.1. GHI GIÁ VÀO GOOGLE SHEETS ======
+class SheetWriter:
+    """Ghi cột giá (và các cột phụ) vào worksheet, chỉ gửi các ô thay đổi so với lần ghi trước
+
+    Giữ bản sao (mirror) của các ô đã ghi; các ô thay đổi được gom thành những
+    range liên tiếp và gửi trong 1 lần batch_update. Lần ghi đầu tiên (hoặc sau
+    khi ghi lỗi) gửi toàn bộ vì chưa biết nội dung trên sheet.
+    """
+
+    def __init__(self, worksheet, column='H'):
+        self.worksheet = worksheet
+        self.column = column
+        self._mirror = {}  # (cột, số dòng) -> giá trị đã ghi
+
+    def changed_ranges(self, values_by_row, column=None):
+        """Gom các dòng có giá trị thay đổi thành list (dòng đầu, list giá trị liên tiếp)"""
+        column = column or self.column
+        changed_rows = sorted(row for row, value in values_by_row.items() if self._mirror.get((column, row), _UNSET) != value)
+        ranges = []
+        for row in changed_rows:
+            if ranges and ranges[-1][0] + len(ranges[-1][1]) == row:
+                ranges[-1][1].append(values_by_row[row])
+            else:
+                ranges.append((row, [values_by_row[row]]))
+        return ranges
+
+    @staticmethod
+    def _range_name(column, start_row, row_count):
+        if row_count == 1:
+            return f"{column}{start_row}"
+        return f"{column}{start_row}:{column}{start_row + row_count - 1}"
+
+    def write(self, values_by_row):
+        """Ghi các ô thay đổi của cột giá, trả về (số ô đã ghi, số range)"""
+        return self.write_columns({self.column: values_by_row})
+
+    def write_columns(self, values_by_column):
+        """Ghi các ô thay đổi của nhiều cột trong 1 lần batch_update; không gọi API nếu không có thay đổi"""
+        ranges = [
+            (column, start_row, values)
+            for column, values_by_row in values_by_column.items()
+            for start_row, values in self.changed_ranges(values_by_row, column)
+        ]
+        if not ranges:
+            return 0, 0
         
-        print(f"🔍 Tìm thấy {len(tickers)} mã cổ phiếu để cập nhật.")
+        data = [
+            {
+                'range': self._range_name(column, start_row, len(values)),
+                'values': [[value] for value in values],
+            }
+            for column, start_row, values in ranges
+        ]
+        try:
+            sheets_call(self.worksheet.batch_update, data)
+        except Exception:
+            # Không chắc sheet đã được ghi đến đâu: lần sau ghi lại toàn bộ
+            self.invalidate()
+            raise
         
-        # Sử dụng logic thông minh: realtime khi thị trường mở, đóng cửa khi thị trường đóng
-        mode = "smart"
-        print("🤖 Sử dụng LOGIC THÔNG MINH: Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
+        for column, start_row, values in ranges:
+            for offset, value in enumerate(values):
+                self._mirror[(column, start_row + offset)] = value
+        return sum(len(values) for _, _, values in ranges), len(ranges)
+
+    def invalidate(self):
+        """Xóa mirror để lần ghi sau gửi lại toàn bộ"""
+        self._mirror.clear()
+
+_UNSET = object()
+_sheet_writers = {}   # (worksheet, cột giá) -> SheetWriter
+
+def get_sheet_writer(worksheet, column='H'):
+    """SheetWriter của worksheet (tạo mới khi worksheet được kết nối lại)"""
+    key = (worksheet, column)
+    if key not in _sheet_writers:
+        _sheet_writers[key] = SheetWriter(worksheet, column)
+    return _sheet_writers[key]
+
+# ====== 4.2. DANH SÁCH MÃ TRÊN SHEET ======
+_listing_symbols = None
+_listing_checked_at = None
+LISTING_RETRY_SECONDS = 3600   # Thử tải lại sau (giây) khi chưa có danh sách nào
+
+def _read_listing_file():
+    """Đọc danh sách mã từ LISTING_FILE, trả về (set mã, thời điểm tải) hoặc (None, None)"""
+    try:
+        with open(LISTING_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return set(data['symbols']), datetime.fromisoformat(data['updated_at'])
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        logger.warning(f"⚠️ Không thể đọc {LISTING_FILE}: {e}")
+        return None, None
+
+def load_listing():
+    """Danh sách mã niêm yết (set), tải lại khi file cũ hơn LISTING_MAX_AGE_DAYS ngày
+
+    Chỉ dùng để cảnh báo mã lạ, không loại mã khỏi danh sách lấy giá.
+    Trả về None nếu không có danh sách nào dùng được.
+    """
+    global _listing_symbols, _listing_checked_at
+    if _listing_checked_at is not None:
+        recheck_seconds = LISTING_MAX_AGE_DAYS * 86400 if _listing_symbols else LISTING_RETRY_SECONDS
+        if time_module.monotonic() - _listing_checked_at < recheck_seconds:
+            return _listing_symbols
+    _listing_checked_at = time_module.monotonic()
+    
+    symbols, updated_at = _read_listing_file()
+    if symbols and datetime.now() - updated_at < timedelta(days=LISTING_MAX_AGE_DAYS):
+        _listing_symbols = symbols
+        return _listing_symbols
+    
+    try:
+        df = safe_vnstock_call(vnstock.listing_companies)
+        column = 'ticker' if 'ticker' in df.columns else 'symbol'
+        fresh_symbols = {str(symbol).strip().upper() for symbol in df[column].dropna()}
+        if fresh_symbols:
+            with open(LISTING_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'updated_at': datetime.now().isoformat(), 'symbols': sorted(fresh_symbols)}, f)
+            logger.info(f"📋 Đã tải danh sách {len(fresh_symbols)} mã niêm yết")
+            symbols = fresh_symbols
+    except Exception as e:
+        logger.warning(f"⚠️ Không thể tải danh sách mã niêm yết: {e}")
+    
+    # Lỗi khi tải: dùng danh sách cũ (trong file hoặc trong bộ nhớ)
+    _listing_symbols = symbols or _listing_symbols
+    return _listing_symbols
+
+class TickerIndex:
+    """Chỉ mục mã trên cột C: mỗi mã duy nhất -> các dòng trên sheet có mã đó
+
+    Dòng rỗng hoặc mã sai định dạng không được lấy giá; ô giá ở các dòng đó
+    được ghi rỗng. Mã không có trong danh sách niêm yết (file của vnstock có
+    thể cũ hơn các mã mới lên sàn) chỉ bị cảnh báo, vẫn được lấy giá.
+    """
+
+    def __init__(self, column_values, listing=None):
+        # column_values: giá trị cột C từ dòng 2 (đã bỏ header)
+        self.rows_by_ticker = OrderedDict()
+        self.invalid = {}   # mã -> các dòng (sai định dạng)
+        self.unlisted = []  # mã hợp lệ nhưng không có trong danh sách niêm yết
+        self.rows = list(range(2, len(column_values) + 2))
+        self.vacated_rows = set()   # dòng cuối vừa bị xóa khỏi cột mã: ghi rỗng 1 lần
+        for row, value in zip(self.rows, column_values):
+            ticker_clean = str(value).strip().upper() if value else ""
+            if not ticker_clean:
+                continue
+            if len(ticker_clean) < 2 or len(ticker_clean) > 5:
+                self.invalid.setdefault(ticker_clean, []).append(row)
+                continue
+            if listing and ticker_clean not in listing and ticker_clean not in self.rows_by_ticker:
+                self.unlisted.append(ticker_clean)
+            self.rows_by_ticker.setdefault(ticker_clean, []).append(row)
+
+    @property
+    def tickers(self):
+        """Các mã hợp lệ duy nhất, theo thứ tự xuất hiện trên sheet"""
+        return list(self.rows_by_ticker)
+
+    @property
+    def has_rows(self):
+        """Còn dòng cần ghi (kể cả dòng vừa bị bỏ trống)"""
+        return bool(self.rows or self.vacated_rows)
+
+    @property
+    def ticker_rows(self):
+        """Số dòng có mã hợp lệ (tính cả mã trùng)"""
+        return sum(len(rows) for rows in self.rows_by_ticker.values())
+
+    def spread(self, values_by_ticker):
+        """Trải giá theo mã ra từng dòng; dòng không có giá (và dòng vừa bị bỏ trống) được ghi rỗng"""
+        values_by_row = dict.fromkeys(sorted(set(self.rows) | self.vacated_rows), "")
+        for ticker_clean, rows in self.rows_by_ticker.items():
+            value = values_by_ticker.get(ticker_clean, "")
+            for row in rows:
+                values_by_row[row] = value
+        return values_by_row
+
+class TickerListWatcher:
+    """Giữ TickerIndex của cột mã (mặc định C), chỉ đọc lại cột sau mỗi TICKER_LIST_REFRESH giây
+
+    Thời gian sửa đổi của file không dùng được để phát hiện thay đổi (chính
+    script ghi giá mỗi phút), nên cột mã được đọc lại theo chu kỳ chậm hơn.
+    Khi danh sách thay đổi: mã bị xóa được bỏ khỏi cache giá, dòng không còn
+    mã được ghi rỗng; mã mới tự được lấy giá vì chưa có trong cache.
+    """
+
+    def __init__(self, worksheet, ticker_column='C', refresh_seconds=TICKER_LIST_REFRESH):
+        self.worksheet = worksheet
+        self.column_number = gspread.utils.a1_to_rowcol(f"{ticker_column}1")[1]
+        self.refresh_seconds = refresh_seconds
+        self.index = None
+        self._column_values = None
+        self._listing = None
+        self._refreshed_at = None
+
+    def invalidate(self):
+        """Đọc lại cột mã ở lần gọi current() tiếp theo"""
+        self._refreshed_at = None
+
+    def current(self):
+        """TickerIndex hiện tại, đọc lại cột mã nếu đã quá hạn"""
+        if self._refreshed_at is not None and time_module.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return self.index
         
-        # Lấy giá và cập nhật
-        prices_to_update = []
-        success_count = 0
-        error_count = 0
+        column_values = sheets_call(self.worksheet.col_values, self.column_number)[1:]  # Bỏ qua header
+        self._refreshed_at = time_module.monotonic()
+        listing = load_listing()
+        if self.index is not None and column_values == self._column_values and listing is self._listing:
+            return self.index
         
-        # Tối ưu hóa: xử lý batch để giảm thời gian
-        batch_size = 22  # Tăng batch size lên để xử lý tất cả mã cùng lúc
-        for i in range(0, len(tickers), batch_size):
-            batch_tickers = tickers[i:i+batch_size]
-            
-            for ticker in batch_tickers:
-                if not ticker:
-                    prices_to_update.append([""])
-                    continue
-                
-                ticker_clean = str(ticker).strip().upper()
-                
-                # Bỏ qua các mã không hợp lệ
-                if len(ticker_clean) < 2 or len(ticker_clean) > 5:
-                    prices_to_update.append([""])
+        index = TickerIndex(column_values, listing)
+        if index.unlisted:
+            logger.warning(f"⚠️ {len(index.unlisted)} mã không có trong danh sách niêm yết (vẫn lấy giá): {', '.join(index.unlisted[:10])}")
+        if self.index is not None:
+            added = set(index.rows_by_ticker) - set(self.index.rows_by_ticker)
+            removed = set(self.index.rows_by_ticker) - set(index.rows_by_ticker)
+            # Mã vẫn còn trên worksheet khác thì giữ lại trong cache
+            _price_cache.evict({
+                ticker_clean for ticker_clean in removed
+                if not any(
+                    watcher.index is not None and ticker_clean in watcher.index.rows_by_ticker
+                    for watcher in _ticker_watchers.values() if watcher is not self
+                )
+            })
+            # Dòng cuối bị xóa khỏi cột mã: ghi rỗng ô giá 1 lần (giữ cả dòng chưa ghi rỗng được)
+            index.vacated_rows = (set(self.index.rows) | self.index.vacated_rows) - set(index.rows)
+            logger.info(f"📝 Danh sách mã thay đổi: +{len(added)} / -{len(removed)} mã")
+        self.index = index
+        self._column_values = column_values
+        self._listing = listing
+        return index
+
+_ticker_watchers = {}   # (worksheet, cột mã) -> TickerListWatcher
+
+def get_ticker_watcher(worksheet, ticker_column='C'):
+    """TickerListWatcher của worksheet (tạo mới khi worksheet được kết nối lại)"""
+    key = (worksheet, ticker_column)
+    if key not in _ticker_watchers:
+        _ticker_watchers[key] = TickerListWatcher(worksheet, ticker_column)
+    return _ticker_watchers[key]
+
+# ====== 4.3. GHI GIÁ NGAY KHI CÓ KẾT QUẢ (STREAMING) ======
+class StreamingWriter:
+    """Gom giá vừa lấy được và ghi lên sheet theo từng đợt trong lúc chu kỳ đang chạy
+
+    Kết quả được đưa vào queue; 1 thread riêng gom lại và ghi khi đủ
+    STREAM_FLUSH_SIZE mã hoặc khi mã đầu tiên của đợt đã chờ
+    STREAM_FLUSH_INTERVAL giây (kể cả khi không còn kết quả mới đến), nên
+    không chặn luồng lấy giá hay event loop. Mỗi đợt được chuẩn hóa bằng
+    PriceBatch 1 lần và ghi qua SheetWriter của từng target (mỗi target 1 lần
+    batch_update). Chỉ ghi giá hợp lệ; cuối chu kỳ lần ghi đầy đủ chỉ gửi các
+    ô còn thay đổi.
+    """
+
+    def __init__(self, targets, reference_prices,
+                 flush_interval=STREAM_FLUSH_INTERVAL, flush_size=STREAM_FLUSH_SIZE):
+        self.targets = targets  # list (SheetWriter, TickerIndex)
+        self.reference_prices = reference_prices
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.flush_count = 0
+        self.cell_count = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="stream-write", daemon=True)
+        self._thread.start()
+
+    def add(self, ticker_clean, result):
+        """Thêm kết quả của 1 mã (ghi ở thread của writer)"""
+        self._queue.put((ticker_clean, result))
+
+    def _run(self):
+        buffered = {}
+        flush_at = None
+        while True:
+            timeout = None if not buffered else max(flush_at - time_module.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # Hết STREAM_FLUSH_INTERVAL: ghi phần đã gom
+            if item is _STREAM_CLOSE:
+                return  # Phần còn trong buffer để lần ghi cuối chu kỳ xử lý
+            if item is not None:
+                if not buffered:
+                    flush_at = time_module.monotonic() + self.flush_interval
+                ticker_clean, result = item
+                buffered[ticker_clean] = result
+                if len(buffered) < self.flush_size and time_module.monotonic() < flush_at:
                     continue
-                
-                try:
-                    # Kiểm tra thị trường có đang mở không
-                    if is_market_open():
-                        # Thị trường đang mở: ưu tiên realtime, thử nhiều method
-                        price, info = get_realtime_price(ticker_clean)
-                        
-                        # Nếu realtime không có dữ liệu hôm nay, thử các method khác
-                        if price in ['N/A', 'Lỗi', '', None] or '2025-08-26' in str(info):
-                            print(f"  - {ticker_clean}: 🔄 Thử method realtime khác...")
-                            # Thử method realtime khác
-                            price, info = get_realtime_price_alternative(ticker_clean)
-                            
-                            # Nếu vẫn không có, thử method force
-                            if price in ['N/A', 'Lỗi', '', None] or '2025-08-26' in str(info):
-                                print(f"  - {ticker_clean}: 🔥 Thử method force...")
-                                price, info = get_realtime_price_force(ticker_clean)
-                                
-                                # Nếu vẫn không có, thử web scraping
-                                if price in ['N/A', 'Lỗi', '', None] or '2025-08-26' in str(info):
-                                    print(f"  - {ticker_clean}: 🌐 Thử web scraping...")
-                                    price, info = get_realtime_price_webscrape(ticker_clean)
-                                    
-                                    # Nếu vẫn không có, mới fallback sang closing price
-                                    if price in ['N/A', 'Lỗi', '', None] or '2025-08-26' in str(info):
-                                        print(f"  - {ticker_clean}: ⚠️ Fallback sang closing price...")
-                                        price, info = get_closing_price(ticker_clean)
-                    else:
-                        # Thị trường đã đóng: lấy giá đóng cửa gần nhất
-                        price, info = get_closing_price(ticker_clean)
-                    
-                    # Xử lý trường hợp API trả về None
-                    if price is None:
-                        price = "N/A"
-                        info = "API trả về None"
-                    
-                    # Đảm bảo giá trị là string hoặc number, không phải numpy types
-                    if isinstance(price, (np.integer, np.floating)):
-                        price = float(price)
-                    elif isinstance(price, (int, float)):
-                        price = float(price)
-                    elif price not in ['N/A', 'Lỗi', '']:
-                        try:
-                            price = float(price)
-                        except (ValueError, TypeError):
-                            price = str(price)
-                    
-                    # Format giá trị để hiển thị đẹp hơn
-                    if isinstance(price, float):
-                        # Kiểm tra nếu giá quá lớn (có thể bị nhân 1000)
-                        if price > 10000:  # Nếu giá > 10,000 thì có thể bị nhân 1000
-                            price = price / 1000
-                        # Làm tròn đến 2 chữ số thập phân
-                        price = round(price, 2)
-                    
-                    # Đảm bảo giá trị hợp lệ trước khi thêm vào list
-                    if price not in ['N/A', 'Lỗi', '', None]:
-                        prices_to_update.append([price])
-                        success_count += 1
-                    else:
-                        prices_to_update.append([""])
-                        error_count += 1
-                    
-                    # Giảm logging để tăng tốc - chỉ log mỗi 50 mã và các mã quan trọng
-                    if i % 50 == 0 or ticker_clean in ['VCB', 'HPG', 'VNM', 'FPT']:
-                        print(f"  - {ticker_clean}: {price} ({info})")
-                        
-                except Exception as e:
-                    error_msg = str(e)
-                    if "timeout" in error_msg.lower():
-                        print(f"  - {ticker_clean}: ⏱️ Timeout - Thử method khác...")
-                    elif "connection" in error_msg.lower():
-                        print(f"  - {ticker_clean}: 🌐 Lỗi kết nối - {error_msg}")
-                    else:
-                        print(f"  - {ticker_clean}: ❌ Lỗi - {error_msg}")
-                    prices_to_update.append([""])
-                    error_count += 1
-        
-        # Cập nhật Google Sheets - sử dụng batch update để tăng tốc
-        if prices_to_update:
+            self._flush(buffered)
+            buffered = {}
+
+    def _flush(self, buffered):
+        tickers = list(buffered)
+        batch = PriceBatch(tickers, buffered, self.reference_prices, {})
+        payload = {
+            ticker_clean: price for ticker_clean, price in batch.payload().items() if price != ""
+        }
+        for sheet_writer, ticker_index in self.targets:
+            values_by_row = {
+                row: price
+                for ticker_clean, price in payload.items()
+                for row in ticker_index.rows_by_ticker.get(ticker_clean, ())
+            }
+            if not values_by_row:
+                continue
             try:
-                # Sử dụng batch update để tăng tốc
-                range_to_update = f"H2:H{len(prices_to_update) + 1}"
-                
-                # Đảm bảo tất cả giá trị đều hợp lệ
-                valid_prices = []
-                for price_list in prices_to_update:
-                    price = price_list[0] if price_list else ""
-                    if price and price not in ['N/A', 'Lỗi', '', None]:
-                        valid_prices.append([price])
-                    else:
-                        valid_prices.append([""])
-                
-                # Sử dụng named arguments để tránh deprecation warning
-                worksheet.update(values=valid_prices, range_name=range_to_update)
-                print(f"\n✅ Cập nhật thành công {success_count}/{len(tickers)} mã!")
-                if error_count > 0:
-                    print(f"⚠️ Có {error_count} mã bị lỗi")
-                
-                # Kiểm tra xem dữ liệu đã được cập nhật chưa
-                try:
-                    # Đọc lại một vài giá trị để kiểm tra
-                    check_range = f"H2:H{min(5, len(valid_prices) + 1)}"
-                    updated_values = worksheet.get(check_range)
-                    print(f"🔍 Kiểm tra cập nhật: {len(updated_values)} giá trị đã được lưu")
-                except Exception as check_error:
-                    print(f"⚠️ Không thể kiểm tra dữ liệu đã cập nhật: {check_error}")
-                
+                with _metrics.timer('stream_write'):
+                    changed_count, _ = sheet_writer.write(values_by_row)
             except Exception as e:
-                print(f"⚠️ Lỗi khi cập nhật Google Sheets: {e}")
-                print(f"🔍 Debug: Số lượng giá trị: {len(prices_to_update)}")
-                print(f"🔍 Debug: Giá trị đầu tiên: {prices_to_update[0] if prices_to_update else 'None'}")
-                
-                # Thử lại với phương pháp khác
-                try:
-                    print("🔄 Thử phương pháp cập nhật từng ô...")
-                    for i, price_list in enumerate(prices_to_update, start=2):
-                        price = price_list[0] if price_list else ""
-                        if price and price not in ['N/A', 'Lỗi', '', None]:
-                            # Sử dụng named arguments để tránh deprecation warning
-                            worksheet.update(values=[[price]], range_name=f'H{i}')
-                    print(f"✅ Cập nhật thành công với phương pháp thay thế!")
-                except Exception as e2:
-                    print(f"❌ Không thể cập nhật Google Sheets: {e2}")
-                    return False
-            
-            # Thống kê
-            success_rate = (success_count / len(tickers)) * 100 if tickers else 0
-            print(f"📊 Tỷ lệ thành công: {success_rate:.1f}%")
-            
-            # Thông báo thời gian
-            vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-            now = datetime.now(vn_tz)
-            if is_market_open():
-                mode_text = "REALTIME (thị trường đang mở)"
-            else:
-                mode_text = "ĐÓNG CỬA GẦN NHẤT (thị trường đã đóng)"
-            print(f"🕐 Thời gian cập nhật: {now.strftime('%H:%M:%S %d/%m/%Y')}")
-            print(f"📊 Chế độ sử dụng: {mode_text}")
-            
-            return True
-        else:
-            print("❌ Không có dữ liệu để cập nhật.")
+                logger.warning(f"⚠️ Lỗi ghi giá từng phần: {e}")
+                continue
+            if changed_count:
+                self.flush_count += 1
+                self.cell_count += changed_count
+
+    def close(self):
+        """Chờ đợt ghi đang chạy xong và dừng thread của writer"""
+        self._queue.put(_STREAM_CLOSE)
+        self._thread.join()
+        _metrics.set('stream_flushes', self.flush_count)
+        _metrics.set('stream_cells', self.cell_count)
+
+_STREAM_CLOSE = object()
+
+def _start_streaming(indexed_targets, plan):
+    """StreamingWriter của chu kỳ nếu bật STREAM_WRITES, None nếu không"""
+    if not STREAM_WRITES:
+        return None
+    return StreamingWriter(
+        [(get_sheet_writer(target.worksheet, target.price_column), ticker_index) for target, ticker_index in indexed_targets],
+        plan[2],
+    )
+
+# ====== 4.4. GHI GIÁ VÀO NHIỀU NƠI ======
+_sheets_executor = None
+
+def _get_sheets_executor():
+    """Thread pool đọc/ghi các target song song (quota vẫn do _rate_limiter kiểm soát)"""
+    global _sheets_executor
+    if _sheets_executor is None:
+        _sheets_executor = ThreadPoolExecutor(max_workers=SHEET_WRITE_WORKERS, thread_name_prefix="sheets")
+    return _sheets_executor
+
+def load_target_indexes(targets):
+    """Đọc danh sách mã của các target (song song)
+
+    Trả về (list (target, TickerIndex), danh sách mã hợp nhất theo thứ tự xuất
+    hiện) - mỗi mã chỉ được lấy giá 1 lần dù có trên nhiều sheet. Target đọc
+    lỗi được bỏ qua trong chu kỳ này.
+    """
+    load_listing()  # Nạp trước để các thread dùng chung 1 danh sách niêm yết
+    executor = _get_sheets_executor()
+    futures = [
+        (target, executor.submit(get_ticker_watcher(target.worksheet, target.ticker_column).current))
+        for target in targets
+    ]
+    indexed_targets = []
+    for target, future in futures:
+        try:
+            indexed_targets.append((target, future.result()))
+        except Exception as e:
+            logger.error(f"❌ Không đọc được danh sách mã ({target.name}): {e}")
+    tickers = list(OrderedDict.fromkeys(
+        ticker_clean for _, ticker_index in indexed_targets for ticker_clean in ticker_index.tickers
+    ))
+    return indexed_targets, tickers
+
+def _write_target(target, ticker_index, payload):
+    """Ghi cột giá (và các cột intraday nếu bật) của 1 target, trả về (số ô đã ghi, số range)"""
+    sheet_writer = get_sheet_writer(target.worksheet, target.price_column)
+    values_by_column = {sheet_writer.column: ticker_index.spread(payload)}
+    if INTRADAY_COLUMNS:
+        values_by_column.update(intraday_columns(ticker_index, target.intraday_columns))
+    result = sheet_writer.write_columns(values_by_column)
+    ticker_index.vacated_rows.clear()  # Đã ghi rỗng xong, các chu kỳ sau không ghi lại
+    return result
+
+def write_targets(indexed_targets, payload):
+    """Ghi giá của chu kỳ lên tất cả target song song
+
+    Trả về (tổng số ô đã ghi, tổng số range, số target lỗi). Target ghi lỗi
+    sẽ đọc lại danh sách mã và ghi lại toàn bộ ở chu kỳ sau.
+    """
+    executor = _get_sheets_executor()
+    futures = [
+        (target, executor.submit(_write_target, target, ticker_index, payload))
+        for target, ticker_index in indexed_targets if ticker_index.has_rows
+    ]
+    changed_count = range_count = failed_count = 0
+    for target, future in futures:
+        try:
+            target_changed, target_ranges = future.result()
+        except Exception as e:
+            logger.error(f"❌ Không thể cập nhật Google Sheets ({target.name}): {e}")
+            logger.warning("🔄 Chu kỳ sau sẽ đọc lại danh sách mã và ghi lại toàn bộ cột giá")
+            get_ticker_watcher(target.worksheet, target.ticker_column).invalidate()
+            failed_count += 1
+            continue
+        changed_count += target_changed
+        range_count += target_ranges
+    return changed_count, range_count, failed_count
+
+# ====== 5. CẬP NHẬT GIÁ CỔ PHIẾU ======
+def _begin_update_cycle():
+    """Bắt đầu 1 chu kỳ: đặt hạn chót, reset bộ đếm, trả về snapshot phiên giao dịch"""
+    # Hạn chót cho toàn bộ việc lấy giá của chu kỳ này
+    start_cycle_deadline(FETCH_CYCLE_TIMEOUT)
+    _source_router.reset_cycle_counters()
+    with _hedge_stats_lock:
+        _hedge_stats.update(launched=0, won=0)
+    
+    # Snapshot phiên giao dịch dùng chung cho mọi mã trong chu kỳ
+    session = refresh_market_session()
+    _history_loader.reset(session)
+    _intraday_store.begin_cycle(session)
+    utc_now = datetime.now(pytz.UTC)
+    logger.debug(f"🌍 Timezone Debug: UTC={utc_now.strftime('%H:%M:%S %d/%m/%Y')}, VN={session.now.strftime('%H:%M:%S %d/%m/%Y')}")
+    market_status = "MỞ" if session.is_open else "ĐÓNG"
+    logger.debug(f"📊 Thị trường: {market_status} (Phiên: {session.phase_name}, Ngày giao dịch gần nhất: {session.last_trading_day})")
+    return session
+
+def _plan_update(indexed_targets, tickers, session):
+    """Tách mã có giá trong cache và mã cần lấy giá (danh sách mã hợp nhất của mọi target)
+
+    Trả về (giá từ cache, mã cần lấy, giá tham chiếu, thời điểm bắt đầu).
+    """
+    row_count = sum(ticker_index.ticker_rows for _, ticker_index in indexed_targets)
+    logger.debug(f"🔍 Tìm thấy {len(tickers)} mã cổ phiếu để cập nhật ({row_count} dòng, {len(indexed_targets)} sheet).")
+    for target, ticker_index in indexed_targets:
+        if ticker_index.invalid:
+            logger.warning(f"⚠️ {target.name}: bỏ qua {len(ticker_index.invalid)} mã không hợp lệ: {', '.join(list(ticker_index.invalid)[:10])}")
+    
+    # Sử dụng logic thông minh: realtime khi thị trường mở, đóng cửa khi thị trường đóng
+    logger.debug("🤖 Sử dụng LOGIC THÔNG MINH: Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
+    
+    # Dùng giá trong cache nếu còn hạn (giá đóng cửa của phiên đã kết thúc không đổi)
+    cached_prices, tickers_to_fetch = get_cached_prices(tickers, session)
+    logger.debug(f"💾 Cache: {len(cached_prices)}/{len(tickers)} mã")
+    cycle_started_at = time_module.time()
+    
+    # Giá hợp lệ gần nhất trước chu kỳ này, dùng làm giá tham chiếu khi kiểm tra giá bất thường
+    reference_prices = {}
+    for ticker_clean in tickers:
+        last_good = _price_cache.last_good(ticker_clean)
+        if last_good is not None:
+            reference_prices[ticker_clean] = last_good.price
+    return cached_prices, tickers_to_fetch, reference_prices, cycle_started_at
+
+def _finish_update_cycle(indexed_targets, session, tickers, plan, batch_prices, leftover_tickers, fetch_results):
+    """Lưu giá, chuẩn hóa 1 lần và ghi lên mọi target; trả về True nếu ghi thành công ở tất cả target"""
+    cached_prices, tickers_to_fetch, reference_prices, cycle_started_at = plan
+    fetched_prices = dict(batch_prices)
+    fetched_prices.update(zip(leftover_tickers, fetch_results))
+    
+    # Mã chưa có giá hợp lệ nào trước đây: dùng giá đóng cửa phiên trước (nếu đã tải nến trong chu kỳ) làm tham chiếu
+    for ticker_clean in tickers:
+        if ticker_clean not in reference_prices:
+            previous_close = _history_loader.previous_close(ticker_clean, load=False)
+            if previous_close is not None:
+                reference_prices[ticker_clean] = previous_close
+    
+    # Giá ngoài biên chưa được xác nhận không vào cache/PriceStore; giá đã xác nhận được ghi như bình thường
+    held_tickers, confirmed_tickers = _band_guard.screen(fetched_prices, reference_prices)
+    for ticker_clean in confirmed_tickers:
+        reference_prices.pop(ticker_clean, None)
+        logger.info(f"📈 {ticker_clean}: giá ngoài biên được xác nhận lần 2, chấp nhận {fetched_prices[ticker_clean].price}")
+    
+    with _metrics.timer('store'):
+        stored_prices = store_prices(fetched_prices, session, from_price_board=batch_prices, held=held_tickers)
+        try:
+            _price_store.save_cycle(stored_prices)
+        except Exception as e:
+            logger.warning(f"⚠️ Không thể lưu giá vào {PRICE_STORE_FILE}: {e}")
+    
+    # Mã lỗi ở tất cả method: dùng giá hợp lệ gần nhất thay vì để trống
+    stale_count = apply_last_known_good(fetched_prices)
+    if stale_count:
+        logger.debug(f"⚠️ {stale_count} mã lỗi, dùng giá hợp lệ gần nhất (cũ)")
+    _metrics.set('history_downloads', _history_loader.downloads)
+    _metrics.set('intraday_requests', _intraday_store.requests)
+    
+    fetched_at = time_module.time()
+    timestamps = dict.fromkeys(cached_prices, cycle_started_at)
+    timestamps.update(dict.fromkeys(fetched_prices, fetched_at))
+    results_by_ticker = dict(cached_prices)
+    results_by_ticker.update(fetched_prices)
+    
+    # Chuẩn hóa giá (đơn vị, giá bất thường, làm tròn) trên mảng NumPy
+    with _metrics.timer('normalize'):
+        batch = PriceBatch(tickers, results_by_ticker, reference_prices, timestamps)
+    success_count = batch.count(STATUS_OK) + batch.count(STATUS_STALE) + batch.count(STATUS_OUT_OF_BAND)
+    error_count = len(tickers) - success_count
+    _metrics.set('tickers', len(tickers))
+    _metrics.set('rows', sum(ticker_index.ticker_rows for _, ticker_index in indexed_targets))
+    _metrics.set('targets', len(indexed_targets))
+    _metrics.set('cache_hits', len(cached_prices))
+    _metrics.set('price_board_hits', len(batch_prices))
+    _metrics.set('fetched_individually', len(leftover_tickers))
+    _metrics.set('stale', stale_count)
+    _metrics.set('out_of_band', batch.count(STATUS_OUT_OF_BAND))
+    _metrics.set('success', success_count)
+    _metrics.set('errors', error_count)
+    
+    # Giá bất thường luôn được cảnh báo; log từng mã chỉ khi bật DEBUG
+    for idx in np.flatnonzero(batch.status == STATUS_OUT_OF_BAND):
+        logger.warning("  - %s: ⚠️ Giá bất thường %.2f (%s), giữ giá %s", tickers[idx], batch.raw[idx], batch.label(idx), batch.price[idx])
+    if logger.isEnabledFor(logging.DEBUG):
+        for idx, ticker_clean in enumerate(tickers):
+            status = batch.status[idx]
+            if status == STATUS_ERROR:
+                error_msg = batch.label(idx)
+                if "timeout" in error_msg.lower():
+                    logger.debug("  - %s: ⏱️ Timeout - %s", ticker_clean, error_msg)
+                elif "connection" in error_msg.lower():
+                    logger.debug("  - %s: 🌐 Lỗi kết nối - %s", ticker_clean, error_msg)
+                else:
+                    logger.debug("  - %s: ❌ Lỗi - %s", ticker_clean, error_msg)
+            elif status != STATUS_OUT_OF_BAND:
+                price = batch.price[idx] if status in (STATUS_OK, STATUS_STALE) else "N/A"
+                logger.debug("  - %s: %s (%s)", ticker_clean, price, batch.label(idx))
+    
+    # Cập nhật Google Sheets - trải giá theo mã ra đúng dòng của từng target, chỉ ghi các ô thay đổi
+    if any(ticker_index.has_rows for _, ticker_index in indexed_targets):
+        if INTRADAY_COLUMNS:
+            refresh_intraday(tickers, session)
+        changed_count, range_count, failed_count = write_targets(indexed_targets, batch.payload())
+        _metrics.set('cells_written', changed_count)
+        if failed_count:
             return False
+        if changed_count:
+            logger.debug(f"✅ Cập nhật thành công {success_count}/{len(tickers)} mã! ({changed_count} ô thay đổi, {range_count} range)")
+        else:
+            logger.debug(f"✅ Lấy giá thành công {success_count}/{len(tickers)} mã, không có ô nào thay đổi (bỏ qua ghi)")
+        if error_count > 0:
+            logger.debug(f"⚠️ Có {error_count} mã bị lỗi")
+        
+        # Thống kê
+        success_rate = (success_count / len(tickers)) * 100 if tickers else 0
+        logger.debug(f"📊 Tỷ lệ thành công: {success_rate:.1f}%")
+        conn_stats = _client_registry.connection_stats()
+        logger.debug(f"🔌 HTTP pool: {conn_stats['requests']} request / {conn_stats['connections']} kết nối (tái sử dụng {conn_stats['reuse_rate']:.1f}%)")
+        logger.debug(f"💾 Cache giá: tỷ lệ hit {_price_cache.hit_rate():.1f}%")
+        _metrics.set('cache_hit_rate', round(_price_cache.hit_rate(), 1))
+        if HEDGE_ENABLED:
+            logger.debug(f"🔀 Hedge: {_hedge_stats['launched']} lần gửi, {_hedge_stats['won']} lần thắng")
+        throttled_hosts = _rate_limiter.throttled_hosts()
+        if throttled_hosts:
+            logger.debug("🚦 Đang giảm tốc: " + ", ".join(f"{host} {rate:.1f}/{max_rate:.0f} req/s" for host, (rate, max_rate) in throttled_hosts.items()))
+        open_methods = _source_router.open_methods()
+        logger.debug(f"🧭 Lần thử method thất bại: {_source_router.failed_attempts}" + (f" (tạm ngắt: {', '.join(open_methods)})" if open_methods else ""))
+        
+        # Thông báo thời gian
+        now = datetime.now(VN_TZ)
+        if session.is_open:
+            mode_text = f"REALTIME (thị trường đang mở - {session.phase_name})"
+        else:
+            mode_text = "ĐÓNG CỬA GẦN NHẤT (thị trường đã đóng)"
+        logger.debug(f"🕐 Thời gian cập nhật: {now.strftime('%H:%M:%S %d/%m/%Y')}")
+        logger.debug(f"📊 Chế độ sử dụng: {mode_text}")
+        
+        return True
+    else:
+        logger.error("❌ Không có dữ liệu để cập nhật.")
+        return False
+
+def update_stock_prices(targets):
+    """Cập nhật giá cổ phiếu vào Google Sheets (mọi target, mỗi mã chỉ lấy giá 1 lần)"""
+    session = _begin_update_cycle()
+    try:
+        # Danh sách mã từ cột mã của từng target (chỉ đọc lại từ sheet khi quá hạn)
+        indexed_targets, tickers = load_target_indexes(targets)
+        plan = _plan_update(indexed_targets, tickers, session)
+        tickers_to_fetch = plan[1]
+        stream = _start_streaming(indexed_targets, plan)
+        try:
+            # Lấy giá theo lô cho các mã chưa có trong cache
+            with _metrics.timer('price_board'):
+                batch_prices = get_batch_prices(tickers_to_fetch)
+            logger.debug(f"📦 Price board: {len(batch_prices)}/{len(tickers_to_fetch)} mã")
+            if stream is not None:
+                for ticker_clean, result in batch_prices.items():
+                    stream.add(ticker_clean, result)
+            
+            # Các mã còn lại lấy song song theo từng mã
+            leftover_tickers = [ticker_clean for ticker_clean in tickers_to_fetch if ticker_clean not in batch_prices]
+            with _metrics.timer('fetch'):
+                fetch_results = fetch_prices_concurrently(leftover_tickers, on_result=stream.add if stream else None)
+        finally:
+            # Luôn dừng thread ghi từng phần, kể cả khi chu kỳ lỗi giữa chừng
+            if stream is not None:
+                stream.close()
+        success = _finish_update_cycle(indexed_targets, session, tickers, plan, batch_prices, leftover_tickers, fetch_results)
+        return success and len(indexed_targets) == len(targets)
+    except Exception as e:
+        logger.error(f"❌ Lỗi khi cập nhật giá cổ phiếu: {e}")
+        return False
+
+async def update_stock_prices_async(targets, http):
+    """Phiên bản asyncio của update_stock_prices: gspread và vnstock chạy trong thread pool"""
+    session = _begin_update_cycle()
+    try:
+        indexed_targets, tickers = await asyncio.to_thread(load_target_indexes, targets)
+        plan = _plan_update(indexed_targets, tickers, session)
+        tickers_to_fetch = plan[1]
+        stream = _start_streaming(indexed_targets, plan)
+        try:
+            with _metrics.timer('price_board'):
+                batch_prices = await asyncio.to_thread(get_batch_prices, tickers_to_fetch)
+            logger.debug(f"📦 Price board: {len(batch_prices)}/{len(tickers_to_fetch)} mã")
+            if stream is not None:
+                for ticker_clean, result in batch_prices.items():
+                    stream.add(ticker_clean, result)
             
+            leftover_tickers = [ticker_clean for ticker_clean in tickers_to_fetch if ticker_clean not in batch_prices]
+            with _metrics.timer('fetch'):
+                fetch_results = await fetch_prices_async(leftover_tickers, http, on_result=stream.add if stream else None)
+        finally:
+            if stream is not None:
+                await asyncio.to_thread(stream.close)
+        success = await asyncio.to_thread(
+            _finish_update_cycle, indexed_targets, session, tickers, plan, batch_prices, leftover_tickers, fetch_results
+        )
+        return success and len(indexed_targets) == len(targets)
     except Exception as e:
-        print(f"❌ Lỗi khi cập nhật giá cổ phiếu: {e}")
+        logger.error(f"❌ Lỗi khi cập nhật giá cổ phiếu: {e}")
         return False
 
-# ====== 6. HÀM CHÍNH CHẠY AUTO CẬP NHẬT ======
+# ====== 6. LỊCH CẬP NHẬT THEO PHIÊN GIAO DỊCH ======
+def settled_refresh_key(session):
+    """Khóa của lần cập nhật duy nhất cần làm khi giá không đổi (None nếu đang khớp lệnh)
+
+    Nghỉ trưa: 1 lần cho buổi sáng của ngày giao dịch.
+    Ngoài giờ: 1 lần giá đóng cửa cho ngày giao dịch gần nhất.
+    """
+    if session.is_trading:
+        return None
+    if session.phase == SESSION_LUNCH_BREAK:
+        return ('lunch', session.trading_date)
+    return ('close', session.last_trading_day)
+
+def closing_refresh_time(session):
+    """Thời điểm lấy giá đóng cửa sau ATC (đợi phiên thỏa thuận kết thúc để giá ổn định)"""
+    if session.phase == SESSION_CLOSED and session.trading_date is not None:
+        refresh_at = VN_TZ.localize(datetime.combine(session.trading_date, CLOSING_REFRESH_TIME))
+        if session.now < refresh_at:
+            return refresh_at
+    return None
+
+def next_update_delay(session, refreshed):
+    """Số giây chờ trước lần kiểm tra tiếp theo
+
+    Đang khớp lệnh (hoặc lần cập nhật ngoài giờ chưa thành công): FAST_POLL_INTERVAL.
+    Còn lại: ngủ đến phiên kế tiếp.
+    """
+    if session.is_trading or not refreshed:
+        return random.uniform(*FAST_POLL_INTERVAL)
+    wake_at = session.next_phase_start()
+    return max((wake_at - session.now).total_seconds(), 1)
+
+def format_cycle_summary(loop_count, session, success, record, duration, next_update):
+    """1 dòng tóm tắt chu kỳ (mức INFO), lấy số liệu từ metrics của chu kỳ"""
+    status_icon = "✅" if success else "⚠️"
+    return (
+        f"{status_icon} #{loop_count} {session.phase_name}: "
+        f"{record.get('success', 0)}/{record.get('tickers', 0)} mã, "
+        f"{record.get('cells_written', 0)} ô ghi, cache {record.get('cache_hits', 0)}, "
+        f"cũ {record.get('stale', 0)}, lỗi {record.get('errors', 0)} | "
+        f"{duration:.1f}s | tiếp theo {next_update.strftime('%H:%M:%S')}"
+    )
+
+# ====== 7. HÀM CHÍNH CHẠY AUTO CẬP NHẬT ======
 def run_auto_update():
     """Chạy auto cập nhật vô thời hạn cho đến khi cancel thủ công"""
-    global _start_time, _restart_count
+    global _start_time, _restart_count, _error_count, _loop_count
+    
+    logger.info("🚀 BẮT ĐẦU AUTO CẬP NHẬT GIÁ CỔ PHIẾU")
+    logger.info("⏰ Chế độ: Vô thời hạn (chạy cho đến khi cancel thủ công)")
+    logger.info("🔄 Chế độ: LOGIC THÔNG MINH - Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
+    logger.info("⏱️ Khoảng thời gian: 1 phút giữa các lần cập nhật")
+    logger.info("🛑 Để dừng: Cancel workflow trong GitHub Actions")
+    logger.info("⚠️ Tự động restart trước 6 giờ để tránh timeout")
+    logger.info("🔧 Đã sửa lỗi: Timeout, Connection, API compatibility")
+    logger.info("⏱️ Timeout: 5 giây cho mỗi API call")
+    logger.info("🔄 Retry: 2 lần cho mỗi request")
+    logger.info("🌐 Network check: Tự động kiểm tra kết nối mạng")
+    logger.info("🛠️ Error handling: Cải thiện xử lý lỗi và logging")
+    logger.info("⚡ Tối ưu hóa tốc độ: Batch processing, giảm delay")
+    logger.info("📈 Performance: Theo dõi thời gian cập nhật")
+    logger.info("🚀 Tốc độ: Nhanh hơn 50% so với realtime")
+    logger.info("🛡️ Fallback: 3 methods khác nhau khi API timeout")
+    logger.info("🔍 Debug: Hiển thị chi tiết lỗi timeout")
+    logger.info("="*60)
     
-    print("🚀 BẮT ĐẦU AUTO CẬP NHẬT GIÁ CỔ PHIẾU")
-    print("⏰ Chế độ: Vô thời hạn (chạy cho đến khi cancel thủ công)")
-    print("🔄 Chế độ: LOGIC THÔNG MINH - Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
-    print("⏱️ Khoảng thời gian: 1 phút giữa các lần cập nhật")
-    print("🛑 Để dừng: Cancel workflow trong GitHub Actions")
-    print("⚠️ Tự động restart trước 6 giờ để tránh timeout")
-    print("🔧 Đã sửa lỗi: Timeout, Connection, API compatibility")
-    print("⏱️ Timeout: 5 giây cho mỗi API call")
-    print("🔄 Retry: 2 lần cho mỗi request")
-    print("🌐 Network check: Tự động kiểm tra kết nối mạng")
-    print("🛠️ Error handling: Cải thiện xử lý lỗi và logging")
-    print("⚡ Tối ưu hóa tốc độ: Batch processing, giảm delay")
-    print("📈 Performance: Theo dõi thời gian cập nhật")
-    print("🚀 Tốc độ: Nhanh hơn 50% so với realtime")
-    print("🛡️ Fallback: 3 methods khác nhau khi API timeout")
-    print("🔍 Debug: Hiển thị chi tiết lỗi timeout")
-    print("="*60)
+    install_transport_timeout()
     
-    # Load restart count
+    # Load restart count và lịch nghỉ giao dịch
     load_restart_count()
+    load_market_holidays()
+    load_price_store()
+    load_listing()
     
     # Ghi lại thời gian bắt đầu
     _start_time = datetime.now()
     
-    print(f"📊 Restart count hiện tại: {_restart_count} (vô hạn)")
+    logger.info(f"📊 Restart count hiện tại: {_restart_count} (vô hạn)")
     
     # Tính thời gian tổng cộng đã chạy
     total_runtime_hours = (_restart_count * _max_runtime_minutes) / 60
     if _restart_count > 0:
-        print(f"⏰ Thời gian tổng cộng đã chạy: {total_runtime_hours:.1f} giờ")
+        logger.info(f"⏰ Thời gian tổng cộng đã chạy: {total_runtime_hours:.1f} giờ")
     
     # Kết nối Google Sheets
-    worksheet = connect_google_sheets()
-    if not worksheet:
-        print("❌ Không thể kết nối Google Sheets. Thoát chương trình.")
+    targets = connect_google_sheets()
+    if not targets:
+        logger.error("❌ Không thể kết nối Google Sheets. Thoát chương trình.")
         return
     
-    # Kiểm tra kết nối mạng
-    print("🌐 Kiểm tra kết nối mạng...")
+    _loop_count = 0
+    try:
+        if ASYNC_MODE:
+            if aiohttp is None:
+                logger.warning("⚠️ Chế độ asyncio nhưng chưa cài aiohttp (pip install -r requirements.txt): request HTTP chạy bằng requests trong thread pool, không song song trên event loop")
+            http_mode = "aiohttp" if aiohttp is not None else "requests trong thread pool"
+            logger.info(f"⚡ Chế độ asyncio: 1 event loop, HTTP bất đồng bộ bằng {http_mode}")
+            asyncio.run(_auto_update_loop_async(targets))
+        else:
+            _auto_update_loop(targets)
+    except KeyboardInterrupt:
+        logger.info(f"🛑 ĐÃ DỪNG AUTO CẬP NHẬT (Cancel thủ công)")
+        logger.info(f"📊 Tổng số lần cập nhật: {_loop_count}")
+    except Exception as e:
+        logger.error(f"❌ Lỗi trong auto cập nhật: {e}")
+        logger.info(f"📊 Đã chạy được {_loop_count} lần cập nhật")
+        logger.info("🔄 Thử lại sau 30 giây...")
+        time_module.sleep(30)
+        logger.info("🔄 Khởi động lại auto cập nhật...")
+        run_auto_update()
+
+_loop_count = 0
+
+def _log_network_status():
     if not check_network_connection():
-        print("⚠️ Cảnh báo: Kết nối mạng có thể không ổn định")
+        logger.warning("⚠️ Cảnh báo: Kết nối mạng có thể không ổn định")
     else:
-        print("✅ Kết nối mạng ổn định")
+        logger.info("✅ Kết nối mạng ổn định")
+
+def _enforce_runtime_limit():
+    """Thoát với exit code 100 (tín hiệu restart) khi sắp hết thời gian tối đa của GitHub Actions"""
+    global _restart_count
+    if not _start_time:
+        return
+    runtime_minutes = (datetime.now() - _start_time).total_seconds() / 60
+    if runtime_minutes >= _max_runtime_minutes:
+        _restart_count += 1
+        logger.info(f"⚠️ Đã chạy được {runtime_minutes:.1f} phút (gần 6 giờ)")
+        logger.info(f"🔄 Tự động restart #{_restart_count} để tránh GitHub Actions timeout...")
+        logger.info(f"📊 Tổng số lần cập nhật: {_loop_count}")
+        logger.info(f"📊 Số lần restart: {_restart_count} (vô hạn)")
+        logger.info(f"⏰ Thời gian chạy: {runtime_minutes:.1f} phút / {_max_runtime_minutes} phút")
+        
+        logger.info("🔄 Khởi động lại workflow...")
+        logger.info("💡 Workflow sẽ được restart tự động bởi GitHub Actions schedule")
+        logger.info("📊 Exit code 100 là bình thường - đây là tín hiệu restart")
+        
+        # Lưu restart count trước khi exit
+        save_restart_count()
+        shutdown_logging()
+        # Trigger restart bằng cách exit với code đặc biệt
+        os._exit(100)  # Exit code 100 để trigger restart
+
+def _idle_wait(session, now, last_settled_refresh):
+    """Quyết định có cần cập nhật không theo phiên giao dịch
+
+    Trả về None nếu cần cập nhật ngay, nếu không trả về (số giây chờ, có tạm
+    dừng health monitor trong lúc chờ không).
+    """
+    refresh_key = settled_refresh_key(session)
+    closing_wait = closing_refresh_time(session)
+    if closing_wait is not None:
+        # Sau ATC: đợi giá đóng cửa ổn định rồi mới cập nhật
+        logger.info(f"⏳ {session.phase_name}: chờ đến {closing_wait.strftime('%H:%M')} để lấy giá đóng cửa...")
+        return _cap_sleep_to_runtime((closing_wait - now).total_seconds()), False
+    if refresh_key is not None and refresh_key == last_settled_refresh:
+        # Giá không đổi cho đến phiên kế tiếp: ngủ, không gọi API
+        wake_at = session.next_phase_start()
+        sleep_seconds = _cap_sleep_to_runtime(next_update_delay(session, True))
+        logger.info(f"💤 {session.phase_name}: giá đã cập nhật, chờ đến {wake_at.strftime('%H:%M %d/%m/%Y')} ({sleep_seconds / 60:.0f} phút)...")
+        return sleep_seconds, True
+    return None
+
+def _log_cycle_header(now):
+    logger.debug(f"🔄 LẦN CẬP NHẬT THỨ {_loop_count}")
+    logger.debug(f"🕐 Thời gian: {now.strftime('%H:%M:%S %d/%m/%Y')}")
+    logger.debug(f"📊 Thời gian chạy: {_loop_count} phút")
+    if _start_time:
+        runtime_minutes = (datetime.now() - _start_time).total_seconds() / 60
+        remaining_minutes = _max_runtime_minutes - runtime_minutes
+        logger.debug(f"⏰ Runtime: {runtime_minutes:.1f} phút / {_max_runtime_minutes} phút")
+        logger.debug(f"⏰ Thời gian còn lại trước restart: {remaining_minutes:.1f} phút")
+    logger.debug("-" * 40)
+
+def _after_update(session, success, update_duration, targets):
+    """Ghi metrics và xử lý kết quả chu kỳ
+
+    Trả về (list target đã kết nối, số giây chờ thêm khi lỗi liên tục quá nhiều).
+    """
+    global _error_count
+    _metrics.set('loop', _loop_count)
+    _metrics.set('phase', session.phase_name)
+    _metrics.set('ok', bool(success))
+    
+    if success:
+        logger.debug(f"✅ Cập nhật thành công! (Thời gian: {update_duration:.1f} giây)")
+        _error_count = 0  # Reset error count khi thành công
+        return targets, 0
+    
+    logger.warning(f"⚠️ Cập nhật không thành công, thử lại sau... (Thời gian: {update_duration:.1f} giây)")
+    _error_count += 1
+    logger.warning(f"⚠️ Lỗi liên tục: {_error_count}/{_max_errors}")
+    
+    # Thử kết nối lại Google Sheets nếu cần
+    targets = connect_google_sheets()
+    if not targets:
+        logger.error("❌ Không thể kết nối lại Google Sheets. Thử lại sau...")
+        _error_count += 1
     
-    loop_count = 0
+    # Nếu quá nhiều lỗi liên tục, restart
+    if _error_count >= _max_errors:
+        logger.warning("🔄 Quá nhiều lỗi liên tục. Khởi động lại...")
+        _error_count = 0
+        return targets, 60  # Chờ 1 phút trước khi restart
+    return targets, 0
+
+def _next_update(session, success, update_duration, cycle_record):
+    """Tính thời gian chờ tiếp theo theo phiên giao dịch và log tóm tắt chu kỳ"""
+    logger.debug("=" * 60)
+    delay = _cap_sleep_to_runtime(next_update_delay(session, success))
+    next_update = datetime.now(VN_TZ) + timedelta(seconds=delay)
+    logger.debug(f"⏰ Lần cập nhật tiếp theo: {next_update.strftime('%H:%M:%S %d/%m/%Y')}")
+    logger.debug(f"⏳ Đang chờ {delay:.1f} giây...")
+    logger.info(format_cycle_summary(_loop_count, session, success, cycle_record, update_duration, next_update))
+    return delay
+
+def _auto_update_loop(targets):
+    """Vòng cập nhật dùng thread (mặc định)"""
+    global _loop_count
+    # Kiểm tra kết nối mạng, sau đó health monitor tiếp tục kiểm tra định kỳ trong nền
+    logger.info("🌐 Kiểm tra kết nối mạng...")
+    _health_monitor.start()
+    _log_network_status()
+    
+    _last_settled_refresh = None  # Lần cập nhật ngoài giờ khớp lệnh gần nhất
+    while True:  # Chạy vô thời hạn
+        _loop_count += 1
+        now = datetime.now(VN_TZ)
+        
+        # Kiểm tra thời gian chạy để tránh timeout
+        _enforce_runtime_limit()
+        
+        session = get_market_session(now)
+        idle = _idle_wait(session, now, _last_settled_refresh)
+        if idle is not None:
+            sleep_seconds, pause_monitor = idle
+            if pause_monitor:
+                _health_monitor.pause()
+            with _metrics.timer('sleep'):
+                time_module.sleep(sleep_seconds)
+            if pause_monitor:
+                _health_monitor.resume()
+            continue
+        
+        _log_cycle_header(now)
+        
+        # Cập nhật giá cổ phiếu
+        start_time = time_module.time()
+        with _metrics.timer('update'):
+            success = update_stock_prices(targets)
+        update_duration = time_module.time() - start_time
+        
+        targets, backoff = _after_update(session, success, update_duration, targets)
+        cycle_record = _metrics.flush()
+        refresh_key = settled_refresh_key(session)
+        if success and refresh_key is not None:
+            _last_settled_refresh = refresh_key
+        if backoff:
+            time_module.sleep(backoff)
+        
+        delay = _next_update(session, success, update_duration, cycle_record)
+        with _metrics.timer('sleep'):
+            time_module.sleep(delay)
+
+async def _auto_update_loop_async(targets):
+    """Vòng cập nhật chế độ asyncio: 1 event loop, ngủ bằng asyncio.sleep, health probe là 1 task"""
+    global _loop_count
+    _async_source_semaphores.clear()  # Semaphore gắn với event loop đã tạo ra nó
+    http = AsyncHttpClient()
+    logger.info("🌐 Kiểm tra kết nối mạng...")
+    await _health_monitor.check_all_async(http, force=True)
+    monitor_task = asyncio.ensure_future(_health_monitor.run_async(http))
+    _log_network_status()
     
+    _last_settled_refresh = None
     try:
-        while True:  # Chạy vô thời hạn
-            loop_count += 1
-            vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-            now = datetime.now(vn_tz)
+        while True:
+            _loop_count += 1
+            now = datetime.now(VN_TZ)
+            _enforce_runtime_limit()
             
-            # Kiểm tra thời gian chạy để tránh timeout
-            if _start_time:
-                runtime_minutes = (datetime.now() - _start_time).total_seconds() / 60
-                if runtime_minutes >= _max_runtime_minutes:
-                    _restart_count += 1
-                    print(f"\n⚠️ Đã chạy được {runtime_minutes:.1f} phút (gần 6 giờ)")
-                    print(f"🔄 Tự động restart #{_restart_count} để tránh GitHub Actions timeout...")
-                    print(f"📊 Tổng số lần cập nhật: {loop_count}")
-                    print(f"📊 Số lần restart: {_restart_count} (vô hạn)")
-                    print(f"⏰ Thời gian chạy: {runtime_minutes:.1f} phút / {_max_runtime_minutes} phút")
-                    
-                    print("🔄 Khởi động lại workflow...")
-                    print("💡 Workflow sẽ được restart tự động bởi GitHub Actions schedule")
-                    print("📊 Exit code 100 là bình thường - đây là tín hiệu restart")
-                    
-                    # Lưu restart count trước khi exit
-                    save_restart_count()
-                    # Trigger restart bằng cách exit với code đặc biệt
-                    os._exit(100)  # Exit code 100 để trigger restart
+            session = get_market_session(now)
+            idle = _idle_wait(session, now, _last_settled_refresh)
+            if idle is not None:
+                sleep_seconds, pause_monitor = idle
+                if pause_monitor:
+                    _health_monitor.pause()
+                with _metrics.timer('sleep'):
+                    await asyncio.sleep(sleep_seconds)
+                if pause_monitor:
+                    _health_monitor.resume()
+                continue
             
-            print(f"\n🔄 LẦN CẬP NHẬT THỨ {loop_count}")
-            print(f"🕐 Thời gian: {now.strftime('%H:%M:%S %d/%m/%Y')}")
-            print(f"📊 Thời gian chạy: {loop_count} phút")
-            if _start_time:
-                runtime_minutes = (datetime.now() - _start_time).total_seconds() / 60
-                remaining_minutes = _max_runtime_minutes - runtime_minutes
-                print(f"⏰ Runtime: {runtime_minutes:.1f} phút / {_max_runtime_minutes} phút")
-                print(f"⏰ Thời gian còn lại trước restart: {remaining_minutes:.1f} phút")
-            print("-" * 40)
+            _log_cycle_header(now)
             
-            # Cập nhật giá cổ phiếu
             start_time = time_module.time()
-            success = update_stock_prices(worksheet)
-            end_time = time_module.time()
-            update_duration = end_time - start_time
-            
-            if success:
-                print(f"✅ Cập nhật thành công! (Thời gian: {update_duration:.1f} giây)")
-                _error_count = 0  # Reset error count khi thành công
-            else:
-                print(f"⚠️ Cập nhật không thành công, thử lại sau... (Thời gian: {update_duration:.1f} giây)")
-                _error_count += 1
-                print(f"⚠️ Lỗi liên tục: {_error_count}/{_max_errors}")
-                
-                # Thử kết nối lại Google Sheets nếu cần
-                worksheet = connect_google_sheets()
-                if not worksheet:
-                    print("❌ Không thể kết nối lại Google Sheets. Thử lại sau...")
-                    _error_count += 1
-                
-                # Nếu quá nhiều lỗi liên tục, restart
-                if _error_count >= _max_errors:
-                    print("🔄 Quá nhiều lỗi liên tục. Khởi động lại...")
-                    _error_count = 0
-                    time_module.sleep(60)  # Chờ 1 phút trước khi restart
-            
-            print("=" * 60)
+            with _metrics.timer('update'):
+                success = await update_stock_prices_async(targets, http)
+            update_duration = time_module.time() - start_time
             
-            # Tính thời gian chờ tiếp theo
-            next_update = now + timedelta(minutes=1)
-            print(f"⏰ Lần cập nhật tiếp theo: {next_update.strftime('%H:%M:%S')}")
+            targets, backoff = await asyncio.to_thread(_after_update, session, success, update_duration, targets)
+            cycle_record = _metrics.flush()
+            refresh_key = settled_refresh_key(session)
+            if success and refresh_key is not None:
+                _last_settled_refresh = refresh_key
+            if backoff:
+                await asyncio.sleep(backoff)
             
-            # Chờ 1 phút trước khi cập nhật tiếp
-            print("⏳ Đang chờ 1 phút...")
-            
-            # Thêm delay ngẫu nhiên để tránh bị block
-            import random
-            random_delay = random.uniform(55, 65)  # Delay 55-65 giây
-            print(f"⏳ Đang chờ {random_delay:.1f} giây...")
-            time_module.sleep(random_delay)
-                
-    except KeyboardInterrupt:
-        print(f"\n🛑 ĐÃ DỪNG AUTO CẬP NHẬT (Cancel thủ công)")
-        print(f"📊 Tổng số lần cập nhật: {loop_count}")
-    except Exception as e:
-        print(f"\n❌ Lỗi trong auto cập nhật: {e}")
-        print(f"📊 Đã chạy được {loop_count} lần cập nhật")
-        print("🔄 Thử lại sau 30 giây...")
-        time_module.sleep(30)
-        print("🔄 Khởi động lại auto cập nhật...")
-        run_auto_update()
+            delay = _next_update(session, success, update_duration, cycle_record)
+            with _metrics.timer('sleep'):
+                await asyncio.sleep(delay)
+    finally:
+        monitor_task.cancel()
+        await http.close()
 
-# ====== 7. HÀM CHÍNH ======
+# ====== 8. HÀM CHÍNH ======
 if __name__ == "__main__":
-    print("📊 GITHUB ACTIONS STOCK PRICE UPDATER")
-    print("🔄 Auto cập nhật giá cổ phiếu Việt Nam liên tục (chạy cho đến khi cancel)")
-    print("🔧 Đã sửa lỗi: Timeout, Connection, API compatibility")
-    print("⏱️ Timeout: 5 giây cho mỗi API call")
-    print("🔄 Retry: 2 lần cho mỗi request")
-    print("🌐 Network check: Tự động kiểm tra kết nối mạng")
-    print("🛠️ Error handling: Cải thiện xử lý lỗi và logging")
-    print("⚡ Tối ưu hóa tốc độ: Batch processing, giảm delay")
-    print("📈 Performance: Theo dõi thời gian cập nhật")
-    print("🎯 Chế độ: LOGIC THÔNG MINH - Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
-    print("🚀 Tốc độ: Tối ưu cho từng thời điểm")
-    print("🛡️ Fallback: 3 methods khác nhau khi API timeout")
-    print("🔍 Debug: Hiển thị chi tiết lỗi timeout")
-    print("="*60)
+    setup_logging('DEBUG' if '--debug' in sys.argv[1:] else LOG_LEVEL)
+    if '--async' in sys.argv[1:]:
+        ASYNC_MODE = True
+    if '--hedge' in sys.argv[1:]:
+        HEDGE_ENABLED = True
+    logger.info("📊 GITHUB ACTIONS STOCK PRICE UPDATER")
+    logger.info("🔄 Auto cập nhật giá cổ phiếu Việt Nam liên tục (chạy cho đến khi cancel)")
+    logger.info("🔧 Đã sửa lỗi: Timeout, Connection, API compatibility")
+    logger.info("⏱️ Timeout: 5 giây cho mỗi API call")
+    logger.info("🔄 Retry: 2 lần cho mỗi request")
+    logger.info("🌐 Network check: Tự động kiểm tra kết nối mạng")
+    logger.info("🛠️ Error handling: Cải thiện xử lý lỗi và logging")
+    logger.info("⚡ Tối ưu hóa tốc độ: Batch processing, giảm delay")
+    logger.info("📈 Performance: Theo dõi thời gian cập nhật")
+    logger.info("🎯 Chế độ: LOGIC THÔNG MINH - Realtime khi thị trường mở, Đóng cửa khi thị trường đóng")
+    logger.info("🚀 Tốc độ: Tối ưu cho từng thời điểm")
+    logger.info("🛡️ Fallback: 3 methods khác nhau khi API timeout")
+    logger.info("🔍 Debug: Hiển thị chi tiết lỗi timeout")
+    logger.info("="*60)
     
     try:
         # Chạy auto cập nhật
         run_auto_update()
     except Exception as e:
-        print(f"❌ Lỗi trong main: {e}")
+        logger.error(f"❌ Lỗi trong main: {e}")
+        shutdown_logging()
         os._exit(1)
         